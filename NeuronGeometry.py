@@ -14,6 +14,15 @@ from collections import deque
 import matplotlib.pyplot as pyplot
 from math import log, sqrt, atan, isnan, pi, acos
 from bisect import bisect_left
+from heapq import heappush, heappop
+import numpy
+import gc
+import tempfile
+import types
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
 
 """
 Geometry class public methods: (self is always first argument)
@@ -24,6 +33,10 @@ Geometry class public methods: (self is always first argument)
  findBranches()
  checkConnectivity()
  shollAnalysis()
+ getArrays()
+ writeCache(cacheFile, key)
+ readCache(cacheFile, key)
+ steadyStateAnalysis(model)
 """
 
 terminalColors = {
@@ -111,18 +124,23 @@ class PathDistanceFinder(object):
       raise KeyError('%s is not reachable from the network' % segment.name)
 
     return min(baseD + segment.length * abs(pos - startPos) for
-               baseD, startPos, pathDesc, path in self.distances[segment])
+               baseD, startPos, label in self.distances[segment])
   
   def pathTo(self, segment, pos=0.5):
     # return optimal path to specified segment at specified location
-    return min(((baseD + segment.length * abs(pos - startPos), path) for
-               baseD, startPos, pathDesc, path in self.distances[segment]),
-               key=lambda x:x[0])[1]
+    return _labelPath(self._bestLabel(segment, pos))
   
   def pathDescriptionTo(self, segment, pos=0.5):
     # return optimal path to specified segment at specified location
-    return min(((baseD + segment.length * abs(pos - startPos), pathDesc) for
-               baseD, startPos, pathDesc, path in self.distances[segment]),
+    return _describeLabel(self._bestLabel(segment, pos))
+  
+  def _bestLabel(self, segment, pos):
+    # return the label (path end-point) that gives the shortest path to the
+    # specified segment at specified location
+    if type(segment) == int:
+      segment = self.network[segment]
+    return min(((baseD + segment.length * abs(pos - startPos), label) for
+               baseD, startPos, label in self.distances[segment]),
                key=lambda x:x[0])[1]
   
   def tortuosityTo(self, segment, pos=0.5):
@@ -181,73 +199,115 @@ class PathDistanceFinder(object):
     # Keep track of effect of startPos (starting position in startSegment)
     # Also keep track of effect of pos of each final segment
     segment, startPos = self.startSegment, self.startPos
+    # each path is stored as a label: a tuple
+    #   (segment, connecting location in the segment, parent label,
+    #    location in parent segment where the path leaves it)
+    # The start label has parent None. Full paths and path descriptions are
+    # only constructed (by following parent labels) when requested.
     # distances is a dict object, with segments as keys
-    # the values are a list of paths, each path described by a tuple
-    #   (pathDistance, connecting location in the segment, path description,
-    #    list of segments in path )
-    distances = { segment : [(0.0, startPos,
-                              segment.name + '(%.1f)' % startPos, [segment])] }
+    # the values are a list of efficient paths, each path described by a tuple
+    #   (pathDistance, connecting location in the segment, label)
+    # sorted by increasing pathDistance
+    startLabel = (segment, startPos, None, None)
+    distances = { segment : [(0.0, startPos, startLabel)] }
     branchOrders = { segment : 0 }
-    openSegments = { segment, }
-    while openSegments:
-      segment = openSegments.pop()
-      for currentD, startPos, segPathDesc, segPath in distances[segment]:
-        branchOrderInc = 1
-        if branchOrders[segment] > 0 and len(segment.neighbors) <= 2:
-          branchOrderInc = 0
-        #branchOrderInc = int(len(segment.neighbors) > 2)
-        for neighbor, (connectLoc, nConnectLoc, node) \
-            in zip(segment.neighbors, segment.neighborLocations):
-          pathD = currentD + segment.length * abs(startPos - connectLoc)
-          # check if neighbor in distances?
-          if neighbor not in distances:
-            # found path to new segment
-            nPath = segPath + [neighbor]
-            nPathDesc = segPathDesc + '->(%.1f)->' % connectLoc + \
-                  neighbor.name + '(%.1f)' % nConnectLoc
-            distances[neighbor] = [(pathD, nConnectLoc, nPathDesc, nPath)]
-            openSegments.add(neighbor)
+    # cache segment lengths, they're used in every relaxation
+    lengths = { segment : segment.length }
+    # heap of (pathDistance, tie-breaking count, label) left to expand
+    openPaths = [(0.0, 0, startLabel)]
+    # labels made obsolete by a shorter path are skipped when popped (keep a
+    # reference to each so that its id can't be recycled)
+    obsolete = {}
+    pushCount = 1
+    while openPaths:
+      currentD, dummy, label = heappop(openPaths)
+      if id(label) in obsolete:
+        continue
+      segment, startPos = label[0], label[1]
+      segLength = lengths[segment]
+      branchOrderInc = 1
+      if branchOrders[segment] > 0 and len(segment.neighbors) <= 2:
+        branchOrderInc = 0
+      for neighbor, (connectLoc, nConnectLoc, node) \
+          in zip(segment.neighbors, segment.neighborLocations):
+        pathD = currentD + segLength * abs(startPos - connectLoc)
+        # check if neighbor in distances?
+        if neighbor not in distances:
+          # found path to new segment
+          nLabel = (neighbor, nConnectLoc, label, connectLoc)
+          distances[neighbor] = [(pathD, nConnectLoc, nLabel)]
+          lengths[neighbor] = neighbor.length
+          heappush(openPaths, (pathD, pushCount, nLabel))
+          pushCount += 1
+          branchOrders[neighbor] = branchOrders[segment] + branchOrderInc
+        else:
+          # Either there is a loop involving this segment, or the path is
+          #  backtracking
+          # Check if the current path is an efficient route to the loop
+          efficient = True
+          insertInd = None
+          loopDistances = distances[neighbor]
+          nLength = lengths[neighbor]
+          keepDistances = []
+          for ind, (loopD, loopPos, loopLabel) in enumerate(loopDistances):
+            traverse = nLength * abs(loopPos - nConnectLoc)
+            if pathD >= loopD + traverse:
+              # the new path to neighbor is too slow to ever be useful
+              efficient = False
+              keepDistances.extend(loopDistances[ind:])
+              break
+            elif pathD + traverse < loopD:
+              # the new path to neighbor renders an old one obsolete
+              obsolete[id(loopLabel)] = loopLabel
+              continue
+            if insertInd is None and pathD < loopD:
+              insertInd = len(keepDistances)
+            keepDistances.append((loopD, loopPos, loopLabel))
+          distances[neighbor] = keepDistances
+          if efficient:
+            nLabel = (neighbor, nConnectLoc, label, connectLoc)
+            pathInfo = (pathD, nConnectLoc, nLabel)
+            if insertInd is None:
+              keepDistances.append(pathInfo)
+            else:
+              keepDistances.insert(insertInd, pathInfo)
+            heappush(openPaths, (pathD, pushCount, nLabel))
+            pushCount += 1
             branchOrders[neighbor] = branchOrders[segment] + branchOrderInc
-          else:
-            # Either there is a loop involving this segment, or the path is
-            #  backtracking
-            # Check if the current path is an efficient route to the loop
-            efficient = True
-            insertInd = None
-            loopDistances = distances[neighbor]
-            for ind, (loopD, loopPos, loopPathDesc, loopPath) in \
-                enumerate(loopDistances):
-              traverse = neighbor.length * abs(loopPos - nConnectLoc)
-              if pathD >= loopD + traverse:
-                # the new path to neighbor is too slow to ever be useful
-                efficient = False
-                break
-              elif pathD + traverse < loopD:
-                # the new path to neighbor renders an old one obsolete
-                loopDistances.pop(ind)
-              if insertInd is None and pathD < loopD:
-                insertInd = ind
-            if efficient:
-              nPath = segPath + [neighbor]
-              nPathDesc = segPathDesc + '->(%.1f)->' % connectLoc + \
-                    neighbor.name + '(%.1f)' % nConnectLoc
-              pathInfo = (pathD, nConnectLoc, nPathDesc, nPath)
-              if insertInd is None:
-                loopDistances.append(pathInfo)
-              else:
-                loopDistances.insert(insertInd, pathInfo)
-              distances[neighbor] = loopDistances
-              openSegments.add(neighbor)
-              branchOrders[neighbor] = branchOrders[segment] + branchOrderInc
-              if self.warnLoops and len(loopDistances) > 1:
-                warn('%d efficient paths to %s.' % (len(loopDistances), neighbor.name))
-                for ind, loopPos, loopPath in loopDistances:
-                  print(loopPath)
+            if self.warnLoops and len(keepDistances) > 1:
+              warn('%d efficient paths to %s.' % (len(keepDistances),
+                                                  neighbor.name))
+              for loopD, loopPos, loopLabel in keepDistances:
+                print(_describeLabel(loopLabel))
     
     return distances, branchOrders
 
 
 
+def _labelPath(label):
+  # follow parent links from a PathDistanceFinder label back to the start,
+  # returning the list of segments in the path
+  path = []
+  while label is not None:
+    path.append(label[0])
+    label = label[2]
+  path.reverse()
+  return path
+
+
+def _describeLabel(label):
+  # follow parent links from a PathDistanceFinder label back to the start,
+  # returning a string describing the path
+  descList = []
+  while label[2] is not None:
+    segment, pos, parent, connectLoc = label
+    descList.append('->(%.1f)->' % connectLoc + segment.name + '(%.1f)' % pos)
+    label = parent
+  descList.append(label[0].name + '(%.1f)' % label[1])
+  descList.reverse()
+  return ''.join(descList)
+
+
 class Geometry:
   def __init__(self, _fileName = None):
     # who knows, do something?
@@ -274,6 +334,12 @@ class Geometry:
     self._axons = None
     self._axonsBranch = None
     
+    # vectorized cache of segment geometric properties, built on request by
+    # self.getArrays()
+    self._arrays = None
+    # number of in-place changes to the shape of this geometry's Nodes
+    self._shapeVersion = 0
+    
     self.surfaceArea = 0.0   # mm^2
     self.volume = 0.0        # mm^3
 
@@ -294,6 +360,115 @@ class Geometry:
     return len(self.compartments)
   
   
+  def getArrays(self):
+    """
+    Return GeometryArrays (vectorized cache of geometric properties),
+    rebuilding it if the geometry has changed since it was last built.
+    Once built, Segment geometric properties are read from the arrays.
+    """
+    if self._arrays is None or not self._arrays.isCurrent(self):
+      self._arrays = GeometryArrays(self)
+    return self._arrays
+  
+  
+  def _arraysToken(self):
+    # cheap signature that changes when the geometry is structurally altered,
+    # or when any of its Nodes is moved or resized in place
+    return (len(self.nodes), len(self.compartments), len(self.segments),
+            len(self.branches),
+            id(self.segments[0]) if self.segments else None,
+            self._shapeVersion)
+  
+  
+  def writeCache(self, cacheFile, key=None):
+    """
+    Write the geometry (including any processing: connectivity, soma/axon
+    tags, branches, branch and centripetal orders) to binary cacheFile.
+    key is stored in the header, and must match when the cache is read. The
+    file is written to a temporary name and then renamed, so a partially
+    written cache is never read.
+    """
+    objects, states = _cacheStates(self)
+    cacheDir = os.path.dirname(os.path.abspath(cacheFile))
+    fd, tempName = tempfile.mkstemp(dir=cacheDir, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as fOut:
+        pickler = pickle.Pickler(fOut, pickle.HIGHEST_PROTOCOL)
+        # header: key and the class of each object
+        pickler.dump((key, [obj.__class__ for obj in objects]))
+        # object states, with references to objects stored as their index
+        objIndex = {id(obj) : ind for ind, obj in enumerate(objects)}
+        pickler.persistent_id = lambda obj: objIndex.get(id(obj))
+        pickler.dump(states)
+      if os.path.exists(cacheFile):
+        os.remove(cacheFile)
+      os.rename(tempName, cacheFile)
+    except BaseException:
+      if os.path.exists(tempName):
+        os.remove(tempName)
+      raise
+  
+  
+  def readCache(self, cacheFile, key=None):
+    """
+    Replace the contents of this geometry with the geometry stored in
+    cacheFile by writeCache(). Return True if successful, or False if
+    cacheFile is missing, unreadable, or was written with a different key.
+    The file name of this geometry is kept (the cache may have been written
+    for a file with the same contents at a different path).
+    """
+    fileName = self.fileName
+    # loading creates many objects but no garbage, so don't collect garbage
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+      with open(cacheFile, 'rb') as fIn:
+        unpickler = pickle.Unpickler(fIn)
+        cacheKey, classes = unpickler.load()
+        if cacheKey != key or classes[0] != self.__class__:
+          return False
+        objects = [self] + [_emptyInstance(cls) for cls in classes[1:]]
+        unpickler.persistent_load = objects.__getitem__
+        states = unpickler.load()
+      for obj, state in zip(objects, states):
+        obj.__dict__.update(state)
+    except (IOError, OSError, EOFError, ValueError, TypeError, IndexError,
+            AttributeError, ImportError, pickle.UnpicklingError):
+      return False
+    finally:
+      if gcEnabled:
+        gc.enable()
+    # these attributes aren't cached
+    self._arrays = None
+    self._connectivityChecked = set()
+    if fileName is None:
+      self.path = None
+      self.fileName = None
+      self.name = None
+    else:
+      self.setFileName(fileName)
+    return True
+  
+  
+  def steadyStateAnalysis(self, model):
+    """
+    Solve for the steady-state response of passive model (made by
+    neuron_simulateGeometry.makeModel) on this geometry, with one
+    factorization of the conductance matrix.
+    Return (inputResistance, transferRatios):
+      inputResistance (MOhm) is the soma voltage change per unit stimulus
+      transferRatios is a dict keyed by segment, of the ratio of the
+        segment's steady-state voltage change to the soma's
+    """
+    from neuron_simulateGeometry import steadyStateResponse
+    vSteady = steadyStateResponse(self, model)
+    somaV = vSteady[self.soma.name]
+    inputResistance = somaV / model['stimulus']['amplitude']
+    transferRatios = {segment : vSteady[segment.name] / somaV
+                      for segment in self.segments}
+    return inputResistance, transferRatios
+  
+  
   def readGeometry(self):
     raise RuntimeError( \
       'Geometry must be a subclass that knows how to read files')  
@@ -330,7 +505,19 @@ class Geometry:
     
   #############################################################################
   def getProperties(self, passiveFile="", display=True,
-                    makePlots=False):
+                    makePlots=False, modal=False, resultCache=None):
+    """
+    Compute morphological properties, and (if passiveFile is specified)
+    electrical properties of a passive model.
+    If modal is True, the membrane time constant is computed directly from
+    the slowest mode of the passive model, rather than fit to simulated data.
+    Then only steady-state properties remain, so input resistance and
+    coupling coefficients are solved for directly, and the model is only
+    simulated if makePlots is True.
+    If resultCache (a neuron_simulateGeometry.ResultCache) is specified,
+    electrical properties are reused from (and stored in) it.
+    Return properties, units
+    """
     def _dispListStats(L, confidence = 0.05, display=True, printName=""):
       # return median, lowBound, highBound
       sortedL = sorted(L)
@@ -393,6 +580,8 @@ class Geometry:
     # check connectivity
     self.checkConnectivity(removeDisconnected=True, removeLoops=True)
     self.findBranches()
+    # compute geometric properties of all segments and branches at once
+    self.getArrays()
     
     if display:
       print("number of connected nodes: %d" % len(self.nodes))
@@ -497,38 +686,79 @@ class Geometry:
     }
   
     if passiveFile:
-      from neuron_simulateGeometry import makeModel, simulateModel
+      from neuron_simulateGeometry import makeModel, simulateModel, \
+                                          modalResponse
       import peelLength
       import json
       # get the properties
       with open(passiveFile, 'r') as fIn:
         passiveProperties = json.load(fIn)
+      tips = [segment for segment in self.segments
+              if 'Soma' not in segment.tags and segment.isTerminal]
       # make a demo model
       model = makeModel(self, passiveProperties)
-      # simulation model on specified geometry
-      timeTrace, vTraces, textOutput = simulateModel(self, model)
-      if makePlots:
-        _plotTraces(timeTrace, vTraces)
-       
-      somaV = max(vTraces[self.soma.name])
-      rIn = somaV / model['stimulus']['amplitude']
+      if not makePlots:
+        # only the soma trace and the maximum tip voltages are needed
+        model['recording'] = {'segments' : [self.soma],
+                              'probes' : {'max' : [self.soma] + tips}}
+      # look for previously computed electrical properties
+      cached = {}
+      if resultCache is not None:
+        cacheKey = resultCache.key(self, model, passiveProperties,
+                                   'modal' if modal else 'neuron')
+        cached = resultCache.get(cacheKey) or {}
+      useCached = all(name in cached for name in
+                      ('rIn', 'tipsTransfer', 'expModel', 'vErr', 'vResid'))
+      if makePlots or not (modal or useCached):
+        # simulation model on specified geometry
+        timeTrace, vTraces, textOutput = simulateModel(self, model)
+        if makePlots:
+          _plotTraces(timeTrace, vTraces)
+      
+      if useCached:
+        rIn = cached['rIn'] ; tipsTransfer = cached['tipsTransfer']
+      elif modal:
+        rIn, transferRatios = self.steadyStateAnalysis(model)
+        tipsTransfer = [transferRatios[tip] for tip in tips]
+      else:
+        if makePlots:
+          vMax = {tip.name : max(vTraces[tip.name])
+                  for tip in [self.soma] + tips}
+        else:
+          vMax = {tip.name : vTraces[('max', tip.name)]
+                  for tip in [self.soma] + tips}
+        somaV = vMax[self.soma.name]
+        rIn = somaV / model['stimulus']['amplitude']
+        tipsTransfer = [vMax[tip.name] / somaV for tip in tips]
       properties['Input resistance'] = rIn
       units['Input resistance'] = 'MOhm'
       if display:
         print('Input resistance = %g MOhm' % rIn)
-      tipsV = [max(vTraces[segment.name]) for segment in self.segments
-              if 'Soma' not in segment.tags and segment.isTerminal]
-      tipsTransfer = [tipV / somaV for tipV in tipsV]
       _dispListStats(tipsTransfer, display=display,
                      printName='Coupling coefficient from soma to tips')
       properties['Coupling Coefficient'] = tipsTransfer
       units['Coupling Coefficient'] = ''
-      model, vErr, vResid = \
-      peelLength.modelResponse(timeTrace, vTraces[self.soma.name],
-                               verbose=False, findStepWindow=True,
-                               plotFit=False, debugPlots=False,
-                               displayModel=display)
-      tauM = model[0][0]
+      if useCached:
+        expModel = cached['expModel']
+        vErr = cached['vErr'] ; vResid = cached['vResid']
+        if display:
+          peelLength.printModel(expModel, vErr=vErr, vResid=vResid)
+      elif modal:
+        expModel, vErr, vResid = modalResponse(self, model)
+        if display:
+          peelLength.printModel(expModel, vErr=vErr, vResid=vResid)
+      else:
+        expModel, vErr, vResid = \
+        peelLength.modelResponse(timeTrace, vTraces[self.soma.name],
+                                 verbose=False, findStepWindow=True,
+                                 plotFit=False, debugPlots=False,
+                                 displayModel=display)
+      if resultCache is not None and not useCached:
+        resultCache.update(cacheKey, {'rIn' : rIn,
+                                      'tipsTransfer' : tipsTransfer,
+                                      'expModel' : expModel, 'vErr' : vErr,
+                                      'vResid' : vResid})
+      tauM = expModel[0][0]
       if display:
         print('membrane tau = %6.2f ms' % tauM)
       properties['Membrane Time Constant'] = tauM
@@ -1049,6 +1279,73 @@ class Geometry:
     return newNode
   
   
+  def _addNodes(self, segment, x, y, z, r):
+    """
+    Define and add many (circular) nodes to the model within the specified
+    segment, given arrays of coordinates and radii. Consecutive nodes are
+    connected by appended compartments, as though each node were added with
+    _addNode() then connected to the previous node with _addCompartment().
+    Compartment geometry is computed for all the new compartments at once.
+    """
+    if segment.nodes:
+      # the first new compartment connects to the current last node
+      lastNode = segment.nodes[-1]
+      x = numpy.concatenate(([lastNode.x], x))
+      y = numpy.concatenate(([lastNode.y], y))
+      z = numpy.concatenate(([lastNode.z], z))
+      r = numpy.concatenate(([lastNode.r1], r))
+      numOld = 1
+    else:
+      numOld = 0
+    for _x, _y, _z, _r in zip(x[numOld:].tolist(), y[numOld:].tolist(),
+                              z[numOld:].tolist(), r[numOld:].tolist()):
+      self._addNode(segment, _x, _y, _z, _r)
+    nodes = segment.nodes[len(segment.nodes) - len(x):]
+    if len(nodes) < 2:
+      return
+    
+    # compute length, surface area, and volume of new compartments
+    r0, r1 = r[:-1], r[1:]
+    length = numpy.sqrt(numpy.diff(x)**2 + numpy.diff(y)**2 +
+                        numpy.diff(z)**2)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      coneFactor = numpy.where(r0 == r1, 1.0,
+                               numpy.sqrt(1.0 + ((r0 - r1) / length)**2))
+    surfaceArea = 1.0e-6 * (coneFactor * pi * length * (r0 + r1))
+    volume = 1.0e-9 * ((pi / 3.0) * length * (r0 * r0 + r1 * r1 + r0 * r1))
+    # degenerate compartments compute their own geometry (and warn)
+    regular = ((length > 0) | (r0 == r1)).tolist()
+    
+    compTags = set(segment.tags)
+    compTags.add(segment.name)
+    for ind, (node0, node1) in enumerate(zip(nodes[:-1], nodes[1:])):
+      newComp = TwoNodeCompartment(node0, node1)
+      if regular[ind]:
+        newComp._length = float(length[ind])
+        newComp._surfaceArea = float(surfaceArea[ind])
+        newComp._volume = float(volume[ind])
+      node0.compartments.append(newComp)
+      node1.compartments.append(newComp)
+      segment.compartments.append(newComp)
+      
+      # add segment information to compartment
+      newComp.tags.update(compTags)
+      newComp.segment = segment
+      
+      # add compartment to geometry
+      self.compartments.append(newComp)
+      
+      # update geometry totals
+      self.surfaceArea += newComp.surfaceArea
+      self.volume += newComp.volume
+    
+    # update tag counts
+    numComps = len(nodes) - 1
+    self.tags['*'] += numComps
+    for tag in compTags:
+      self.tags[tag] += numComps
+  
+  
   def _addCompartment(self, segment, node0, node1=None, append=False):
     """
     Define and add compartment to geometry within specified segment
@@ -2006,6 +2303,208 @@ def getBranchAngle(segment, neighbor, segLoc, nLoc, node):
   return angle
   
 
+class GeometryArrays(object):
+  """
+  Vectorized cache of the geometric properties of a Geometry. The Node,
+  Compartment and Segment objects remain the representation of the geometry;
+  this copies what the properties need into arrays:
+    node coordinates and radii (nodeX, nodeY, nodeZ, nodeR)
+    compartment node index pairs (compNodes)
+    segment compartment ranges (segCompInds[segCompPtr[i]:segCompPtr[i+1]]
+      are the compartments of segment i, in order)
+  and computes geometric quantities (length, surface area, volume, radii)
+  vectorized once for every compartment and segment in the cell. It costs
+  on the order of 100 bytes per node and per compartment, on top of the
+  objects.
+  Obtain via geometry.getArrays(), which rebuilds the cache if the geometry
+  has changed since it was built (structurally, or by moving or resizing one
+  of its Nodes in place).
+  """
+  def __init__(self, geometry, segments=None):
+    if segments is None:
+      segments = geometry.segments + [b for b in geometry.branches
+                                      if b not in geometry.segments]
+    self.segments = segments
+    self.segmentIndex = {segment : ind for ind, segment in enumerate(segments)}
+    
+    # number compartments and nodes in the order they are encountered in
+    # segments, so that each of geometry.segments is a contiguous range
+    self.compartments = []
+    compIndex = {}
+    self.nodes = []
+    nodeIndex = {}
+    segCompInds = []
+    self.segCompPtr = numpy.zeros(len(segments) + 1, dtype=int)
+    # record enough about each segment to tell if it has been altered since
+    self._segmentChecks = []
+    for segInd, segment in enumerate(segments):
+      for c in segment.compartments:
+        if c not in compIndex:
+          compIndex[c] = len(self.compartments)
+          self.compartments.append(c)
+          for n in c.nodes:
+            if n not in nodeIndex:
+              nodeIndex[n] = len(self.nodes)
+              self.nodes.append(n)
+        segCompInds.append(compIndex[c])
+      self.segCompPtr[segInd + 1] = len(segCompInds)
+      self._segmentChecks.append(_segmentCheck(segment))
+    self.segCompInds = numpy.array(segCompInds, dtype=int)
+    self.compIndex = compIndex
+    self.nodeIndex = nodeIndex
+    
+    # node coordinates and radii
+    self.nodeX = numpy.array([n.x for n in self.nodes], dtype=float)
+    self.nodeY = numpy.array([n.y for n in self.nodes], dtype=float)
+    self.nodeZ = numpy.array([n.z for n in self.nodes], dtype=float)
+    self.nodeR = numpy.array([n.r1 for n in self.nodes], dtype=float)
+    
+    # compartment node pairs (one-node compartments repeat their node)
+    self.compNodes = numpy.array([(nodeIndex[c.nodes[0]],
+                                   nodeIndex[c.nodes[-1]])
+                                  for c in self.compartments],
+                                 dtype=int).reshape(-1, 2)
+    self._calcCompartmentProperties()
+    self._calcSegmentProperties()
+    self._token = geometry._arraysToken()
+  
+  
+  def _calcCompartmentProperties(self):
+    # compute geometric properties of all two-node compartments at once,
+    # using the same formulas as TwoNodeCompartment (for circular nodes)
+    n0, n1 = self.compNodes[:, 0], self.compNodes[:, 1]
+    r0, r1 = self.nodeR[n0], self.nodeR[n1]
+    length = numpy.sqrt((self.nodeX[n1] - self.nodeX[n0])**2 +
+                        (self.nodeY[n1] - self.nodeY[n0])**2 +
+                        (self.nodeZ[n1] - self.nodeZ[n0])**2)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      coneFactor = numpy.where(r0 == r1, 1.0,
+                               numpy.sqrt(1.0 + ((r0 - r1) / length)**2))
+      surfaceArea = numpy.where((length == 0) & (r0 != r1),
+                                pi * numpy.abs(r0 * r0 - r1 * r1),
+                                coneFactor * pi * length * (r0 + r1))
+      volume = (pi / 3.0) * length * (r0 * r0 + r1 * r1 + r0 * r1)
+      avgRadius = numpy.where(length == 0, 0.5 * (r0 + r1),
+                              numpy.sqrt(volume / length / pi))
+    # convert from um^2 to mm^2 and um^3 to mm^3
+    self.compLength = length
+    self.compSurfaceArea = 1.0e-6 * surfaceArea
+    self.compVolume = 1.0e-9 * volume
+    self.compAvgRadius = avgRadius
+    self.compMaxRadius = numpy.maximum(r0, r1)
+    self.compMinRadius = numpy.minimum(r0, r1)
+    
+    # anything that isn't a simple two-node compartment uses its own formulas
+    for ind, c in enumerate(self.compartments):
+      if not isinstance(c, TwoNodeCompartment):
+        self.compLength[ind] = c.length
+        self.compSurfaceArea[ind] = c.surfaceArea
+        self.compVolume[ind] = c.volume
+        self.compAvgRadius[ind] = c.avgRadius
+        self.compMaxRadius[ind] = c.maxRadius
+        self.compMinRadius[ind] = c.minRadius
+  
+  
+  def _calcSegmentProperties(self):
+    # sum/reduce compartment properties over every segment at once
+    numSegs = len(self.segments)
+    numComps = numpy.diff(self.segCompPtr)
+    segOf = numpy.repeat(numpy.arange(numSegs), numComps)
+    inds = self.segCompInds
+    
+    def _segSum(compValues):
+      return numpy.bincount(segOf, weights=compValues[inds],
+                            minlength=numSegs)
+    
+    self.segLength = _segSum(self.compLength)
+    self.segSurfaceArea = _segSum(self.compSurfaceArea)
+    self.segVolume = _segSum(self.compVolume)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      self.segAvgRadius = \
+        _segSum(self.compAvgRadius * self.compVolume) / self.segVolume
+    self.segMaxRadius = numpy.full(numSegs, -numpy.inf)
+    numpy.maximum.at(self.segMaxRadius, segOf, self.compMaxRadius[inds])
+    self.segMinRadius = numpy.full(numSegs, numpy.inf)
+    numpy.minimum.at(self.segMinRadius, segOf, self.compMinRadius[inds])
+  
+  
+  def isCurrent(self, geometry):
+    """
+    Return True if geometry has not been structurally altered since the
+    arrays were built
+    """
+    return self._token == geometry._arraysToken()
+  
+  
+  def segmentValue(self, segment, name):
+    """
+    Return segment property from the arrays (e.g. name='segLength'), or None
+    if segment isn't represented (or has been altered since arrays were built)
+    """
+    ind = self.segmentIndex.get(segment)
+    if ind is None or self._segmentChecks[ind] != _segmentCheck(segment):
+      return None
+    return getattr(self, name)[ind]
+
+
+def _segmentCheck(segment):
+  # cheap signature that changes if a segment's compartments are altered
+  compartments = segment.compartments
+  if compartments:
+    return (len(compartments), id(compartments[0]), id(compartments[-1]))
+  else:
+    return (0, None, None)
+
+
+# attributes that are rebuilt on demand, or refer to objects outside the
+# geometry (e.g. NEURON sections), so are not stored by Geometry.writeCache()
+_uncachedAttributes = frozenset(('_arrays', '_connectivityChecked', 'hSeg',
+                                  '_hocCell'))
+
+
+def _cacheStates(geometry):
+  """
+  Find every Geometry, Segment, Node, and Compartment reachable from
+  geometry. Return (objects, states), where objects[0] is geometry and
+  states[n] is the cached attribute dict of objects[n]. Objects are gathered
+  breadth-first, so that pickling states never recurses deeply.
+  """
+  cacheClasses = (Geometry, Segment, Node, Compartment)
+  containerTypes = (list, tuple, set, frozenset, dict)
+  objects = [geometry]
+  objIds = {id(geometry)}
+  states = []
+  for obj in objects:
+    # objects grows as new objects are discovered
+    state = {key : val for key, val in obj.__dict__.items()
+             if key not in _uncachedAttributes}
+    states.append(state)
+    openContainers = [state]
+    while openContainers:
+      container = openContainers.pop()
+      if isinstance(container, dict):
+        items = list(container.keys()) + list(container.values())
+      else:
+        items = container
+      for item in items:
+        if isinstance(item, cacheClasses):
+          if id(item) not in objIds:
+            objIds.add(id(item))
+            objects.append(item)
+        elif isinstance(item, containerTypes):
+          openContainers.append(item)
+  return objects, states
+
+
+def _emptyInstance(cls):
+  # create an instance of cls without calling __init__
+  if isinstance(cls, type):
+    return cls.__new__(cls)
+  else:
+    # python2 old-style class
+    return types.InstanceType(cls)
+
+
 class Segment:
   def __init__(self, geometry):
     self.geometry = geometry
@@ -2110,32 +2609,62 @@ class Segment:
       c.tags.add(newTag)
       self.geometry.tags[newTag] += 1
   
+  def _arrayValue(self, name):
+    # get precomputed property from geometry's arrays, if they have been built
+    # and are still valid for this segment. Otherwise return None
+    arrays = self.geometry._arrays
+    if arrays is None or not self.compartments:
+      return None
+    if not arrays.isCurrent(self.geometry):
+      # geometry was altered since the arrays were built
+      self.geometry._arrays = None
+      return None
+    return arrays.segmentValue(self, name)
+  
   @property
   def length(self):
+    value = self._arrayValue('segLength')
+    if value is not None:
+      return value
     return sum([c.length for c in self.compartments])
   
   @property
   def surfaceArea(self):
+    value = self._arrayValue('segSurfaceArea')
+    if value is not None:
+      return value
     return sum([c.surfaceArea for c in self.compartments])
   
   @property
   def maxRadius(self):
     # compute maximum radius
+    value = self._arrayValue('segMaxRadius')
+    if value is not None:
+      return value
     return max(c.maxRadius for c in self.compartments)
   
   @property
   def minRadius(self):
     # compute minimum radius
+    value = self._arrayValue('segMinRadius')
+    if value is not None:
+      return value
     return min(c.minRadius for c in self.compartments)
   
   @property
   def avgRadius(self):
     # compute average radius, weighted by volume
+    value = self._arrayValue('segAvgRadius')
+    if value is not None:
+      return value
     return sum(c.avgRadius * c.volume for c in self.compartments) / \
            sum(c.volume for c in self.compartments)
   
   @property
   def volume(self):
+    value = self._arrayValue('segVolume')
+    if value is not None:
+      return value
     return sum(c.volume for c in self.compartments)
   
   @property
@@ -2253,15 +2782,16 @@ class Segment:
     return centroidLen / segLen
    
 
+# Node attributes that determine the geometry of its compartments
+_nodeShapeAttributes = frozenset(('x', 'y', 'z', 'r1', 'r2', 'r3', 'theta',
+                                  'phi'))
+
+
 class Node:
   def __init__(self, _x, _y, _z, _r1, \
                _r2=None, _r3=None, _theta=0.0, _phi=0.0):
-    self.x = _x
-    self.y = _y
-    self.z = _z
-    self.r1 = _r1
-    if self.r1 <= 0.0:
-      if self.r1 < 0:
+    if _r1 <= 0.0:
+      if _r1 < 0:
         raise ValueError('Encountered negative radius')
       else:
         raise ValueError('Encountered radius=0')
@@ -2269,19 +2799,31 @@ class Node:
       if _r3 is not None:
         raise ValueError(\
           'Specify 1 radius for spherical nodes, 3 for ellipsoidal nodes')
-      self.r2 = _r1
-      self.r3 = _r1
+      _r2 = _r1
+      _r3 = _r1
+    
+    # set attributes directly, bypassing __setattr__ (it only needs to track
+    # changes to existing nodes, and is slow for the many nodes in a cell)
+    self.__dict__.update(
+      x=_x, y=_y, z=_z, r1=_r1, r2=_r2, r3=_r3,
+      theta=_theta, # angle from z axis
+      phi=_phi, # angle of azimuth (from x axis to semi-major axis)
+      compartments=[], segments=[], tags=set())
+  
+  def __setattr__(self, name, value):
+    # altering the shape of an existing node invalidates the computed
+    # properties of its compartments, and the GeometryArrays of its geometry
+    if name in _nodeShapeAttributes and name in self.__dict__:
+      self.__dict__[name] = value
+      geometries = {segment.geometry for segment in self.segments}
+      for c in self.compartments:
+        c._nodesChanged()
+        if c.segment is not None:
+          geometries.add(c.segment.geometry)
+      for geometry in geometries:
+        geometry._shapeVersion += 1
     else:
-      self.r2 = _r2
-      self.r3 = _r3
-    
-    self.theta = _theta # angle from z axis
-    self.phi = _phi # angle of azimuth (from x axis to semi-major axis)
-    
-    
-    self.compartments = []
-    self.segments = []
-    self.tags = set()
+      self.__dict__[name] = value
   
   @property
   def maxRadius(self):
@@ -2327,6 +2869,13 @@ class Compartment:
     self.segment = None
     self.nodes = None
   
+  def _nodesChanged(self):
+    # one of the compartment's nodes was altered, so recompute properties
+    # (compartment geometry is derived entirely from its nodes)
+    self._length = None
+    self._surfaceArea = None
+    self._volume = None
+  
   @property
   def neighbors(self):
     """
@@ -2499,7 +3048,10 @@ class TwoNodeCompartment(Compartment):
     Compartment.__init__(self)
     
     self.nodes = [node0, node1]
-    
+    self._setEnds()
+  
+  def _setEnds(self):
+    node0, node1 = self.nodes
     (self.semiMajor0, self.semiMinor0, self.theta0, self.x0, self.y0, self.z0)\
        = node0.getElipse(node1)
     (self.semiMajor1, self.semiMinor1, self.theta1, self.x1, self.y1, self.z1)\
@@ -2507,6 +3059,10 @@ class TwoNodeCompartment(Compartment):
       
     self._centroid = None
   
+  def _nodesChanged(self):
+    Compartment._nodesChanged(self)
+    self._setEnds()
+  
   @property
   def node0(self):
     return self.nodes[0]
@@ -15,7 +15,7 @@ from joblib import Parallel, delayed
 import tempfile
 import os
 import io  # to make logOut atomic
-from robust_map import robust_map
+from robust_map import robust_imap, TaskFailure
 import peelLength
 
 
@@ -51,6 +51,91 @@ def makeParamsList(numSections, range_Ra, range_cm, range_g):
   return paramsList
 
 
+###############################################################################
+def makeSearchRanges(numSections, range_Ra, range_cm, range_g):
+  """
+  Return list of ranges for each parameter, in the same order as the
+  parameter tuples from makeParamsList()
+  """
+  return [range_cm, range_Ra, range_Ra] + [range_g] * numSections
+
+
+###############################################################################
+def adaptiveSearch(evalFunc, ranges, numCoarse=3, numKeep=4, maxRounds=100):
+  """
+  Coarse-to-fine search for the parameters with the lowest fit error.
+  Evaluates a coarse grid in log space, then repeatedly evaluates the
+  neighbours (one step up or down each parameter) of the numKeep best points
+  so far, halving the step whenever the best points stop changing. It stops
+  when the best points stop changing at a step finer than the equivalent
+  full grid (from makeParamsList).
+    evalFunc: function taking a list of parameter tuples and returning a
+              list of results (fitErr, ...) like runParams
+    ranges:   list of ranges for each parameter, e.g. from makeSearchRanges
+  Returns paramsList, resultsList for every evaluated parameter set, in the
+  order they were evaluated
+  """
+  numDims = len(ranges)
+  lows = [log10(propRange[0]) for propRange in ranges]
+  highs = [log10(propRange[-1]) for propRange in ranges]
+  searchDims = [d for d in range(numDims) if highs[d] > lows[d]]
+  # resolution of the full grid, and initial (coarse) search step
+  fineSteps = [(highs[d] - lows[d]) / (ranges[d][1] - 1) for d in searchDims]
+  steps = [(highs[d] - lows[d]) / (numCoarse - 1) for d in searchDims]
+  
+  paramsList = [] ; resultsList = [] ; errs = {}
+  def _evaluate(logPoints):
+    # evaluate any points that have not been evaluated yet
+    newPoints = []
+    for logPoint in logPoints:
+      key = tuple(round(x, 9) for x in logPoint)
+      if key not in errs:
+        errs[key] = None
+        newPoints.append(key)
+    if not newPoints:
+      return
+    newParams = [tuple(10.0**x if highs[d] > lows[d] else ranges[d][0]
+                       for d, x in enumerate(logPoint))
+                 for logPoint in newPoints]
+    newResults = evalFunc(newParams)
+    for key, params, result in zip(newPoints, newParams, newResults):
+      errs[key] = result[0]
+      paramsList.append(params)
+      resultsList.append(result)
+  
+  def _best():
+    return sorted(errs, key=errs.get)[:numKeep]
+  
+  # evaluate the coarse grid
+  _evaluate(itertools.product(
+    *[[lows[d] + n * (highs[d] - lows[d]) / (numCoarse - 1)
+       for n in range(numCoarse)] if highs[d] > lows[d] else [lows[d]]
+      for d in range(numDims)]))
+  print('Coarse grid: %d parameter sets' % len(paramsList))
+  
+  steps = [0.5 * step for step in steps]
+  for numRounds in range(maxRounds):
+    best = _best()
+    neighbors = []
+    for logPoint in best:
+      for d, step in zip(searchDims, steps):
+        for delta in (-step, step):
+          x = min(max(logPoint[d] + delta, lows[d]), highs[d])
+          neighbors.append(logPoint[:d] + (x,) + logPoint[d+1:])
+    _evaluate(neighbors)
+    print('Round %d: %d parameter sets, best error = %.3g'
+          % (numRounds + 1, len(paramsList), errs[_best()[0]]))
+    if _best() == best:
+      # no improvement at this step size: done if it is the finest step,
+      # otherwise refine
+      if all(step < 0.5 * fineStep
+             for step, fineStep in zip(steps, fineSteps)):
+        break
+      steps = [0.5 * step for step in steps]
+  
+  return paramsList, resultsList
+
+
 ###############################################################################
 def makePassiveProperties(parameters=None):
   if parameters is None:
@@ -167,14 +252,44 @@ def analyzeExpOutput(expModel, vUnexplained, vResid,
 
 
 ###############################################################################
-def runParams(params, geoFile, logFile):
+_geometries = {}
+def _getGeometry(geoFile):
+  """
+  Return the geometry for geoFile, reusing it for every parameter set run in
+  this process (the 'pool' backend keeps its NEURON cell built as long as the
+  geometry lives). The geometry is prepared for simulation up front, so that
+  every backend simulates the same pruned geometry
+  """
   from neuron_readExportedGeometry import HocGeometry
-  from neuron_simulateGeometry import makeModel, simulateModel
+  from neuron_simulateGeometry import prepareGeometry
+  if geoFile not in _geometries:
+    _geometries[geoFile] = prepareGeometry(HocGeometry(geoFile, useCache=True))
+  return _geometries[geoFile]
+
+
+_modelHandles = {}
+def _getModelHandle(geoFile, geometry, model):
+  """
+  Return a ModelHandle for geoFile, building its NEURON cell the first time
+  in this process and only updating passive properties thereafter
+  """
+  from neuron_simulateGeometry import ModelHandle
+  if geoFile not in _modelHandles:
+    _modelHandles[geoFile] = ModelHandle(geometry, model)
+  return _modelHandles[geoFile]
+
+
+###############################################################################
+def runParams(params, geoFile, logFile, backend='neuron',
+              useResultCache=False):
+  from neuron_simulateGeometry import makeModel, simulateModel, \
+                                      modalResponse, getResultCache
   import peelLength
   print('Params: %s\n' % ', '.join('%.3g' % p for p in params))
   
-  # make a geometry object
-  geometry = HocGeometry(geoFile)
+  # get the geometry object (loading the processed geometry from the cache
+  # the first time in this process)
+  geometry = _getGeometry(geoFile)
   
   # make properties list from parameters
   properties = makePassiveProperties(params)
@@ -182,16 +297,44 @@ def runParams(params, geoFile, logFile):
   # make a passive model
   model = makeModel(geometry, properties)
   
-  # simulate the model
-  timeTrace, vTraces, textOutput = simulateModel(geometry, model)
-  print(textOutput)
+  # look for a previously computed result
+  cached = None
+  if useResultCache:
+    resultCache = getResultCache()
+    cacheKey = resultCache.key(geometry, model, properties, backend)
+    cached = resultCache.get(cacheKey)
+  
+  if cached is not None and 'expModel' in cached:
+    print('Using stored result')
+    expModel = cached['expModel']
+    vUnexplained = cached['vErr'] ; vResid = cached['vResid']
+    peelLength.printModel(expModel, vErr=vUnexplained, vResid=vResid)
+  elif backend == 'modal':
+    # compute the exponentials directly from the passive model
+    expModel, vUnexplained, vResid = modalResponse(geometry, model)
+    peelLength.printModel(expModel, vErr=vUnexplained, vResid=vResid)
+  else:
+    # simulate the model
+    if backend == 'handle':
+      handle = _getModelHandle(geoFile, geometry, model)
+      handle.updateParameters(properties)
+      timeTrace, vTraces, textOutput = handle.run()
+      print(handle.timingReport())
+    else:
+      timeTrace, vTraces, textOutput = simulateModel(geometry, model,
+                                                     backend=backend)
+    print(textOutput)
+    
+    # analyze output of model simulation
+    expModel, vUnexplained, vResid = \
+      peelLength.modelResponse(timeTrace, vTraces[geometry.soma.name],
+                               verbose=False, findStepWindow=True,
+                               plotFit=False, debugPlots=False,
+                               displayModel=True)
   
-  # analyze output of model simulation
-  expModel, vUnexplained, vResid = \
-    peelLength.modelResponse(timeTrace, vTraces[geometry.soma.name],
-                             verbose=False, findStepWindow=True,
-                             plotFit=False, debugPlots=False,
-                             displayModel=True)
+  if useResultCache and (cached is None or 'expModel' not in cached):
+    resultCache.update(cacheKey, {'expModel' : expModel,
+                                  'vErr' : vUnexplained, 'vResid' : vResid})
   
   fitErr = analyzeExpOutput(expModel, vUnexplained, vResid)
   
@@ -206,13 +349,65 @@ def printBatchSimResult(label, params, result):
   peelLength.printModel(result[1], vErr=result[2], vResid=result[3])
   
   
+###############################################################################
+def _evaluateParams(paramsList, geoFile, logFile, numProcesses,
+                    useRobustMap, backend, useResultCache, mapOptions={}):
+  """
+  Run runParams on every parameter set in paramsList in parallel, return list
+  of results. mapOptions are passed on to robust_imap.
+  """
+  if useRobustMap:
+    resultsList = [None] * len(paramsList)
+    bestErr = float('inf')
+    for ind, result in robust_imap(runParams, paramsList,
+                                   numProcesses=numProcesses,
+                                   args=(geoFile, logFile, backend,
+                                         useResultCache), **mapOptions):
+      if isinstance(result, TaskFailure):
+        # simulation was killed, so it can't be a good fit
+        print('\nFailed (%s): %s for %s'
+              % (result.reason, result.message,
+                 ', '.join('%.3g' % p for p in paramsList[ind])))
+        result = (float('inf'), [], None, None)
+      resultsList[ind] = result
+      # report the best fit so far
+      if result[0] < bestErr:
+        bestErr = result[0]
+        print('\nBest so far: error = %.3g for %s'
+              % (bestErr, ', '.join('%.3g' % p for p in paramsList[ind])))
+    return resultsList
+  else:
+    if numProcesses <= 0:
+      numProcesses -= 1
+    # evaluate all the parameter sets in parallel
+    return Parallel(n_jobs=numProcesses, verbose=10)(
+      delayed(runParams)(params, geoFile, logFile, backend, useResultCache)
+      for params in paramsList
+    )
+
+
 ###############################################################################
 def runBatchSimulate(geoFile, numSections=3, range_Ra=(60, 5, 480),
                      range_cm=(1.0,), range_g=(1e-7, 8, 1e-3),
                      logFile='batch_simulations.log',
-                     numProcesses=0, useRobustMap=True):
-  # get a list of the parameters for each passive model
-  paramsList = makeParamsList(numSections, range_Ra, range_cm, range_g)
+                     numProcesses=0, useRobustMap=True, backend='neuron',
+                     search='grid', useResultCache=True, chunkSize=1,
+                     checkpointDir=None, taskTimeout=None, maxMemory=None,
+                     maxTasksPerWorker=None):
+  """
+  Simulate passive models over ranges of parameters and report the best fit.
+    search: 'grid' evaluates every parameter set from makeParamsList(),
+            'adaptive' searches coarse-to-fine with adaptiveSearch()
+    useResultCache: if True, reuse (and store) results in the persistent
+            ResultCache, so overlapping sweeps don't recompute them
+    chunkSize: number of parameter sets sent to a robust_map worker at a
+            time
+    checkpointDir: directory for robust_map checkpoint files (default:
+            tempdir)
+    taskTimeout, maxMemory, maxTasksPerWorker: kill simulations that take
+            longer than taskTimeout seconds or more than maxMemory MB, and
+            replace each robust_map worker after maxTasksPerWorker tasks
+  """
   if logFile is not None:
     if os.access(logFile, os.F_OK):
       print('Backing up previous log file')
@@ -220,16 +415,23 @@ def runBatchSimulate(geoFile, numSections=3, range_Ra=(60, 5, 480),
     with io.open(logFile, 'wb') as fOut:
       fOut.write('Starting batch simulations.\n')
   
-  if useRobustMap:
-    resultsList = robust_map(runParams, paramsList, numProcesses=numProcesses,
-                           args=(geoFile, logFile))
+  mapOptions = {'chunkSize' : chunkSize, 'checkpointDir' : checkpointDir,
+                'taskTimeout' : taskTimeout, 'maxMemory' : maxMemory,
+                'maxTasksPerWorker' : maxTasksPerWorker}
+  def _evaluate(paramsList):
+    return _evaluateParams(paramsList, geoFile, logFile, numProcesses,
+                           useRobustMap, backend, useResultCache,
+                           mapOptions)
+  
+  if search == 'grid':
+    # get a list of the parameters for each passive model
+    paramsList = makeParamsList(numSections, range_Ra, range_cm, range_g)
+    resultsList = _evaluate(paramsList)
+  elif search == 'adaptive':
+    ranges = makeSearchRanges(numSections, range_Ra, range_cm, range_g)
+    paramsList, resultsList = adaptiveSearch(_evaluate, ranges)
   else:
-    if numProcesses <= 0:
-      numProcesses -= 1
-    # evaluate all the parameter sets in parallel
-    resultsList = Parallel(n_jobs=numProcesses, verbose=10)(
-      delayed(runParams)(params, geoFile, logFile) for params in paramsList
-    )
+    raise ValueError('Unknown search: %s' % search)
   
   # get the index to the best parameter set
   bestInd = min(enumerate(resultsList), key=lambda x:x[1][0])[0]
@@ -268,9 +470,40 @@ def _parseArguments():
   parser.add_argument("geoFile", help="file specifying neuron geometry")
   parser.add_argument("-np", "--numProcesses", default=-1, type=int,
        help="specify number of proceses to use. <= 0 indicates fewer than max")
+  parser.add_argument("--backend", default="neuron",
+       choices=["neuron", "pool", "handle", "hines", "modal"],
+       help="simulator: NEURON, NEURON in a persistent worker, NEURON cell"
+            + " built once per batch process, built-in"
+            + " passive cable (Hines) solver, or compute exponentials"
+            + " directly from passive model modes")
+  parser.add_argument("--search", default="grid",
+       choices=["grid", "adaptive"],
+       help="evaluate every parameter set on a log grid, or search"
+            + " coarse-to-fine around the lowest fit errors")
+  parser.add_argument("--noResultCache", action="store_true",
+       help="recompute every parameter set instead of reusing stored results")
+  parser.add_argument("--chunkSize", default=1, type=int,
+       help="number of parameter sets sent to a worker process at a time")
+  parser.add_argument("--checkpointDir", default=None,
+       help="directory for checkpoint files, used to resume interrupted"
+            + " batches (default: temporary directory)")
+  parser.add_argument("--taskTimeout", default=None, type=float,
+       help="kill (and retry once) simulations taking more than this many"
+            + " seconds")
+  parser.add_argument("--maxMemory", default=None, type=float,
+       help="kill (and retry once) simulations using more than this many MB")
+  parser.add_argument("--maxTasksPerWorker", default=None, type=int,
+       help="replace each worker process after this many simulations")
   return parser.parse_args()
 
 
 if __name__ == "__main__":
   options = _parseArguments()
-  runBatchSimulate(options.geoFile, numProcesses=options.numProcesses)
+  runBatchSimulate(options.geoFile, numProcesses=options.numProcesses,
+                   backend=options.backend, search=options.search,
+                   useResultCache=not options.noResultCache,
+                   chunkSize=options.chunkSize,
+                   checkpointDir=options.checkpointDir,
+                   taskTimeout=options.taskTimeout,
+                   maxMemory=options.maxMemory,
+                   maxTasksPerWorker=options.maxTasksPerWorker)
@@ -113,7 +113,7 @@ def getNeuronCurveTraces(baseDir):
       traces.append(newTrace)
     
     with open(outFile, 'w') as fOut:
-      json.dump(traces, fOut)
+      json.dump(traces, fOut, default=lambda data: data.tolist())
   else:
     with open(outFile, 'r') as fIn:
       traces = json.load(fIn)
@@ -208,7 +208,7 @@ def getCppCurveTraces(baseDir):
         break
     
     with open(outFile, 'w') as fOut:
-      json.dump(traces, fOut)
+      json.dump(traces, fOut, default=lambda data: data.tolist())
   else:
     with open(outFile, 'r') as fIn:
       traces = json.load(fIn)
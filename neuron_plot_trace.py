@@ -6,18 +6,19 @@
 _usageStr=\
 """usage: neuron_plot_trace.py traceFile [traceFile2] [traceFile3] ...
          loads and plots the traces in specified trace files
-     Can pass the -monitor keyword to monitor tracefiles for updates and replot
-       if necessary, but it's broken currently because of the .show()/.draw()
-       mechanism in pyplot
+     Trace files may be text or binary (written by saveBinaryTraces, or by
+       hoc following binaryTraceHeader); binary data is memory-mapped
+     Can pass the -monitor keyword to follow tracefiles as they are written,
+       updating the plots as data is appended
 """
 
 
 
-import sys, os
+import sys, os, re, warnings
+import numpy
 import matplotlib.pyplot as pyplot
 import matplotlib
 from plotXY import *
-from time import sleep
 
 
 # Make output fonts compatible with Illustrator
@@ -25,6 +26,12 @@ matplotlib.rcParams['pdf.fonttype'] = 42
 
 
 _lineNum = 0
+# binary trace files start with this magic string, followed by the format
+# version, byte order, and the byte offset of the trace data
+_binaryMagic = b'NRNTRACEBIN'
+_binaryVersion = 1
+# matches a line of text holding only white space
+_blankLine = re.compile(br'^[ \t\r\f\v]*$', re.MULTILINE)
 
 
 
@@ -40,6 +47,11 @@ def _getNextLine(fIn):
     # while the cleaned line is empty, iterate
     nextLine = fIn.readline()        # get the next line
     _lineNum = _lineNum + 1            # increment lineNum
+    if not nextLine.endswith(b'\n' if isinstance(nextLine, bytes) else '\n'):
+      # at the end of the file, or of what has been written of it so far
+      raise ValueError('Unexpected end of file')
+    if not isinstance(nextLine, str):
+      nextLine = nextLine.decode()
     commentInd = nextLine.find('#')  # get the index to the first comment mark
     if commentInd > -1:
       # there's a comment, remove it, and then strip white space
@@ -57,6 +69,9 @@ def loadTraces(traceFile, monitor=False):
   """
   load all the traces in traceFile into a dictionary object
   """
+  if isBinaryTraceFile(traceFile):
+    return _loadBinaryTraces(traceFile, monitor)
+  
   global _lineNum
   _lineNum = 0
   traces = []
@@ -76,6 +91,8 @@ def loadTraces(traceFile, monitor=False):
         _readTraceHeader(fIn, traces)
       
       # read in the data for each trace
+      text, lineEnds = _splitDataLines(fIn.read())
+      lineInd = 0
       for trace in traces:
         # first just add a few extra fields to trace
         trace['fileName'] = traceFile
@@ -83,12 +100,12 @@ def loadTraces(traceFile, monitor=False):
         if monitor:
           trace['mTime'] = mTime
         # read in data
-        _readTraceData(fIn, trace)
+        lineInd = _readTraceData(text, lineEnds, lineInd, trace)
   
-  except StandardError as err:
+  except Exception as err:
     sys.tracebacklimit = 0
     raise IOError('Error reading %s line %d: %s' % \
-                  (traceFile, _lineNum, err.message))
+                  (traceFile, _lineNum, err))
 
   return traces
 
@@ -114,12 +131,244 @@ def _readTraceHeader(fIn, traces):
 
 
 ###############################################################################
-def _readTraceData(fIn, trace):
+def _splitDataLines(text):
+  """
+  return text as bytes, and the index of the end of each of its lines
+  """
+  if not isinstance(text, bytes):
+    text = text.encode('utf-8')
+  lineEnds = numpy.flatnonzero(numpy.frombuffer(text, dtype=numpy.uint8)
+                               == ord('\n'))
+  if not text.endswith(b'\n'):
+    lineEnds = numpy.append(lineEnds, len(text))
+  return text, lineEnds
+
+
+
+###############################################################################
+def _getDataLine(text, lineEnds, lineInd):
+  """
+  return line number lineInd of text, with comments and white space removed
+  """
+  lineStart = lineEnds[lineInd - 1] + 1 if lineInd > 0 else 0
+  return text[lineStart:lineEnds[lineInd]].split(b'#', 1)[0].strip()
+
+
+
+###############################################################################
+def _readTraceData(text, lineEnds, lineInd, trace):
+  """
+  read the data corresponding to trace from the lines of text, starting at
+  line number lineInd, and return the number of the next unread line
+  """
+  trace['data'], lineInd = _readDataLines(text, lineEnds, lineInd,
+                                          trace['numT'])
+  if len(trace['data']) < trace['numT']:
+    raise ValueError('Unexpected end of file in trace %s' % trace['name'])
+  return lineInd
+
+
+
+###############################################################################
+def _readDataLines(text, lineEnds, lineInd, maxT):
+  """
+  read up to maxT values, one per line, from the lines of text starting at
+  line number lineInd, and return them with the number of the next unread
+  line. If there are no comments or blank lines among them, the lines are
+  parsed with one bulk numpy call, kept only if it gives one value per line;
+  otherwise they are parsed one at a time, so a bad line is reported
+  """
+  global _lineNum
+  headerLineNum = _lineNum - lineInd
+  # skip the comments and blank lines before the data
+  while lineInd < len(lineEnds) and not _getDataLine(text, lineEnds, lineInd):
+    lineInd += 1
+  _lineNum = headerLineNum + lineInd
+  
+  numT = min(maxT, len(lineEnds) - lineInd)
+  stopInd = lineInd + numT
+  if numT > 0:
+    blockStart = lineEnds[lineInd - 1] + 1 if lineInd > 0 else 0
+    block = text[blockStart:lineEnds[stopInd - 1]]
+    if b'#' not in block and _blankLine.search(block) is None:
+      with warnings.catch_warnings():
+        # numpy warns (rather than raising) about unparsable text
+        warnings.simplefilter('error')
+        try:
+          data = numpy.fromstring(block, dtype=float, sep=' ')
+        except (ValueError, DeprecationWarning):
+          data = None
+      if data is not None and len(data) == numT:
+        _lineNum = headerLineNum + stopInd
+        return data, stopInd
+  
+  # fall back to reading one line at a time
+  data = []
+  while len(data) < maxT and lineInd < len(lineEnds):
+    line = _getDataLine(text, lineEnds, lineInd)
+    lineInd += 1
+    _lineNum = headerLineNum + lineInd
+    if line:
+      data.append(float(line.decode()))
+  return numpy.array(data, dtype=float), lineInd
+
+
+
+###############################################################################
+def isBinaryTraceFile(traceFile):
   """
-  read the data corresponding to trace from fIn
+  return True if traceFile is a binary trace file, False if it is text
   """
-  trace['data'] = \
-    [float(_getNextLine(fIn)) for n in range(trace['numT'])]
+  with open(traceFile, 'rb') as fIn:
+    return fIn.read(len(_binaryMagic)) == _binaryMagic
+
+
+
+###############################################################################
+def binaryTraceHeader(names, units, numTs, dTs, byteOrder=sys.byteorder):
+  """
+  return the header of a binary trace file as a string. Trace data follows
+  the header as one contiguous block of float64 values per trace, in order.
+  numT is written with fixed width; entries of numTs that are None are left
+  as a '%12d' placeholder, so that code that only knows numT later (e.g. hoc
+  filling it in with printf) produces a header of the same length
+  """
+  numTWidth = 12
+  placeholder = '%%%dd' % numTWidth
+  numTStrs = [placeholder if numT is None else '%*d' % (numTWidth, numT)
+              for numT in numTs]
+  traceLines = ['%s %s %s %s\n' % (name, unit, numTStr, dT)
+                for name, unit, numTStr, dT in zip(names, units, numTStrs, dTs)]
+  body = '%d\n' % len(traceLines) + ''.join(traceLines)
+  firstLine = '%s %d %s %%10d\n' % (_binaryMagic.decode(), _binaryVersion,
+                                     byteOrder)
+  # length once any placeholders are filled in
+  headerLen = len(firstLine % 0) + len(body) + 1 \
+    + (numTWidth - len(placeholder)) * numTStrs.count(placeholder)
+  # pad so that the data is aligned to 8 bytes
+  padLen = -headerLen % 8
+  headerLen += padLen
+  return firstLine % headerLen + body + ' ' * padLen + '\n'
+
+
+
+###############################################################################
+def saveBinaryTraces(traces, traceFile):
+  """
+  save a list of traces to binary traceFile. Each trace is a dict with 'name',
+  'units', 'dT' and 'data', where 'data' may be a list, a numpy array, or a
+  NEURON Vector. Return the byte offset of the trace data
+  """
+  arrays = [_traceArray(trace['data']) for trace in traces]
+  header = binaryTraceHeader([trace['name'] for trace in traces],
+                             [trace['units'] for trace in traces],
+                             [len(array) for array in arrays],
+                             # repr() keeps every digit of dT
+                             [repr(float(trace['dT'])) for trace in traces])
+  with open(traceFile, 'wb') as fOut:
+    fOut.write(header.encode())
+    for array in arrays:
+      array.tofile(fOut)
+  return len(header)
+
+
+
+###############################################################################
+def _traceArray(data):
+  """
+  return trace data as a float64 numpy array, without copying NEURON Vectors
+  that support as_numpy()
+  """
+  if hasattr(data, 'as_numpy'):
+    data = data.as_numpy()
+  return numpy.ascontiguousarray(data, dtype=float)
+
+
+
+###############################################################################
+def _loadBinaryTraces(traceFile, monitor=False):
+  """
+  load the traces in binary traceFile, memory-mapping their data
+  """
+  mTime = os.path.getmtime(traceFile) if monitor else None
+  traces, dataOffset, dtype = _readBinaryHeader(traceFile)
+  _mapBinaryData(traceFile, traces, dataOffset, dtype)
+  for trace in traces:
+    trace['fileName'] = traceFile
+    trace['uniqueName'] = trace['name'] + '_' + traceFile
+    if monitor:
+      trace['mTime'] = mTime
+  return traces
+
+
+
+###############################################################################
+def _readBinaryHeader(traceFile):
+  """
+  read the header of binary traceFile, and return the list of traces (without
+  data), the byte offset of the data, and its dtype
+  """
+  with open(traceFile, 'rb') as fIn:
+    firstLine = fIn.readline().decode().split()
+    try:
+      magic, version, byteOrder, dataOffset = firstLine
+      version, dataOffset = int(version), int(dataOffset)
+    except ValueError:
+      raise IOError('Error reading %s: bad binary trace header' % traceFile)
+    if version != _binaryVersion:
+      raise IOError('Error reading %s: unsupported binary trace version %d'
+                    % (traceFile, version))
+    header = fIn.read(dataOffset - fIn.tell()).decode()
+  
+  headerLines = [line.strip() for line in header.splitlines()]
+  headerLines = [line for line in headerLines
+                 if line and not line.startswith('#')]
+  if not headerLines:
+    raise IOError('Error reading %s: incomplete binary trace header'
+                  % traceFile)
+  numTraces = int(headerLines[0])
+  traces = []
+  for headerLine in headerLines[1:numTraces + 1]:
+    (traceName, units, numT, dT) = headerLine.rsplit(None, 3)
+    traces.append( {'name'  : traceName,
+                    'units' : units,
+                    'numT'  : int(numT),
+                    'dT'    : float(dT) } )
+  if len(traces) != numTraces:
+    raise IOError('Error reading %s: expected %d trace headers, found %d'
+                  % (traceFile, numTraces, len(traces)))
+  
+  dtype = numpy.dtype(float).newbyteorder('<' if byteOrder == 'little'
+                                          else '>')
+  return traces, dataOffset, dtype
+
+
+
+###############################################################################
+def _mapBinaryData(traceFile, traces, dataOffset, dtype, partial=False):
+  """
+  memory-map the data of binary traceFile into the 'data' of each trace. If
+  partial is True, traces are truncated to the data written so far, instead
+  of raising IOError
+  """
+  totalT = sum(trace['numT'] for trace in traces)
+  dataSize = os.path.getsize(traceFile) - dataOffset
+  if partial:
+    totalT = min(totalT, max(0, dataSize // dtype.itemsize))
+  elif dataSize < totalT * dtype.itemsize:
+    raise IOError('Error reading %s: expected %d bytes of trace data, '
+                  'found %d' % (traceFile, totalT * dtype.itemsize,
+                                dataSize))
+  if totalT == 0:
+    data = numpy.zeros(0, dtype=dtype)
+  else:
+    data = numpy.memmap(traceFile, dtype=dtype, mode='r', offset=dataOffset,
+                        shape=(totalT,))
+  
+  startT = 0
+  for trace in traces:
+    trace['data'] = data[startT:startT + trace['numT']]
+    startT += trace['numT']
 
 
 
@@ -159,7 +408,7 @@ def plotTrace(trace, dupTraces=None, figures=None,
   units = trace['units']
   
   # do any conversions to dT, tUnits based on tUnits and numT?
-  t = [dT * n for n in range(trace['numT'])]
+  t = dT * numpy.arange(len(trace['data']))
   
   xLabel = 'Time (%s)' % tUnits
   yLabel = '%s (%s)' % (trace['name'], units)
@@ -182,15 +431,16 @@ def plotTrace(trace, dupTraces=None, figures=None,
       trace2 = dupTraces[dupNum]
       dT2 = trace2['dT'] * tFactor
       units2 = trace2['units']
-      t2 = [dT2 * n for n in range(trace2['numT'])]
+      t2 = dT2 * numpy.arange(len(trace2['data']))
       plotXY(t2, trace2['data'], '-', color=getColor(dupNum+2), \
              xLabel=xLabel, yLabel=yLabel, title=titleStr, \
-             legendLabel=trace2[legendName], figure=overlayFig, linewidth=2)
+             legendLabel=trace2[legendName], figure=overlayFig, linewidth=2,
+             decimate=True)
     
     titleStr = trace['name'] + ' overlaid'
     plotXY(t, trace['data'], '-', color=getColor(1), \
            xLabel=xLabel, yLabel=yLabel, title=titleStr, \
-           legendLabel=trace[legendName], figure=overlayFig)
+           legendLabel=trace[legendName], figure=overlayFig, decimate=True)
     pyplot.legend(loc=0)
     
     # make difference plots
@@ -199,11 +449,11 @@ def plotTrace(trace, dupTraces=None, figures=None,
     for dupNum in range(len(dupTraces)):
       trace2 = dupTraces[dupNum]
       numDiff += 1
-      traceDiff = [y2 - y for (y, y2) in zip(trace['data'], trace2['data'])]
-      numT = min(trace['numT'], trace2['numT'])
+      numT = min(len(trace['data']), len(trace2['data']))
+      traceDiff = trace2['data'][:numT] - trace['data'][:numT]
       plotXY(t[:numT], traceDiff, '-', color=getColor(dupNum + 2), \
              xLabel=xLabel, yLabel=yLabel, title=titleStr, \
-             legendLabel=trace2[legendName], figure=diffFig)
+             legendLabel=trace2[legendName], figure=diffFig, decimate=True)
     if numDiff > 0:
       pyplot.legend(loc=0)
   else:
@@ -213,12 +463,45 @@ def plotTrace(trace, dupTraces=None, figures=None,
     else:
       traceFig = figures[0]
       traceFig.clf()
-    plotXY(t, trace['data'], 'k-',
-           xLabel=xLabel, yLabel=yLabel, title=trace['name'], figure=traceFig)
+    plotXY(t, trace['data'], 'k-', xLabel=xLabel, yLabel=yLabel,
+           title=trace['name'], figure=traceFig, decimate=True)
   
   return figures
 
 
+###############################################################################
+def updateTracePlot(trace, dupTraces, figures):
+  """
+  update the lines drawn by plotTrace() with the current data of trace and
+  dupTraces, without replotting
+  """
+  (dT, tUnits) = scaleTraceTime(trace, 'ms')
+  tFactor = dT / trace['dT']
+  def _t(_trace, _numT):
+    return tFactor * _trace['dT'] * numpy.arange(_numT)
+  
+  if dupTraces:
+    overlayFig, diffFig = figures
+    # plotTrace() draws the duplicates first, then trace
+    lineTraces = list(dupTraces) + [trace]
+    for line, lineTrace in zip(overlayFig.axes[0].get_lines(), lineTraces):
+      setLineData(line, _t(lineTrace, len(lineTrace['data'])),
+                  lineTrace['data'])
+    for line, trace2 in zip(diffFig.axes[0].get_lines(), dupTraces):
+      numT = min(len(trace['data']), len(trace2['data']))
+      setLineData(line, _t(trace, numT),
+                  trace2['data'][:numT] - trace['data'][:numT])
+  else:
+    line = figures[0].axes[0].get_lines()[0]
+    setLineData(line, _t(trace, len(trace['data'])), trace['data'])
+  
+  for fig in figures:
+    for axes in fig.axes:
+      axes.relim()
+      axes.autoscale_view()
+    fig.canvas.draw_idle()
+
+
 ###############################################################################
 def scaleTraceTime(originalTrace, originalUnits):
   """
@@ -324,16 +607,20 @@ def findDuplicateTraces(traces, updateList):
     else:
       return False
   
+  def _isIn(t, tList):
+    # compare by identity: comparing trace dicts would compare data arrays
+    return any(t is t2 for t2 in tList)
+  
   duplicates = []
   noDupTraces = []
   updates = []
   while traces:
     trace = traces.pop(0)
-    update = trace in updateList
+    update = _isIn(trace, updateList)
     dups = [t for t in traces if _isDup(t, trace)]
+    traces = [t for t in traces if not _isIn(t, dups)]
     for t in dups:
-      traces.remove(t)
-      if t in updateList:
+      if _isIn(t, updateList):
         update = True
     noDupTraces.append(trace)
     duplicates.append(dups)
@@ -381,29 +668,154 @@ def plotTraces(traces, monitor=False, updateList=None, figures=None):
 
 
 ###############################################################################
-def monitorTraces(tracesFiles, traces, figures, sleepTime=1):
-  dependTraces = { traceFile : [trace for trace in traces
-                               if trace['fileName'] == traceFile]
-                   for traceFile in traceFiles }
-  mTimes = { traceFile : dependTraces[traceFile][0]['mTime']
-             for traceFile in traceFiles }
+class TraceFollower(object):
+  """
+  Follow a trace file while it is being written. Each update() parses only
+  the data appended since the previous update; traces holds the traces read
+  so far, with 'data' holding the samples written so far
+  """
+  def __init__(self, traceFile):
+    self.traceFile = traceFile
+    self.traces = []
+    self.reloaded = False
+    self._header = None
+    self._offset = 0
+  
+  
+  def update(self):
+    """
+    read data appended to the file since the last update, and return the list
+    of traces that changed. If the file was (re)written from the start, its
+    header is read again, self.reloaded is set, and all traces are returned
+    """
+    self.reloaded = False
+    try:
+      fileSize = os.path.getsize(self.traceFile)
+    except OSError:
+      return []
+    if self._header is None or fileSize < self._offset \
+        or not self._sameHeader():
+      if not self._readHeader():
+        # the header hasn't been completely written yet
+        return []
+      self.reloaded = True
+    
+    if self._binary:
+      updated = self._updateBinary()
+    else:
+      updated = self._updateText()
+    return self.traces if self.reloaded else updated
+  
+  
+  def _sameHeader(self):
+    with open(self.traceFile, 'rb') as fIn:
+      return fIn.read(len(self._header)) == self._header
+  
+  
+  def _readHeader(self):
+    global _lineNum
+    _lineNum = 0
+    try:
+      self._binary = isBinaryTraceFile(self.traceFile)
+      if self._binary:
+        traces, dataOffset, self._dtype = _readBinaryHeader(self.traceFile)
+      else:
+        traces = []
+        with open(self.traceFile, 'rb') as fIn:
+          numTraces = int(_getNextLine(fIn))
+          for n in range(numTraces):
+            _readTraceHeader(fIn, traces)
+          dataOffset = fIn.tell()
+    except (IOError, ValueError):
+      return False
+    
+    with open(self.traceFile, 'rb') as fIn:
+      self._header = fIn.read(dataOffset)
+    self._offset = dataOffset
+    self._traceInd = 0
+    # traces are filled in as data arrives (pages are only allocated when
+    # they're written)
+    self._buffers = [numpy.empty(trace['numT']) for trace in traces]
+    for trace, buffer in zip(traces, self._buffers):
+      trace['data'] = buffer[:0]
+      trace['fileName'] = self.traceFile
+      trace['uniqueName'] = trace['name'] + '_' + self.traceFile
+    self.traces = traces
+    return True
   
+  
+  def _updateText(self):
+    with open(self.traceFile, 'rb') as fIn:
+      fIn.seek(self._offset)
+      newText = fIn.read()
+    # only parse complete lines
+    newText = newText[:newText.rfind(b'\n') + 1]
+    if not newText:
+      return []
+    self._offset += len(newText)
+    
+    text, lineEnds = _splitDataLines(newText)
+    lineInd = 0
+    updated = []
+    while self._traceInd < len(self.traces):
+      trace = self.traces[self._traceInd]
+      numRead = len(trace['data'])
+      data, lineInd = _readDataLines(text, lineEnds, lineInd,
+                                     trace['numT'] - numRead)
+      if len(data):
+        buffer = self._buffers[self._traceInd]
+        buffer[numRead:numRead + len(data)] = data
+        trace['data'] = buffer[:numRead + len(data)]
+        updated.append(trace)
+      if len(trace['data']) < trace['numT']:
+        # out of data
+        break
+      self._traceInd += 1
+    return updated
+  
+  
+  def _updateBinary(self):
+    oldLens = [len(trace['data']) for trace in self.traces]
+    _mapBinaryData(self.traceFile, self.traces, self._offset, self._dtype,
+                   partial=True)
+    return [trace for trace, oldLen in zip(self.traces, oldLens)
+            if len(trace['data']) != oldLen]
+
+
+
+###############################################################################
+def monitorTraces(followers, figures, sleepTime=1):
+  """
+  follow trace files as they are written, updating the plots of their traces
+  in place as data is appended
+  """
   while True:
+    # pause (rather than sleep) to keep the figures responsive
+    pyplot.pause(sleepTime)
     updateList = []
-    sleep(sleepTime)
-    for traceFile, mTime in mTimes.items():
-      currentMTime = os.path.getmtime(traceFile)
-      if currentMTime > mTime:
-        needUpdate = True
-        updateList.extend(dependTraces[traceFile])
-        mTimes[traceFile] = currentMTime
-    if updateList:
-      plotTraces(traces, monitor=True, updateList=updateList, figures=figures)
-    else:
-      for fName, figList in figures.items():
-        for fig in figList:
-          print('draw')
-          fig.canvas.draw()
+    reloaded = False
+    for follower in followers:
+      updateList.extend(follower.update())
+      reloaded = reloaded or follower.reloaded
+    if not updateList:
+      continue
+    
+    traces = [trace for follower in followers for trace in follower.traces]
+    traces, duplicates, updates = findDuplicateTraces(traces, updateList)
+    for trace, dups, needPlot in zip(traces, duplicates, updates):
+      if not needPlot:
+        continue
+      traceFigures = figures.get(trace['uniqueName'])
+      if traceFigures is not None and len(traceFigures) != (2 if dups else 1):
+        # the duplicates of this trace changed, so make new figures
+        traceFigures = None
+      if traceFigures is None or reloaded:
+        traceFigures = plotTrace(trace, dups, traceFigures)
+        figures[trace['uniqueName']] = traceFigures
+        for fig in traceFigures:
+          fig.canvas.draw_idle()
+      else:
+        updateTracePlot(trace, dups, traceFigures)
 
 
 
@@ -436,13 +848,20 @@ if __name__ == "__main__":
   traceFiles, monitor = _parseArguments()
   
   # load all the traces
-  traces = []
-  for traceFile in traceFiles:
-    traces.extend( loadTraces(traceFile, monitor) )
+  if monitor:
+    followers = [TraceFollower(traceFile) for traceFile in traceFiles]
+    traces = []
+    for follower in followers:
+      follower.update()
+      traces.extend(follower.traces)
+  else:
+    traces = []
+    for traceFile in traceFiles:
+      traces.extend( loadTraces(traceFile, monitor) )
   
   figs = plotTraces(traces, monitor)
   
   if monitor:
-    monitorTraces(traceFiles, traces, figs)
+    monitorTraces(followers, figs)
 
   sys.exit(0)
@@ -33,15 +33,20 @@ def system(commandStr):
 
 
 ###############################################################################
-def getProperties(geoFile, passivePropsFile, display=True):
+def getProperties(geoFile, passivePropsFile, display=True,
+                  useResultCache=True):
   from neuron_readExportedGeometry import demoRead
-  properties, units = demoRead(geoFile, passivePropsFile, display=display)
+  from neuron_simulateGeometry import getResultCache
+  # reuse electrical properties computed by previous runs
+  resultCache = getResultCache() if useResultCache else None
+  properties, units = demoRead(geoFile, passivePropsFile, display=display,
+                               resultCache=resultCache)
   return (properties, units)
 
 
 ###############################################################################
 def computeCellProperties(cellTypesFile, passivePropsFile, populationPropsFile,
-                          numProcesses=0):
+                          numProcesses=0, useResultCache=True):
   geoFiles = {}
   baseDir = os.path.dirname(cellTypesFile)
   with open(cellTypesFile, 'r') as fIn:
@@ -53,7 +58,8 @@ def computeCellProperties(cellTypesFile, passivePropsFile, populationPropsFile,
   
   
   results = robust_map(getProperties, geoFiles, args=(passivePropsFile,),
-                          numProcesses=numProcesses)
+                       kwargs={'useResultCache' : useResultCache},
+                       numProcesses=numProcesses)
   properties, units = zip(*results)
   units = units[0]
   
@@ -340,6 +346,9 @@ def _parseArguments():
   parser.add_argument("-s", "--savePlotsDir", nargs="?", type=str, default="",
                 help="save plots to .pdf files in this dir instead of drawing",
                 action=FullPaths)
+  parser.add_argument("--noResultCache", action="store_true",
+                      help="recompute properties of every cell instead of "
+                           + "reusing stored results")
   return parser.parse_args()
   
 
@@ -352,7 +361,8 @@ if __name__ == "__main__":
   else:
     analysis = computeCellProperties(options.cellTypesFile,
                                      options.passivePropsFile,
-                                     options.populationPropsFile)
+                                     options.populationPropsFile,
+                                useResultCache=not options.noResultCache)
   displayAnalysis(analysis, plotSingles=options.plotSingles,
                   plotLists=options.plotLists,
                   savePlotsDir=options.savePlotsDir)
@@ -3,30 +3,80 @@
 
 
 import os, sys, re, math
+import hashlib
+import numpy
 from NeuronGeometry import *
 
 
 
 class HocGeometry(Geometry):
-  def __init__(self, _fileName=None):
+  def __init__(self, _fileName=None, useCache=False, cacheDir=None):
+    """
+    if _fileName is specified, read the geometry from it
+    if useCache is True, load the fully processed geometry (connectivity,
+      soma/axon tags, branches, branch and centripetal orders) from the
+      geometry cache, reading, processing, and caching it if it isn't there.
+      The cache is keyed by the file contents and the library version, so a
+      changed file is never loaded from a stale cache.
+    cacheDir sets the cache directory (default: getGeometryCacheDir())
+    """
     Geometry.__init__(self)
     self._openFilament = None
     self._connections = []
     self._filamentNames = []
+    self._filamentIndex = {}
     self._filaments = {}
     self._filamentNameType = None
     self._warnRepeatFilaments = True
     
     if _fileName is not None:
       self.setFileName(_fileName)
-      self.readGeometry()
+      if useCache:
+        self.readCachedGeometry(cacheDir)
+      else:
+        self.readGeometry()
+  
+  
+  def readCachedGeometry(self, cacheDir=None):
+    """
+    Load the processed geometry from the geometry cache. If it isn't cached,
+    read the geometry, process it, and write it to the cache.
+    """
+    cacheFile, key = getGeometryCacheFile(self.fileName, cacheDir)
+    if self.readCache(cacheFile, key):
+      return
+    
+    self.readGeometry()
+    # do all the processing that doesn't depend on model parameters
+    self.checkConnectivity(removeDisconnected=True)
+    self.findBranches()
+    self.findAxons()
+    self.calcBranchOrder(doPlot=False)
+    
+    try:
+      self.writeCache(cacheFile, key)
+    except (IOError, OSError) as err:
+      warn('Could not write geometry cache %s' % cacheFile, str(err))
       
   
-  def readGeometry(self):
+  def readGeometry(self, fast=True):
     """
     get dictionary object describing neuron model geometry info by reading file
+    if fast is True, tokenize the whole file at once and convert pt3dadd
+      coordinates in bulk. Files with unusual syntax fall back to reading
+      line-by-line (which produces the same geometry, or a detailed error)
     """
-     
+    if fast:
+      with open(self.fileName, 'r') as fIn:
+        lines = fIn.read().splitlines()
+      events = self._tokenizeHocGeometry(lines)
+      if events is not None:
+        self._buildFromEvents(events)
+        # connect filaments and remove filaments and connections, leaving
+        # segments and nodes
+        self._connectFilaments()
+        return
+    
     lineNum = 0
     with open(self.fileName, 'r') as fIn:
       # read the geometry file
@@ -194,6 +244,129 @@ class HocGeometry(Geometry):
     return filamentInds, positions
 
 
+  def _tokenizeHocGeometry(self, lines):
+    """
+    Tokenize all the lines of a .hoc geometry file without altering the
+    geometry, and return a list of events to build it from:
+      (command, args)
+    pt3dadd coordinates of the whole file are converted in one NumPy call,
+    and consecutive pt3dadd lines in a filament are grouped into one
+    'points' event with args (name, points array).
+    Return None if anything unusual is encountered (e.g. errors) so that the
+    line-by-line parser can handle it.
+    """
+    events = []
+    filamentNames = set()
+    openFilament = None
+    # each pt3dadd line's arguments, and the events that own them
+    pointArgs = []
+    pointEvents = []
+    for line in lines:
+      if openFilament is not None:
+        stripped = line.strip()
+        if not stripped:
+          continue
+        elif stripped.startswith('pt3dadd('):
+          if stripped.count('(') != 1 or not stripped.endswith(')') or \
+              stripped.count(')') != 1:
+            return None
+          args = stripped[8:-1]
+          numArgs = args.count(',') + 1
+          if numArgs == 5:
+            args, lastArg = args.rsplit(',', 1)
+            if lastArg != '0':
+              return None
+          elif numArgs != 4:
+            return None
+          if events[-1][0] != 'points':
+            events.append(['points', [openFilament, 0]])
+            pointEvents.append(events[-1])
+          events[-1][1][1] += 1
+          pointArgs.append(args)
+        elif stripped == '}':
+          events.append(('close', None))
+          openFilament = None
+        elif stripped == 'pt3dclear()':
+          events.append(('clear', openFilament))
+        else:
+          return None
+        continue
+      
+      splitLine = line.split(None)
+      if not splitLine:
+        continue
+      command = splitLine[0]
+      if command == 'connect':
+        events.append(('connect', splitLine))
+      elif command == 'create':
+        events.append(('create', splitLine))
+        try:
+          names, nameType = _createdFilamentNames(splitLine)
+        except (ValueError, IndexError):
+          return None
+        filamentNames.update(names)
+      elif command == 'neuron_name':
+        events.append(('neuron_name', splitLine))
+      elif command.lower() == 'range':
+        events.append(('range', splitLine))
+      elif command in filamentNames:
+        openFilament = command
+        events.append(('open', openFilament))
+      elif command + '[0]' in filamentNames:
+        openFilament = command + '[0]'
+        events.append(('open', openFilament))
+    
+    if openFilament is not None:
+      # let line-by-line parser raise the appropriate error
+      return None
+    
+    # convert all the coordinates at once
+    try:
+      points = numpy.array(','.join(pointArgs).split(','),
+                           dtype=float).reshape(-1, 4)
+    except ValueError:
+      return None
+    start = 0
+    for event in pointEvents:
+      name, numPoints = event[1]
+      event[1] = (name, points[start:start + numPoints])
+      start += numPoints
+    
+    return events
+  
+  
+  def _buildFromEvents(self, events):
+    """
+    Build the geometry from events produced by _tokenizeHocGeometry
+    """
+    for command, args in events:
+      if command == 'points':
+        name, points = args
+        if (points[:, 3] <= 0).any():
+          d = points[:, 3][points[:, 3] <= 0][0]
+          if d == 0:
+            raise ValueError('pt3dadd with diameter = 0.0')
+          else:
+            raise ValueError('pt3dadd with diameter < 0.0')
+        openSegment = self._filaments[self._filamentIndex[name]]
+        self._addNodes(openSegment, points[:, 0], points[:, 1],
+                       points[:, 2], 0.5 * points[:, 3])
+      elif command == 'open':
+        self._openFilament = args
+      elif command == 'close':
+        self._openFilament = None
+      elif command == 'clear':
+        self._filaments[self._filamentIndex[args]].clear()
+      elif command == 'connect':
+        self._addConnection(args)
+      elif command == 'create':
+        self._createFilaments(args)
+      elif command == 'neuron_name':
+        self.name = args[-1]
+      elif command == 'range':
+        self._setRange(args)
+  
+  
   def _parseHocGeometryLine(self, line):
     """
     Read a line from hoc file specifying geometry, and update geometryInfo
@@ -213,16 +386,23 @@ class HocGeometry(Geometry):
     elif splitLine[0] == 'neuron_name':
       self.name = splitLine[-1]
     elif splitLine[0].lower() == "range":
-      if len(splitLine) < 7:
-        raise IOError(\
-          'range should be of form "range minX maxX minY maxY minZ maxZ"')
-      self.minRange = tuple([float(x) for x in splitLine[1:6:2]])
-      self.maxRange = tuple([float(x) for x in splitLine[2:7:2]])
-    elif splitLine[0] in self._filamentNames:
+      self._setRange(splitLine)
+    elif splitLine[0] in self._filamentIndex:
       self._openFilament = splitLine[0]
-    elif splitLine[0]+'[0]' in self._filamentNames:
+    elif splitLine[0]+'[0]' in self._filamentIndex:
       self._openFilament = splitLine[0]+'[0]'
   
+  def _setRange(self, splitLine):
+    """
+    Set the geometry range from a line of form
+      range minX maxX minY maxY minZ maxZ
+    """
+    if len(splitLine) < 7:
+      raise IOError(\
+        'range should be of form "range minX maxX minY maxY minZ maxZ"')
+    self.minRange = tuple([float(x) for x in splitLine[1:6:2]])
+    self.maxRange = tuple([float(x) for x in splitLine[2:7:2]])
+  
   def _parseDefineFilament(self, line):
     """
     Parse a line in a filament declaration block. Add node, clear nodes, or
@@ -232,7 +412,7 @@ class HocGeometry(Geometry):
     """
     splitLine = re.split(',|\)|\(', line.strip())
     
-    openSegment = self.segments[self._filamentNames.index(self._openFilament)]
+    openSegment = self._filaments[self._filamentIndex[self._openFilament]]
       
     if splitLine[0] == '}':
       self._openFilament = None
@@ -279,37 +459,19 @@ class HocGeometry(Geometry):
     """
     Add requested number of filaments to geometry, as segments
     """
-    if '[' and ']' in splitLine[1]:
-      # hoc produced by Imaris, requests variable number of filaments
-      # create baseName[numFilaments]
-      baseName, numFilamentsStr = re.split('\[|\]', splitLine[1])[0:2]
-      numFilaments = int(numFilamentsStr)
-      if self._filamentNameType in [None, 'Imaris']:
-        self._filamentNameType = 'Imaris'
-      else:
-        self._filamentNameType = 'Mixed'
-        warn('Filament index will not reliably match numbers in filament name')
-      thisType = 'Imaris'
+    names, thisType = _createdFilamentNames(splitLine)
+    if self._filamentNameType in [None, thisType]:
+      self._filamentNameType = thisType
     else:
-      # hoc produce by Amira, requests 1 filament
-      # create baseName
-      baseName, numFilaments = splitLine[1], 1
-      if self._filamentNameType in [None, 'Amira']:
-        self._filamentNameType = 'Amira'
-      else:
-        self._filamentNameType = 'Mixed'
-        warn('Filament index will not reliably match numbers in filament name')
-      thisType = 'Amira'
+      self._filamentNameType = 'Mixed'
+      warn('Filament index will not reliably match numbers in filament name')
     
-    for n in range(numFilaments):
-      if thisType == 'Imaris':
-        name = '%s[%d]' % (baseName, n)
-      else:
-        name = baseName
-      if name in self._filamentNames:
+    for name in names:
+      if name in self._filamentIndex:
         raise IOError('%s already created' % name)
       newSeg = self._addSegment(name)
       newSeg.filamentIndex = len(self._filamentNames)
+      self._filamentIndex[name] = newSeg.filamentIndex
       self._filamentNames.append(name)
       self._filaments[newSeg.filamentIndex] = newSeg
 
@@ -321,7 +483,7 @@ class HocGeometry(Geometry):
       their ends. Note that this removes a node for each connection
     """
     def _getSegmentFromFilament(_filament):
-      _segment = self._filaments[self._filamentNames.index(_filament)]
+      _segment = self._filaments[self._filamentIndex[_filament]]
       return _segment      
     
     #while self._connections:
@@ -360,13 +522,74 @@ class HocGeometry(Geometry):
       
 
 ###############################################################################
-def demoRead(geoFile, passiveFile="", display=True, makePlots=False):
+def getLibraryVersion():
+  """
+  Return the library version string from VERSION.txt
+  """
+  versionFile = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'VERSION.txt')
+  with open(versionFile, 'r') as fIn:
+    return fIn.readline().split()[-1]
+
+
+def getGeometryCacheDir():
+  """
+  Return the default geometry cache directory, creating it if necessary
+  """
+  cacheDir = os.path.join(os.path.expanduser('~'), '.cache',
+                          'neuron_geometry')
+  if not os.path.isdir(cacheDir):
+    os.makedirs(cacheDir)
+  return cacheDir
+
+
+def getGeometryCacheFile(geoFile, cacheDir=None):
+  """
+  Return (cacheFile, key) for the processed geometry from geoFile.
+  key is a hash of the contents of geoFile and the library version, so the
+  cache is automatically invalidated when either one changes.
+  """
+  if cacheDir is None:
+    cacheDir = getGeometryCacheDir()
+  keyHash = hashlib.sha1()
+  with open(geoFile, 'rb') as fIn:
+    for block in iter(lambda: fIn.read(1 << 20), b''):
+      keyHash.update(block)
+  keyHash.update(getLibraryVersion().encode('ascii'))
+  key = keyHash.hexdigest()
+  name = os.path.basename(geoFile).split('.')[0]
+  cacheFile = os.path.join(cacheDir, '%s_%s.geo' % (name, key))
+  return cacheFile, key
+
+
+###############################################################################
+def _createdFilamentNames(splitLine):
+  """
+  Return list of filament names requested by a .hoc create statement, and the
+  type of program that produced the .hoc file ('Imaris' or 'Amira')
+  """
+  if '[' and ']' in splitLine[1]:
+    # hoc produced by Imaris, requests variable number of filaments
+    # create baseName[numFilaments]
+    baseName, numFilamentsStr = re.split('\[|\]', splitLine[1])[0:2]
+    numFilaments = int(numFilamentsStr)
+    return ['%s[%d]' % (baseName, n) for n in range(numFilaments)], 'Imaris'
+  else:
+    # hoc produce by Amira, requests 1 filament
+    # create baseName
+    return [splitLine[1]], 'Amira'
+  
+
+###############################################################################
+def demoRead(geoFile, passiveFile="", display=True, makePlots=False,
+             modal=False, resultCache=None):
   ### Read in geometry file and pre-compute various quantities
   # create geometry object
   geometry = HocGeometry(geoFile)
   # return the properties
   return geometry.getProperties(passiveFile, display=display,
-                                makePlots=makePlots)
+                                makePlots=makePlots, modal=modal,
+                                resultCache=resultCache)
   
 
 ###############################################################################
@@ -382,6 +605,9 @@ def _parseArguments():
                       help="specify passive properties", type=str)
   parser.add_argument("--plots", action='store_true',
                       help="visualize some neuron data")
+  parser.add_argument("--modal", action='store_true',
+                      help="compute membrane time constant from passive "
+                           + "model modes instead of fitting simulation")
   return parser.parse_args()
   
 
@@ -390,7 +616,8 @@ if __name__ == "__main__":
   # get the geometry file
   options = _parseArguments()
   # run a demo of capabilities
-  demoRead(options.geoFile, options.passive, makePlots=options.plots)
+  demoRead(options.geoFile, options.passive, makePlots=options.plots,
+           modal=options.modal)
   # display any plots
   if options.plots:
     pyplot.show()
@@ -11,13 +11,18 @@ _usageStr=\
 
 
 import sys, os, shutil, tempfile, time, math, neuron_createModelHocFile
+import numpy
 
 
 
 class SimHocData:
   def __init__(self, modelFile, dataFile, traceFile, \
                sectionList, modelName, prefix, tol=None, integralStep=None, \
-               useCVOde=True):
+               useCVOde=True, binaryIO=False):
+    # if binaryIO is True, the generated hoc file reads the stimulus from a
+    # prepared binary file with Vector.fread, and writes a binary trace file
+    # with Vector.fwrite, instead of parsing/printing one value at a time
+    self.binaryIO = binaryIO
     self.setFileNames(modelFile, dataFile, traceFile, prefix)
     self.getTimeInfo()
     self.sectionList = sectionList
@@ -47,6 +52,8 @@ class SimHocData:
     splitData = os.path.split(dataFile)
     self.simDataFile = os.path.join(splitModel[0], \
                                     prefix[0:3] + splitData[1])
+    self.stimFile = os.path.join(splitModel[0], prefix[0:3] + 'Stim' + \
+                                 os.path.splitext(splitData[1])[0] + '.bin')
 
   def getTimeInfo(self):
     with open(os.path.expanduser(self.dataFile), 'r') as h:
@@ -122,62 +129,19 @@ class SimHocData:
       f.write('outFile = "%s"\n' % self.simDataFile)
       if validate:
         f.write('traceFile = "%s"\n' % self.traceFile)
+      if self.binaryIO:
+        f.write('strdef stimFile\n')
+        f.write('stimFile = "%s"\n' % self.stimFile)
 
       f.write('\n// Load model hoc file:\n')
       f.write('load_file(modelFile)\n')
       f.write('objectvar modelCell\n')
       f.write('modelCell = new %s()\n' % self.modelName)
 
-      f.write('\n// Get time/current trace of perturbing current injection:\n')
-      #f.write('objref fileIn, tVec, iVec, vVec\n')
-      f.write('objref fileIn, tVec, iVec\n')
-      f.write('fileIn = new File()\n')
-      f.write('fileIn.ropen(dataFile)\n')
-  
-      f.write('\nnumT = fileIn.scanvar()\n')
-      f.write('startInd = modelCell.startInd\n')
-      f.write('tVec = new Vector(numT - startInd)\n')
-      f.write('iVec = new Vector(numT - startInd)\n')
-      # don't keep voltage stored, explicitely throw it away
-      #f.write('vVec = new Vector(numT - startInd)\n')
-      f.write('for(i = 0; i <= startInd; i = i + 1){\n')
-      f.write('  tVec.x[0] = fileIn.scanvar()\n')
-      f.write('  iVec.x[0] = fileIn.scanvar()\n')
-      # f.write('  vVec.x[0] = fileIn.scanvar()\n')
-      f.write("  // don't record voltage, read and throw away\n")
-      f.write('  dummyV    = fileIn.scanvar()\n')
-      f.write('}\n')
-      f.write('tStart = tVec.x[0]\n')
-      f.write('tVec.x[0] = 0\n')
-      f.write('printf("startInd = %d\\n", startInd)\n')
-      f.write('printf("tStart = %d\\n", tStart)\n')
-      f.write('for(i = startInd + 1; i < numT; i = i + 1){\n')
-      f.write('  tVec.x[i - startInd] = fileIn.scanvar() - tStart\n')
-      f.write('  iVec.x[i - startInd] = fileIn.scanvar()\n')
-      #f.write('  vVec.x[i - startInd] = fileIn.scanvar()\n')
-      f.write("  // don't record voltage, read and throw away\n")
-      f.write('  dummyV    = fileIn.scanvar()\n')
-      f.write('}\n')  
-      f.write('fileIn.close()\n')
-      f.write('numT = numT - startInd\n')
-      f.write('printf("numT = %d\\n", numT)\n')  
-
-      if validate:
-        f.write('\n// Get error current data:\n')
-        f.write('objref errVec\n')
-        f.write('fileIn.ropen(traceFile)\n')
-  
-        f.write('\nnumErr = fileIn.scanvar()\n')
-        f.write('errVec = new Vector(numErr - startInd)\n')
-        f.write('for(i = 0; i < startInd; i = i + 1){\n')
-        f.write('  errVec.x[0] = fileIn.scanvar()\n')
-        f.write('}\n')
-        f.write('for(i = startInd; i < numErr; i = i + 1){\n')
-        f.write('  errVec.x[i - startInd] = -fileIn.scanvar()\n')
-        f.write('}\n')
-        f.write('fileIn.close()\n')
-        f.write('numErr = numErr - startInd\n')
-        f.write('printf("numErr = %d\\n", numErr)\n')        
+      if self.binaryIO:
+        self._writeBinaryInput(f, validate)
+      else:
+        self._writeTextInput(f, validate)
 
       f.write('\n// Attach the stimulus current injector object:\n')
       f.write('objref iInjector\n')
@@ -239,30 +203,220 @@ class SimHocData:
       f.write('printf("numTSim = %d\\n", numTSim)\n')
 
       f.write('\n//Output the results:\n')
-      f.write('wopen(outFile)\n')
-      f.write(r'fprint("# number of simulated traces\n")')
-      f.write('\n')
-      f.write(r'fprint("' + str(len(traceNames)) + r'\n")')
+      if self.binaryIO:
+        self._writeBinaryOutput(f, traceNames, traceUnits, neuronTraceNames)
+      else:
+        self._writeTextOutput(f, traceNames, traceUnits, neuronTraceNames)
+
+
+
+  def _writeTextInput(self, f, validate):
+    """
+    write hoc that reads the stimulus (and error current) from the text
+    data files, one value at a time
+    """
+    f.write('\n// Get time/current trace of perturbing current injection:\n')
+    #f.write('objref fileIn, tVec, iVec, vVec\n')
+    f.write('objref fileIn, tVec, iVec\n')
+    f.write('fileIn = new File()\n')
+    f.write('fileIn.ropen(dataFile)\n')
+  
+    f.write('\nnumT = fileIn.scanvar()\n')
+    f.write('startInd = modelCell.startInd\n')
+    f.write('tVec = new Vector(numT - startInd)\n')
+    f.write('iVec = new Vector(numT - startInd)\n')
+    # don't keep voltage stored, explicitely throw it away
+    #f.write('vVec = new Vector(numT - startInd)\n')
+    f.write('for(i = 0; i <= startInd; i = i + 1){\n')
+    f.write('  tVec.x[0] = fileIn.scanvar()\n')
+    f.write('  iVec.x[0] = fileIn.scanvar()\n')
+    # f.write('  vVec.x[0] = fileIn.scanvar()\n')
+    f.write("  // don't record voltage, read and throw away\n")
+    f.write('  dummyV    = fileIn.scanvar()\n')
+    f.write('}\n')
+    f.write('tStart = tVec.x[0]\n')
+    f.write('tVec.x[0] = 0\n')
+    f.write('printf("startInd = %d\\n", startInd)\n')
+    f.write('printf("tStart = %d\\n", tStart)\n')
+    f.write('for(i = startInd + 1; i < numT; i = i + 1){\n')
+    f.write('  tVec.x[i - startInd] = fileIn.scanvar() - tStart\n')
+    f.write('  iVec.x[i - startInd] = fileIn.scanvar()\n')
+    #f.write('  vVec.x[i - startInd] = fileIn.scanvar()\n')
+    f.write("  // don't record voltage, read and throw away\n")
+    f.write('  dummyV    = fileIn.scanvar()\n')
+    f.write('}\n')  
+    f.write('fileIn.close()\n')
+    f.write('numT = numT - startInd\n')
+    f.write('printf("numT = %d\\n", numT)\n')  
+
+    if validate:
+      f.write('\n// Get error current data:\n')
+      f.write('objref errVec\n')
+      f.write('fileIn.ropen(traceFile)\n')
+  
+      f.write('\nnumErr = fileIn.scanvar()\n')
+      f.write('errVec = new Vector(numErr - startInd)\n')
+      f.write('for(i = 0; i < startInd; i = i + 1){\n')
+      f.write('  errVec.x[0] = fileIn.scanvar()\n')
+      f.write('}\n')
+      f.write('for(i = startInd; i < numErr; i = i + 1){\n')
+      f.write('  errVec.x[i - startInd] = -fileIn.scanvar()\n')
+      f.write('}\n')
+      f.write('fileIn.close()\n')
+      f.write('numErr = numErr - startInd\n')
+      f.write('printf("numErr = %d\\n", numErr)\n')        
+
+
+
+  def _writeTextOutput(self, f, traceNames, traceUnits, neuronTraceNames):
+    """
+    write hoc that prints the recorded traces to a text trace file
+    """
+    _dT = str(self.integralStep)
+    f.write('wopen(outFile)\n')
+    f.write(r'fprint("# number of simulated traces\n")')
+    f.write('\n')
+    f.write(r'fprint("' + str(len(traceNames)) + r'\n")')
+    f.write('\n')
+    f.write(r'fprint("# name units numT deltaT\n")')
+    f.write('\n')
+    for n in range(len(traceNames)):
+      name = traceNames[n]
+      unit = traceUnits[n]
+      f.write(r'fprint("' + name + r' ' + unit + r' %d ' + _dT + \
+              r'\n", numTSim)')
       f.write('\n')
-      f.write(r'fprint("# name units numT deltaT\n")')
+    for n in range(len(traceNames)):
+      neuronName = neuronTraceNames[n]
+      name = traceNames[n]
+      unit = traceUnits[n]
+      f.write(r'fprint("#' + name + r'\n")')
       f.write('\n')
-      for n in range(len(traceNames)):
-        name = traceNames[n]
-        unit = traceUnits[n]
-        f.write(r'fprint("' + name + r' ' + unit + r' %d ' + _dT + \
-                r'\n", numTSim)')
-        f.write('\n')
-      for n in range(len(traceNames)):
-        neuronName = neuronTraceNames[n]
-        name = traceNames[n]
-        unit = traceUnits[n]
-        f.write(r'fprint("#' + name + r'\n")')
-        f.write('\n')
-        f.write('for(i = 0; i < numTSim; i = i + 1){\n')
-        f.write(r'  fprint("%.19f\n", ' + neuronName + r'.x[i])')
-        f.write('\n}\n')
+      f.write('for(i = 0; i < numTSim; i = i + 1){\n')
+      f.write(r'  fprint("%.19f\n", ' + neuronName + r'.x[i])')
+      f.write('\n}\n')
         
-      f.write('wopen()\n')
+    f.write('wopen()\n')
+
+
+
+  def _writeBinaryInput(self, f, validate):
+    """
+    write the stimulus (and error current) to binary stimFile, and write hoc
+    that reads them with Vector.fread
+    """
+    if validate:
+      offsets = writeBinaryStimulus(self.dataFile, self.stimFile, self.dt,
+                                    self.traceFile)
+    else:
+      offsets = writeBinaryStimulus(self.dataFile, self.stimFile, self.dt)
+    
+    f.write('\n// Get time/current trace of perturbing current injection:\n')
+    f.write('objref fileIn, tVec, iVec\n')
+    f.write('fileIn = new File()\n')
+    f.write('fileIn.ropen(stimFile)\n')
+    f.write('startInd = modelCell.startInd\n')
+    f.write('tVec = new Vector()\n')
+    f.write('iVec = new Vector()\n')
+    f.write('fileIn.seek(%d)\n' % offsets['t'][0])
+    f.write('tVec.fread(fileIn, %d)\n' % offsets['t'][1])
+    f.write('fileIn.seek(%d)\n' % offsets['i'][0])
+    f.write('iVec.fread(fileIn, %d)\n' % offsets['i'][1])
+    f.write('fileIn.close()\n')
+    f.write('numT = tVec.size()\n')
+    f.write('if(startInd > 0){\n')
+    f.write('  tVec.remove(0, startInd - 1)\n')
+    f.write('  iVec.remove(0, startInd - 1)\n')
+    f.write('}\n')
+    f.write('tStart = tVec.x[0]\n')
+    f.write('tVec.sub(tStart)\n')
+    f.write('printf("startInd = %d\\n", startInd)\n')
+    f.write('printf("tStart = %d\\n", tStart)\n')
+    f.write('numT = numT - startInd\n')
+    f.write('printf("numT = %d\\n", numT)\n')
+    
+    if validate:
+      f.write('\n// Get error current data:\n')
+      f.write('objref errVec\n')
+      f.write('errVec = new Vector()\n')
+      f.write('fileIn.ropen(stimFile)\n')
+      f.write('fileIn.seek(%d)\n' % offsets['err'][0])
+      f.write('errVec.fread(fileIn, %d)\n' % offsets['err'][1])
+      f.write('fileIn.close()\n')
+      f.write('numErr = errVec.size()\n')
+      f.write('if(startInd > 0){\n')
+      f.write('  errVec.remove(0, startInd - 1)\n')
+      f.write('}\n')
+      f.write('errVec.mul(-1)\n')
+      f.write('numErr = numErr - startInd\n')
+      f.write('printf("numErr = %d\\n", numErr)\n')
+
+
+
+  def _writeBinaryOutput(self, f, traceNames, traceUnits, neuronTraceNames):
+    """
+    write hoc that saves the recorded traces to a binary trace file (see
+    neuron_plot_trace.binaryTraceHeader), writing each with Vector.fwrite
+    """
+    from neuron_plot_trace import binaryTraceHeader
+    header = binaryTraceHeader(traceNames, traceUnits,
+                               [None] * len(traceNames),
+                               [str(self.integralStep)] * len(traceNames))
+    f.write('objref fileOut\n')
+    f.write('fileOut = new File()\n')
+    f.write('fileOut.wopen(outFile)\n')
+    # the header's numT placeholders are filled in with numTSim
+    for line in header.splitlines():
+      if '%' in line:
+        f.write('fileOut.printf("%s\\n", numTSim)\n' % line)
+      else:
+        f.write('fileOut.printf("%s\\n")\n' % line)
+    for neuronName in neuronTraceNames[:len(traceNames)]:
+      f.write('%s.fwrite(fileOut, 0, numTSim - 1)\n' % neuronName)
+    f.write('fileOut.close()\n')
+
+
+###############################################################################
+def writeBinaryStimulus(dataFile, stimFile, dT, traceFile=None):
+  """
+  Convert the time and current columns of text dataFile (and the error
+  current in traceFile, if specified) to binary trace file stimFile, so that
+  hoc can read them in bulk with Vector.fread. stimFile can be loaded with
+  neuron_plot_trace.loadTraces()
+  Return dict of trace name -> (byte offset, numT) in stimFile
+  """
+  from neuron_plot_trace import saveBinaryTraces
+  # columns are t, i, v
+  data = _readDataValues(dataFile, 3)
+  traces = [{'name' : 't', 'units' : 'ms', 'dT' : dT, 'data' : data[:, 0]},
+            {'name' : 'i', 'units' : 'nA', 'dT' : dT, 'data' : data[:, 1]}]
+  if traceFile:
+    traces.append({'name' : 'err', 'units' : 'nA', 'dT' : dT,
+                   'data' : _readDataValues(traceFile, 1)[:, 0]})
+  
+  offset = saveBinaryTraces(traces, stimFile)
+  offsets = {}
+  for trace in traces:
+    numT = len(trace['data'])
+    offsets[trace['name']] = (offset, numT)
+    offset += 8 * numT
+  return offsets
+
+
+
+###############################################################################
+def _readDataValues(dataFile, numColumns):
+  """
+  read a text data file: the number of rows on the first line, followed by
+  rows of numColumns values. Return numpy array of shape (numT, numColumns)
+  """
+  with open(os.path.expanduser(dataFile), 'r') as fIn:
+    numT = int(next(fIn))
+    values = numpy.fromstring(fIn.read(), sep=' ')
+  if len(values) < numT * numColumns:
+    raise IOError('Error reading %s: expected %d values, found %d'
+                  % (dataFile, numT * numColumns, len(values)))
+  return values[:numT * numColumns].reshape(numT, numColumns)
 
 
 
@@ -489,14 +643,15 @@ def elapsedTime(deltaT):
 
 ###############################################################################
 def simulateNeuron(startupFile, sectionList, modelName, \
-                   tol=None, integralStep=None, useCVOde=True):
+                   tol=None, integralStep=None, useCVOde=True, binaryIO=False):
   fileNames = neuron_createModelHocFile.getFileNames(startupFile)
   hocFile = fileNames['hocFile']
   dataFile = fileNames['dataFile']
   traceFile = "" #don't use traceFile
   simHocData = SimHocData(hocFile, dataFile, traceFile, sectionList, \
                           modelName, 'Simulate', tol=tol, \
-                          integralStep=integralStep, useCVOde=useCVOde)
+                          integralStep=integralStep, useCVOde=useCVOde, \
+                          binaryIO=binaryIO)
 
   print('Simulating hoc file: %s' % os.path.relpath(simHocData.simHocFile))
   simHocData.writeSimHocFile()
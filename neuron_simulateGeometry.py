@@ -7,10 +7,18 @@ NeuronGeometry
 from NeuronGeometry import *
 from neuron_readExportedGeometry import HocGeometry
 import scipy
+import numpy
+from math import pi
 import peelLength
 from matplotlib import pyplot
 import sys
+import os
 import json
+import hashlib
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
 
 
 ###############################################################################
@@ -89,6 +97,23 @@ def getPassiveProperties(passiveFile=None, parameters=None):
   return properties
 
 
+###############################################################################
+def prepareGeometry(geometry):
+  """
+  Prepare geometry for simulation, in place: remove all but its largest
+  connected piece, check it for loops, and find branch orders (which model
+  properties may target). Every simulation backend works on the prepared
+  geometry, and prepares it first if necessary, so simulating changes the
+  caller's geometry. Call this before makeModel() to make the change
+  explicit, and so that the model refers to the segments that are simulated.
+  Return geometry
+  """
+  geometry.checkConnectivity(removeDisconnected=True, removeLoops=True)
+  if geometry.soma.branchOrder is None:
+    geometry.calcBranchOrder(doPlot=False)
+  return geometry
+
+
 ###############################################################################
 def makeModel(geometry, properties):
   # given geometry and passive properties, make an object holding model info
@@ -135,10 +160,67 @@ def makeModel(geometry, properties):
     
 
 ###############################################################################
-def _simulateModel(geometry, model, child_conn=None):
+def _captureOutput():
+  """
+  Redirect python and low-level (e.g. NEURON) stdout and stderr, so that
+  output can be collected by _releaseOutput()
+  """
+  import tempfile
+  if sys.version_info[0] == 3:
+    from io import StringIO
+  else:
+    from cStringIO import StringIO
+  
+  textOutput = StringIO()
+  stdout = sys.stdout ; stderr = sys.stderr
+  sys.stdout = textOutput ; sys.stderr = textOutput
+  
+  tempStdFile = tempfile.NamedTemporaryFile(delete=False).name
+  tempStdOut = os.open(tempStdFile, os.O_WRONLY)
+  stdout.flush()
+  stderr.flush()
+  temp1 = os.dup(1)
+  temp2 = os.dup(2)
+  os.dup2(tempStdOut, 1)
+  os.dup2(tempStdOut, 2)
+  os.close(tempStdOut)
+  return textOutput, stdout, stderr, tempStdFile, temp1, temp2
+
+
+def _releaseOutput(outputState):
+  """
+  Restore stdout and stderr redirected by _captureOutput(), and return the
+  text that was output in the meantime
+  """
+  textOutput, stdout, stderr, tempStdOutFile, temp1, temp2 = outputState
+  if temp1 is not None:
+    os.dup2(temp1, 1)
+    os.close(temp1)
+  if temp2 is not None:
+    os.dup2(temp2, 2)
+    os.close(temp2)
+
+  textOutput = textOutput.getvalue()
+  # Get the output of stderr, stdout and clean up temporary files
+  if tempStdOutFile:
+    with open(tempStdOutFile, 'r') as fOut:
+      textOutput += fOut.read()
+    os.remove(tempStdOutFile)
+  sys.stdout = stdout ; sys.stderr = stderr
+  return textOutput
+
+
+###############################################################################
+def _simulateModel(geometry, model, child_conn=None, sharedTraces=None,
+                   recording=None):
   """
   Do the nuts and bolts of neuron simulation, typically called in a separate
-  Process by simulateModel
+  Process by simulateModel. If sharedTraces (a multiprocessing.RawArray
+  holding a recorded segments x time array) is passed, traces are written
+  into it and only the number of time points is sent back through
+  child_conn. If recording (from _recordingSpec) is passed, geometry must
+  already be prepared by prepareGeometry(), and recording is used as is, so
+  the rows of sharedTraces are those the caller expects.
   """
   ##-------------------------------------------------------------------------##
   def _createSegment(segment, geometry):
@@ -237,91 +319,64 @@ def _simulateModel(geometry, model, child_conn=None):
     iClamp.dur = stimInfo['duration']
     iClamp.delay = stimInfo['delay']
     
-    # record voltage in each segment
-    vTraces = {segment.name : neuron.h.Vector()
-               for segment in geometry.segments}
-    for segment in geometry.segments:
-      trace = vTraces[segment.name]
-      hSeg = segment.hSeg
-      hPos = 0.5 # for now, just record in the middle of all segments
-      trace.record(hSeg(hPos)._ref_v, model['dT'])
-    
-    return iClamp, vTraces
+    # record voltage as requested by model['recording']
+    traceVectors, probes = _startRecording(hSegs, recording)
+    return iClamp, traceVectors, probes
   ##-------------------------------------------------------------------------##
   def _runSimulation(model):
     neuron.h.dt = model['dT']
     neuron.h.finitialize(model['v0'])
     neuron.h.fcurrent()
-    tFinal = model['tFinal']
-    while neuron.h.t < tFinal:
-      neuron.h.fadvance()
+    _integrate(model['tFinal'], probes)
 
 
-  # redirect stdout and stderr
-  import os
-  import tempfile
-  if sys.version_info[0] == 3:
-    from io import StringIO
-  else:
-    from cStringIO import StringIO
   import traceback
   
-  def _redirect_stdout():
-    tempStdFile = tempfile.NamedTemporaryFile(delete=False).name
-    tempStdOut = os.open(tempStdFile, os.O_WRONLY)
-    sys.stdout.flush()
-    sys.stderr.flush()
-    temp1 = os.dup(1)
-    temp2 = os.dup(2)
-    os.dup2(tempStdOut, 1)
-    os.dup2(tempStdOut, 2)
-    os.close(tempStdOut)
-    return tempStdFile, temp1, temp2
-  
-  textOutput = StringIO()
-  stdout = sys.stdout ; stderr = sys.stderr
-  sys.stdout = textOutput ; sys.stderr = textOutput
-  tempStdOutFile, temp1, temp2 = _redirect_stdout()
-  #temp1 = None ; temp2 = None ; tempStdOutFile = ""
+  # redirect stdout and stderr
+  outputState = _captureOutput()
   err = None ; tb = ""
   
   try:
     import neuron
     
-    geometry.checkConnectivity(removeDisconnected=True, removeLoops=True)
+    if recording is None:
+      prepareGeometry(geometry)
+      recording = _recordingSpec(geometry, model)
     firstSeg = geometry.segments[0]
     if hasattr(firstSeg, 'hSeg') and firstSeg.hSeg is not None:
       for segment in geometry.segments:
         segment.hSeg = None
     _addGeometryToHoc(geometry)
     _setProperties(geometry, model)
-    iClamp, vTraces = _initStimulusAndRecording(geometry, model)
+    hSegs = [segment.hSeg for segment in geometry.segments]
+    iClamp, traceVectors, probes = \
+      _initStimulusAndRecording(geometry, model)
     _runSimulation(model)
-    # convert traces to python arrays
-    for segment in geometry.segments:
-      vTraces[segment.name] = scipy.array(vTraces[segment.name])
-    # create time trace
-    numT = len(vTraces[firstSeg.name])
-    timeTrace = scipy.array([n * model['dT'] for n in range(numT)])
+    numT = len(traceVectors[0]) if traceVectors else 0
+    probeValues = probes.values()
+    if sharedTraces is None:
+      # convert traces to python arrays
+      vTraces = {key : scipy.array(vector) for (key, segInd, location),
+                 vector in zip(recording['traces'], traceVectors)}
+      vTraces.update(probeValues)
+      # create time trace
+      timeTrace = recording['dT'] * numpy.arange(numT)
+    else:
+      # copy traces into shared memory, and just report how many times
+      traces = numpy.frombuffer(sharedTraces).reshape(
+        len(recording['traces']), -1)
+      if numT > traces.shape[1]:
+        raise RuntimeError('Too many time points for shared trace array')
+      for row, vector in zip(traces, traceVectors):
+        row[:numT] = _vectorArray(vector)
+      timeTrace = numT ; vTraces = probeValues
           
-  except BaseException as err:
+  except BaseException as error:
+    err = error
     timeTrace = [] ; vTraces = {}
     tb = traceback.format_exc()
 
-  if temp1 is not None:
-    os.dup2(temp1, 1)
-    os.close(temp1)
-  if temp2 is not None:
-    os.dup2(temp2, 2)
-    os.close(temp2)
-
-  textOutput = textOutput.getvalue()
-  # Get the output of stderr, stdout and clean up temporary files
-  if tempStdOutFile:
-    with open(tempStdOutFile, 'r') as fOut:
-      textOutput += fOut.read()
-    os.remove(tempStdOutFile)
-  sys.stdout = stdout ; sys.stderr = stderr
+  textOutput = _releaseOutput(outputState)
 
   # report results
   if child_conn is None:
@@ -334,29 +389,1224 @@ def _simulateModel(geometry, model, child_conn=None):
 
 
 ###############################################################################
-def simulateModel(geometry, model):
-  from multiprocessing import Pipe, Process
+def simulateModel(geometry, model, backend='neuron'):
+  """
+  Simulate model on geometry, return (timeTrace, vTraces, textOutput)
+  vTraces maps segment names to voltage traces. What is recorded can be set
+  by model['recording'], a dict with any of
+    'segments': list of segments to record (default: all), each a Segment,
+                segment name, or (segment or name, location) pair. Traces
+                are keyed by segment name, or 'name(location)' for pairs.
+    'dT':       sampling interval (default: model['dT'])
+    'probes':   dict {probe : list of segments, as for 'segments'} of
+                reductions kept as running values, without storing the
+                trace: probe is 'max', 'min', or 'final' (every backend
+                updates 'max' and 'min' each time step). Each value is
+                keyed in vTraces by (probe, trace key), e.g.
+                vTraces[('max', 'soma')]
+  geometry is first prepared in place by prepareGeometry(), whatever the
+  backend.
+  backend selects the simulator:
+    'neuron': run NEURON in a separate process
+    'hines': integrate the passive cable equations with NumPy, in this
+             process (see simulateModelHines)
+    'pool': run NEURON in a persistent worker process that keeps the cell
+            built between simulations (see SimulationPool)
+  """
+  prepareGeometry(geometry)
+  if backend == 'hines':
+    return simulateModelHines(geometry, model)
+  elif backend == 'pool':
+    return getSimulationPool().simulate(geometry, model)
+  elif backend != 'neuron':
+    raise ValueError('Unknown simulation backend: %s' % backend)
+  
+  from multiprocessing import Pipe, Process, RawArray
   from time import sleep
+  # the child process writes traces into shared memory, so they don't have
+  # to be pickled and sent back. It records with this spec (built from the
+  # prepared geometry) so its rows match the ones read back here
+  recording = _recordingSpec(geometry, model)
+  numTraces = len(recording['traces'])
+  maxT = int(numpy.ceil(model['tFinal'] / recording['dT'])) + 2
+  sharedTraces = RawArray('d', numTraces * maxT) if numTraces else None
   parent_conn, child_conn = Pipe()
-  p = Process(target=_simulateModel, args=(geometry, model, child_conn))
+  p = Process(target=_simulateModel,
+              args=(geometry, model, child_conn, sharedTraces, recording))
   try:
     p.start()
     while not parent_conn.poll():
       sleep(0.1)
-    timeTrace, vTraces, textOutput, err, tb = parent_conn.recv()
+    numT, probeValues, textOutput, err, tb = parent_conn.recv()
     p.join()
   except BaseException:
     if p.is_alive():
       p.terminate()
-    timeTrace = [] ; vTraces = [] ; textOutput = "" ; err = None ; tb = ""
     raise
   
   if err is not None:
     print(tb)
     raise err
+  if sharedTraces is None:
+    # only probes were recorded
+    return numpy.array([]), probeValues, textOutput
+  # view (without copying) the traces in shared memory
+  traces = numpy.frombuffer(sharedTraces).reshape(numTraces, maxT)[:, :numT]
+  vTraces = {key : trace for (key, segInd, location), trace
+             in zip(recording['traces'], traces)}
+  vTraces.update(probeValues)
+  timeTrace = recording['dT'] * numpy.arange(numT)
   return timeTrace, vTraces, textOutput
 
 
+def _recordingSpec(geometry, model):
+  """
+  Return what to record from model['recording'] (see simulateModel), with
+  segments replaced by their indices into geometry.segments:
+    {'dT' : sampling interval,
+     'traces' : [(key, segment index, location), ...],
+     'probes' : [(key, probe, segment index, location), ...]}
+  """
+  recording = model.get('recording', {})
+  segments = geometry.segments
+  indices = {segment : ind for ind, segment in enumerate(segments)}
+  nameIndices = {segment.name : ind for ind, segment in enumerate(segments)}
+  def _locate(entry):
+    # return key, segment index, and location to record entry
+    if isinstance(entry, (tuple, list)):
+      entry, location = entry
+      explicit = True
+    else:
+      location = 0.5 ; explicit = False
+    ind = indices[entry] if isinstance(entry, Segment) \
+          else nameIndices[entry]
+    key = '%s(%g)' % (segments[ind].name, location) if explicit \
+          else segments[ind].name
+    return key, ind, location
+  
+  if recording.get('segments') is None:
+    traces = [(segment.name, ind, 0.5) for ind, segment in enumerate(segments)]
+  else:
+    traces = [_locate(entry) for entry in recording['segments']]
+  probes = []
+  for probe, entries in sorted(recording.get('probes', {}).items()):
+    if probe not in ('max', 'min', 'final'):
+      raise ValueError('Unknown recording probe: %s' % probe)
+    for entry in entries:
+      key, ind, location = _locate(entry)
+      probes.append(((probe, key), probe, ind, location))
+  return {'dT' : recording.get('dT', model['dT']), 'traces' : traces,
+          'probes' : probes}
+
+
+def _startRecording(sections, recording):
+  """
+  Start recording NEURON sections (list indexed like geometry.segments) as
+  specified by recording (from _recordingSpec). Return traceVectors, probes
+  (a _Probes, to be advanced with _integrate)
+  """
+  import neuron
+  traceVectors = []
+  for key, segInd, location in recording['traces']:
+    vector = neuron.h.Vector()
+    vector.record(sections[segInd](location)._ref_v, recording['dT'])
+    traceVectors.append(vector)
+  return traceVectors, _Probes(sections, recording)
+
+
+class _Probes(object):
+  """
+  Probe values (see _recordingSpec) of a NEURON simulation. 'max' and 'min'
+  probes are running extrema, updated after every time step, so no voltage
+  trace is stored for them
+  """
+  def __init__(self, sections, recording):
+    self.keys = [key for key, probe, segInd, location in recording['probes']]
+    self.probes = [probe for key, probe, segInd, location
+                   in recording['probes']]
+    self.segments = [sections[segInd](location)
+                     for key, probe, segInd, location in recording['probes']]
+    # (index, sign) of extrema, with sign chosen so each is a running max
+    self.extrema = [(ind, 1.0 if probe == 'max' else -1.0)
+                    for ind, probe in enumerate(self.probes)
+                    if probe != 'final']
+    self.extremeValues = [None] * len(self.probes)
+  
+  
+  def start(self):
+    # the initial voltage counts toward the extrema
+    for ind, sign in self.extrema:
+      self.extremeValues[ind] = sign * self.segments[ind].v
+  
+  
+  def update(self):
+    extremeValues = self.extremeValues
+    for ind, sign in self.extrema:
+      v = sign * self.segments[ind].v
+      if v > extremeValues[ind]:
+        extremeValues[ind] = v
+  
+  
+  def values(self):
+    """
+    Return dict of probe values after the simulation
+    """
+    values = {key : segment.v
+              for key, segment in zip(self.keys, self.segments)}
+    for ind, sign in self.extrema:
+      values[self.keys[ind]] = sign * self.extremeValues[ind]
+    return values
+
+
+def _integrate(tFinal, probes):
+  """
+  Advance an initialized NEURON simulation to tFinal, updating probes (from
+  _startRecording) every time step
+  """
+  import neuron
+  h = neuron.h
+  probes.start()
+  if probes.extrema:
+    while h.t < tFinal:
+      h.fadvance()
+      probes.update()
+  else:
+    while h.t < tFinal:
+      h.fadvance()
+
+
+def _vectorArray(vector):
+  """
+  Return numpy array with the values of NEURON Vector, without copying if
+  this version of NEURON allows it
+  """
+  if hasattr(vector, 'as_numpy'):
+    return vector.as_numpy()
+  return numpy.array(vector)
+
+
+###############################################################################
+class SimulationPool(object):
+  """
+  Long-lived pool of NEURON worker processes. Each worker imports NEURON once,
+  and builds the sections of a geometry once; subsequent simulations on the
+  same geometry only send segment properties, stimulus, and recording
+  settings. A worker that crashes (or hangs past timeout seconds) is
+  restarted, and its simulation retried once.
+    pool = SimulationPool(numWorkers=4)
+    timeTrace, vTraces, textOutput = pool.simulate(geometry, model)
+    results = pool.simulateMany(geometry, models)
+    pool.close()
+  """
+  def __init__(self, numWorkers=1, timeout=None):
+    self.numWorkers = numWorkers
+    self.timeout = timeout
+    self._workers = [None] * numWorkers
+    # key of the cell built in each worker
+    self._workerCells = [None] * numWorkers
+  
+  
+  def simulate(self, geometry, model):
+    """
+    Simulate model on geometry in a worker, return
+    (timeTrace, vTraces, textOutput) like simulateModel()
+    """
+    return self.simulateMany(geometry, [model])[0]
+  
+  
+  def simulateMany(self, geometry, models):
+    """
+    Simulate each of models on geometry, distributing them over the workers.
+    Return list of (timeTrace, vTraces, textOutput)
+    """
+    from time import sleep
+    key, description = _cellDescription(geometry)
+    tasks = [_simulationTask(geometry, model) for model in models]
+    results = [None] * len(tasks)
+    retried = set()
+    openTasks = list(range(len(tasks)))[::-1]
+    busy = {}   # worker index -> (task index, start time)
+    try:
+      while openTasks or busy:
+        # hand tasks to idle workers
+        for workerInd in range(self.numWorkers):
+          if workerInd in busy or not openTasks:
+            continue
+          taskInd = openTasks.pop()
+          busy[workerInd] = (taskInd, _now())
+          self._send(workerInd, key, description, tasks[taskInd])
+      
+        # collect results from workers that are done (or dead)
+        for workerInd, (taskInd, startTime) in list(busy.items()):
+          worker, conn = self._workers[workerInd]
+          try:
+            if not conn.poll():
+              if worker.is_alive() and (self.timeout is None or
+                                        _now() - startTime < self.timeout):
+                continue
+              raise EOFError('worker did not respond')
+            result = conn.recv()
+          except (EOFError, IOError, OSError) as crash:
+            # crashed or hung: restart the worker, retry the task once
+            self._restart(workerInd)
+            del busy[workerInd]
+            if taskInd in retried:
+              raise RuntimeError('NEURON worker failed twice simulating task'
+                                 ' %d (%s)' % (taskInd,
+                                               str(crash) or 'crashed'))
+            retried.add(taskInd)
+            openTasks.append(taskInd)
+            continue
+          del busy[workerInd]
+          timeTrace, vTraces, textOutput, err, tb = result
+          if err is not None:
+            print(tb)
+            raise err
+          results[taskInd] = (timeTrace, vTraces, textOutput)
+        if busy:
+          sleep(0.001)
+    finally:
+      # after an error (or interrupt), the results of tasks still running
+      # would be read as the answers to later tasks, so restart the workers
+      for workerInd in busy:
+        if self._workers[workerInd] is not None:
+          self._restart(workerInd)
+    return results
+  
+  
+  def close(self):
+    """
+    Stop all the workers
+    """
+    for workerInd, workerInfo in enumerate(self._workers):
+      if workerInfo is None:
+        continue
+      worker, conn = workerInfo
+      try:
+        conn.send(None)
+        conn.close()
+      except (IOError, OSError):
+        pass
+      worker.join(1.0)
+      if worker.is_alive():
+        worker.terminate()
+      self._workers[workerInd] = None
+      self._workerCells[workerInd] = None
+  
+  
+  def __del__(self):
+    self.close()
+  
+  
+  def _send(self, workerInd, key, description, task):
+    # send task to worker, first starting worker / building cell if needed
+    if self._workers[workerInd] is None:
+      self._start(workerInd)
+    worker, conn = self._workers[workerInd]
+    if self._workerCells[workerInd] != key:
+      conn.send(('build', description))
+      self._workerCells[workerInd] = key
+    conn.send(('simulate', task))
+  
+  
+  def _start(self, workerInd):
+    from multiprocessing import Pipe, Process
+    parent_conn, child_conn = Pipe()
+    worker = Process(target=_simulationWorker, args=(child_conn,))
+    worker.daemon = True
+    worker.start()
+    child_conn.close()
+    self._workers[workerInd] = (worker, parent_conn)
+    self._workerCells[workerInd] = None
+  
+  
+  def _restart(self, workerInd):
+    worker, conn = self._workers[workerInd]
+    if worker.is_alive():
+      worker.terminate()
+    worker.join()
+    conn.close()
+    self._start(workerInd)
+
+
+_simulationPool = None
+def getSimulationPool():
+  """
+  Return the persistent SimulationPool for this process, starting it if
+  necessary
+  """
+  global _simulationPool
+  if _simulationPool is None:
+    _simulationPool = SimulationPool()
+  return _simulationPool
+
+
+def _now():
+  from time import time
+  return time()
+
+
+def _cellDescription(geometry):
+  """
+  Return (key, description) where description is the (picklable) information
+  needed to build geometry's sections in NEURON: segment names, 3D points,
+  and connections. key identifies the description, and is kept with the
+  geometry until the geometry changes.
+  """
+  prepareGeometry(geometry)
+  token = geometry._arraysToken()
+  cached = getattr(geometry, '_hocCell', None)
+  if cached is not None and cached[0] == token:
+    return cached[1], cached[2]
+  
+  import uuid
+  segments = geometry.segments
+  segIndex = {segment : ind for ind, segment in enumerate(segments)}
+  points = [[(node.x, node.y, node.z, 2 * node.r1) for node in segment.nodes]
+            for segment in segments]
+  # connect neighbors only once, at the segment with lowest index at the node
+  # (as _simulateModel does)
+  connections = []
+  for index, segment in enumerate(segments):
+    for neighbor, (location, nLocation, node) in zip(
+        segment.neighbors, segment.neighborLocations):
+      if min(segIndex[s] for s in node.segments) == index:
+        connections.append((segIndex[neighbor], index, location, nLocation))
+  description = {'names' : [segment.name for segment in segments],
+                 'points' : points,
+                 'connections' : connections}
+  key = uuid.uuid4().hex
+  geometry._hocCell = (token, key, description)
+  return key, description
+
+
+def _segmentProperties(geometry, model):
+  """
+  Return list of (values, channels) for each segment in geometry
+  """
+  # branch orders can be used to target properties
+  prepareGeometry(geometry)
+  segments = geometry.segments
+  # model['properties'] tags segments; NEURON does that in a separate
+  # process, so restore the tags afterwards to leave geometry unchanged
+  oldTags = [set(segment.tags) for segment in segments]
+  try:
+    return [model['properties'](segment) for segment in segments]
+  finally:
+    for segment, tags in zip(segments, oldTags):
+      segment.tags = tags
+
+
+def _simulationTask(geometry, model):
+  """
+  Return the (picklable) per-simulation information for model: each segment's
+  properties, the stimulus, and recording/integration settings
+  """
+  segments = geometry.segments
+  stimInfo = model['stimulus']
+  return {'properties' : _segmentProperties(geometry, model),
+          'stimulus' : (segments.index(stimInfo['segment']),
+                        stimInfo['location'], stimInfo['amplitude'],
+                        stimInfo['duration'], stimInfo['delay']),
+          'dT' : model['dT'], 'tFinal' : model['tFinal'], 'v0' : model['v0'],
+          'recording' : _recordingSpec(geometry, model)}
+
+
+def _simulationWorker(conn):
+  """
+  Worker process for SimulationPool: build cells and run simulations as
+  requested through conn, until sent None
+  """
+  import traceback
+  cell = None
+  while True:
+    try:
+      request = conn.recv()
+    except EOFError:
+      break
+    if request is None:
+      break
+    command, info = request
+    outputState = _captureOutput()
+    err = None ; tb = ""
+    try:
+      if command == 'build':
+        cell = None
+        cell = _HocCell(info)
+        result = None
+      else:
+        if cell is None:
+          raise RuntimeError('No cell has been built')
+        result = cell.simulate(info)
+    except Exception as error:
+      err = error
+      result = None
+      tb = traceback.format_exc()
+    textOutput = _releaseOutput(outputState)
+    if command == 'build':
+      if err is not None:
+        # report build failures with the next simulation
+        cell = _FailedCell(err, tb, textOutput)
+      continue
+    timeTrace, vTraces = result if result is not None else ([], {})
+    conn.send((timeTrace, vTraces, textOutput, err, tb))
+  conn.close()
+
+
+class _FailedCell(object):
+  # stands in for a cell that could not be built, reporting the failure
+  def __init__(self, err, tb, textOutput):
+    self.err = err
+    self.tb = tb
+    self.textOutput = textOutput
+  
+  def simulate(self, task):
+    print(self.textOutput)
+    raise RuntimeError('Failed to build cell:\n' + self.tb)
+
+
+class _HocCell(object):
+  """
+  NEURON sections built once from a cell description (see _cellDescription),
+  that can be simulated repeatedly with different properties and stimuli
+  """
+  def __init__(self, description):
+    import neuron
+    h = neuron.h
+    self.names = description['names']
+    self.sections = []
+    for name, points in zip(self.names, description['points']):
+      section = h.Section(name=name)
+      for x, y, z, diam in points:
+        h.pt3dadd(x, y, z, diam, sec=section)
+      self.sections.append(section)
+    for child, parent, location, childLocation in description['connections']:
+      self.sections[child].connect(self.sections[parent], location,
+                                   childLocation)
+    self.inserted = [set() for section in self.sections]
+    self.properties = [None] * len(self.sections)
+    self.iClamp = h.IClamp(self.sections[0](0.5))
+    # voltage recordings, set up by run()
+    self.traceVectors = [] ; self.probes = None
+    self.recording = None
+  
+  
+  def setProperties(self, properties):
+    # only set the properties of sections that have changed
+    for ind, (section, inserted, (values, channels)) in enumerate(zip(
+        self.sections, self.inserted, properties)):
+      if self.properties[ind] == (values, channels):
+        continue
+      # copy, so that later in-place changes by the caller are noticed
+      self.properties[ind] = (dict(values),
+                              {channel : dict(chanPropDict)
+                               for channel, chanPropDict in channels.items()})
+      for prop, val in values.items():
+        setattr(section, prop, val)
+      for channel in inserted.difference(channels):
+        section.uninsert(channel)
+        inserted.remove(channel)
+      for channel, chanPropDict in channels.items():
+        if channel not in inserted:
+          section.insert(channel)
+          inserted.add(channel)
+        for prop, val in chanPropDict.items():
+          setattr(section, prop + '_' + channel, val)
+  
+  
+  def setStimulus(self, segInd, location, amplitude, duration, delay):
+    self.iClamp.loc(self.sections[segInd](location))
+    self.iClamp.amp = amplitude
+    self.iClamp.dur = duration
+    self.iClamp.delay = delay
+  
+  
+  def run(self, dT, tFinal, v0, recording=None):
+    """
+    Integrate the model, recording as specified by recording (from
+    _recordingSpec; default: every section, every time step)
+    """
+    import neuron
+    h = neuron.h
+    if recording is None:
+      recording = {'dT' : dT, 'probes' : [],
+                   'traces' : [(name, ind, 0.5)
+                               for ind, name in enumerate(self.names)]}
+    if (dT, recording) != self.recording:
+      # discarding the old Vectors stops their recording
+      self.traceVectors, self.probes = \
+        _startRecording(self.sections, recording)
+      self.recording = (dT, recording)
+    h.dt = dT
+    h.finitialize(v0)
+    h.fcurrent()
+    _integrate(tFinal, self.probes)
+    vTraces = {key : numpy.array(vector) for (key, segInd, location), vector
+               in zip(recording['traces'], self.traceVectors)}
+    vTraces.update(self.probes.values())
+    numT = len(self.traceVectors[0]) if self.traceVectors else 0
+    timeTrace = recording['dT'] * numpy.arange(numT)
+    return timeTrace, vTraces
+  
+  
+  def simulate(self, task):
+    self.setProperties(task['properties'])
+    self.setStimulus(*task['stimulus'])
+    return self.run(task['dT'], task['tFinal'], task['v0'],
+                    task['recording'])
+
+
+###############################################################################
+class ModelHandle(object):
+  """
+  A model whose NEURON cell is built once (in this process), and can then be
+  re-run with new passive properties:
+    handle = ModelHandle(geometry, model)
+    timeTrace, vTraces, textOutput = handle.run()
+    handle.updateParameters(properties)   # e.g. makePassiveProperties(...)
+    timeTrace, vTraces, textOutput = handle.run()
+    print(handle.timingReport())
+  updateParameters() only sets the range variables of sections whose
+  properties changed, and run() only re-initializes and integrates. Every run
+  after the first saves the time it would take to rebuild the cell.
+  """
+  def __init__(self, geometry, model):
+    startTime = _now()
+    self.geometry = geometry
+    self.model = model
+    outputState = _captureOutput()
+    try:
+      key, description = _cellDescription(geometry)
+      self.cell = _HocCell(description)
+      task = _simulationTask(geometry, model)
+      self.cell.setProperties(task['properties'])
+      self.cell.setStimulus(*task['stimulus'])
+      self.recording = task['recording']
+    finally:
+      self.textOutput = _releaseOutput(outputState)
+    # time to build the cell: saved by each re-run
+    self.buildTime = _now() - startTime
+    self.runTimes = []
+    self.timeSaved = 0.0
+  
+  
+  def updateParameters(self, properties):
+    """
+    Set new passive properties (a list of property dicts, as passed to
+    makeModel), leaving geometry, stimulus, and recording unchanged
+    """
+    self.model = dict(self.model)
+    self.model['properties'] = makeModel(self.geometry,
+                                         properties)['properties']
+    self.cell.setProperties(_segmentProperties(self.geometry, self.model))
+  
+  
+  def run(self):
+    """
+    Re-initialize and integrate the model, return
+    (timeTrace, vTraces, textOutput) like simulateModel()
+    """
+    if self.runTimes:
+      self.timeSaved += self.buildTime
+    startTime = _now()
+    outputState = _captureOutput()
+    try:
+      timeTrace, vTraces = self.cell.run(self.model['dT'],
+                                         self.model['tFinal'],
+                                         self.model['v0'], self.recording)
+    finally:
+      textOutput = self.textOutput + _releaseOutput(outputState)
+      self.textOutput = ""
+    self.runTimes.append(_now() - startTime)
+    return timeTrace, vTraces, textOutput
+  
+  
+  def timingReport(self):
+    """
+    Return string describing build time, run times, and time saved by
+    re-using the cell
+    """
+    numRuns = len(self.runTimes)
+    meanRun = sum(self.runTimes) / numRuns if numRuns else 0.0
+    return ('Built cell in %.3f s, %d runs averaging %.3f s, saved %.3f s '
+            '(%.3f s per re-run)' % (self.buildTime, numRuns, meanRun,
+                                     self.timeSaved, self.buildTime))
+
+
+###############################################################################
+class ResultCache(object):
+  """
+  Persistent on-disk store of model responses (e.g. the exponential fit to a
+  simulation), stored as dicts of picklable values in an SQLite database so
+  that concurrent processes can share it. Entries are content-addressed:
+    cacheKey = resultCache.key(geometry, model, properties, backend)
+    values = resultCache.get(cacheKey)  # None if not stored
+    resultCache.update(cacheKey, {'expModel' : expModel, ...})
+  The key depends on the geometry file contents, the passive properties
+  (floats rounded to 6 significant digits), the stimulus and integration
+  settings, and the simulator, so new sweeps reuse any overlapping results.
+  It also depends on the library version and on the source of the modules
+  that simulate and fit models (see _codeHash), so results computed by older
+  simulation or fitting code are never reused, even if VERSION.txt was not
+  updated.
+  """
+  def __init__(self, cacheFile=None):
+    """
+    cacheFile sets the database file (default: results.sqlite in
+    getGeometryCacheDir())
+    """
+    if cacheFile is None:
+      from neuron_readExportedGeometry import getGeometryCacheDir
+      cacheFile = os.path.join(getGeometryCacheDir(), 'results.sqlite')
+    self.cacheFile = cacheFile
+    self._connection = None
+    self._pid = None
+  
+  
+  def key(self, geometry, model, properties, backend='neuron'):
+    """
+    Return the key for the response of model on geometry (read from
+    geometry.fileName) with passive properties (list of property dicts, as
+    passed to makeModel), simulated with backend
+    """
+    stimulus = model['stimulus']
+    settings = {'amplitude' : stimulus['amplitude'],
+                'duration' : stimulus['duration'],
+                'delay' : stimulus['delay'],
+                'segment' : stimulus['segment'].name,
+                'location' : stimulus['location'],
+                'tFinal' : model['tFinal'], 'dT' : model['dT'],
+                'v0' : model['v0']}
+    # the NEURON backends all give the same result
+    if backend in ('pool', 'handle'):
+      backend = 'neuron'
+    # different processing (e.g. removing loops) changes the response
+    structure = (len(geometry.segments),
+                 sum(len(segment.neighbors) for segment in geometry.segments))
+    from neuron_readExportedGeometry import getLibraryVersion
+    description = json.dumps([_fileHash(geometry.fileName), structure,
+                              _roundFloats(properties),
+                              _roundFloats(settings), backend,
+                              getLibraryVersion(), _codeHash()],
+                             sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+  
+  
+  def get(self, cacheKey):
+    """
+    Return dict of values stored for cacheKey, or None if there are none
+    """
+    row = self._connect().execute('SELECT value FROM results WHERE key = ?',
+                                  (cacheKey,)).fetchone()
+    if row is None:
+      return None
+    return pickle.loads(bytes(row[0]))
+  
+  
+  def update(self, cacheKey, values):
+    """
+    Add values (dict) to the values stored for cacheKey
+    """
+    import sqlite3
+    connection = self._connect()
+    # lock the database so concurrent updates of one key are not lost
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+      row = connection.execute('SELECT value FROM results WHERE key = ?',
+                               (cacheKey,)).fetchone()
+      stored = {} if row is None else pickle.loads(bytes(row[0]))
+      stored.update(values)
+      connection.execute(
+        'INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)',
+        (cacheKey, sqlite3.Binary(pickle.dumps(stored, 2))))
+    except:
+      connection.execute('ROLLBACK')
+      raise
+    connection.execute('COMMIT')
+  
+  
+  def _connect(self):
+    # connections must not be shared with forked (e.g. robust_map) processes
+    if self._pid != os.getpid():
+      import sqlite3
+      self._connection = sqlite3.connect(self.cacheFile, timeout=600,
+                                         isolation_level=None)
+      self._connection.execute('CREATE TABLE IF NOT EXISTS results '
+                               '(key TEXT PRIMARY KEY, value BLOB)')
+      self._pid = os.getpid()
+    return self._connection
+
+
+_resultCache = None
+def getResultCache():
+  """
+  Return the ResultCache for this process, opening it if necessary
+  """
+  global _resultCache
+  if _resultCache is None:
+    _resultCache = ResultCache()
+  return _resultCache
+
+
+# modules whose code determines the results stored in ResultCache
+_codeFiles = ('NeuronGeometry.py', 'neuron_readExportedGeometry.py',
+              'neuron_simulateGeometry.py', 'neuron_batchSimulate.py',
+              'peelLength.py')
+def _codeHash():
+  """
+  Return list of SHA-1 hashes of the source of the modules that simulate
+  models and fit their responses
+  """
+  codeDir = os.path.dirname(os.path.abspath(__file__))
+  return [_fileHash(os.path.join(codeDir, codeFile))
+          for codeFile in _codeFiles]
+
+
+_fileHashes = {}
+def _fileHash(fileName):
+  """
+  Return SHA-1 hash of the contents of fileName, only re-reading the file if
+  it has changed
+  """
+  fileName = os.path.abspath(fileName)
+  fileStat = os.stat(fileName)
+  statKey = (fileName, fileStat.st_mtime, fileStat.st_size)
+  if statKey not in _fileHashes:
+    fileHash = hashlib.sha1()
+    with open(fileName, 'rb') as fIn:
+      for block in iter(lambda: fIn.read(1 << 20), b''):
+        fileHash.update(block)
+    _fileHashes[statKey] = fileHash.hexdigest()
+  return _fileHashes[statKey]
+
+
+def _roundFloats(obj, numDigits=6):
+  """
+  Return copy of obj (nested lists/tuples/dicts) with floats rounded to
+  numDigits significant digits
+  """
+  if isinstance(obj, float):
+    return float('%.*g' % (numDigits, obj))
+  elif isinstance(obj, dict):
+    return {key : _roundFloats(val, numDigits) for key, val in obj.items()}
+  elif isinstance(obj, (list, tuple)):
+    return [_roundFloats(val, numDigits) for val in obj]
+  else:
+    return obj
+
+
+###############################################################################
+def simulateModelHines(geometry, model, secondOrder=False):
+  """
+  Simulate a passive model without NEURON, in this process. Each segment is
+  one compartment (nseg = 1) connected through zero-area end nodes, as
+  NEURON builds it, and the tree-ordered (Hines) system is factored once and
+  integrated with implicit Euler (or Crank-Nicolson if secondOrder is True).
+  Like NEURON, the stimulus is evaluated at the midpoint of each time step.
+  geometry is prepared in place by prepareGeometry(), as for every backend.
+  Return (timeTrace, vTraces, textOutput), as simulateModel does.
+  """
+  from scipy.sparse import diags
+  from scipy.sparse.linalg import splu
+  
+  capacitance, conductance, source, stimulus, segmentInds = \
+    _passiveCableSystem(geometry, model)
+  recording = _recordingSpec(geometry, model)
+  if any(record[-1] != 0.5
+         for record in recording['traces'] + recording['probes']):
+    raise ValueError('hines backend can only record at location 0.5')
+  recordInds = segmentInds[[segInd for key, segInd, location
+                            in recording['traces']]].astype(int)
+  probeInds = segmentInds[[segInd for key, probe, segInd, location
+                           in recording['probes']]].astype(int)
+  sampleSteps = int(round(recording['dT'] / model['dT']))
+  if sampleSteps < 1 or \
+     abs(sampleSteps * model['dT'] - recording['dT']) > 1e-9 * model['dT']:
+    raise ValueError('hines backend recording interval must be a multiple'
+                     ' of dT')
+  
+  # theta-method: theta = 1 is implicit Euler, 0.5 is Crank-Nicolson. Zero-
+  # area nodes have no dynamics, so always solve their equations implicitly
+  dT = model['dT']
+  theta = numpy.where(capacitance > 0, 0.5 if secondOrder else 1.0, 1.0)
+  cOverDt = capacitance / dT
+  lhs = diags(cOverDt) + diags(theta).dot(conductance)
+  # nodes are numbered children-first, so eliminating in natural order
+  # produces no fill-in
+  lu = splu(lhs.tocsc(), permc_spec='NATURAL', diag_pivot_thresh=0.0)
+  if secondOrder:
+    explicit = (diags(cOverDt) - diags(1.0 - theta).dot(conductance)).tocsr()
+  else:
+    explicit = None
+  
+  # take steps the same way NEURON does, so the number of steps matches
+  stimInfo = model['stimulus']
+  stimStart = stimInfo['delay']
+  stimStop = stimInfo['delay'] + stimInfo['duration']
+  tFinal = model['tFinal']
+  stepStim = []
+  t = 0.0
+  while t < tFinal:
+    tMid = t + 0.5 * dT
+    stepStim.append(stimStart <= tMid < stimStop)
+    t += dT
+  rhsOff = source
+  rhsOn = source + stimInfo['amplitude'] * stimulus
+  
+  v = numpy.empty(len(capacitance))
+  v.fill(model['v0'])
+  traces = numpy.empty((len(stepStim) // sampleSteps + 1, len(recordInds)))
+  traces[0] = v[recordInds]
+  vMax = v[probeInds] ; vMin = v[probeInds]
+  for step, stimOn in enumerate(stepStim):
+    if explicit is None:
+      rhs = cOverDt * v
+    else:
+      rhs = explicit.dot(v)
+    rhs += rhsOn if stimOn else rhsOff
+    v = lu.solve(rhs)
+    if (step + 1) % sampleSteps == 0:
+      traces[(step + 1) // sampleSteps] = v[recordInds]
+    if len(probeInds):
+      vMax = numpy.maximum(vMax, v[probeInds])
+      vMin = numpy.minimum(vMin, v[probeInds])
+  
+  traces = traces.T.copy()
+  vTraces = {key : trace for (key, segInd, location), trace
+             in zip(recording['traces'], traces)}
+  probeVals = {'max' : vMax, 'min' : vMin, 'final' : v[probeInds]}
+  for n, (key, probe, segInd, location) in enumerate(recording['probes']):
+    vTraces[key] = float(probeVals[probe][n])
+  timeTrace = recording['dT'] * numpy.arange(traces.shape[1])
+  return timeTrace, vTraces, ""
+
+
+###############################################################################
+def _passiveCableSystem(geometry, model):
+  """
+  Assemble the passive cable equations for model on geometry,
+    C dV/dt = -G V + source + stimulus * I(t)
+  with one node at the center of each segment, and one zero-area node at
+  each connection point (and stimulated end). Units are nF, uS, mV, nA, ms.
+  Nodes are numbered in reverse Hines order (every node before its parent,
+  with the stimulated node as the root). checkConnectivity() reports loops
+  but does not remove them, so in a cell with loops some nodes have more than
+  one parent, and factoring the system produces some fill-in.
+  geometry is prepared in place by prepareGeometry() (so the direct solvers
+  work on the same segments as the simulation backends).
+  Return (capacitance, conductance, source, stimulus, recordInds), where
+  conductance is a sparse matrix and recordInds are the indices of the
+  segment center nodes.
+  """
+  from scipy.sparse import coo_matrix
+  
+  prepareGeometry(geometry)
+  
+  segments = geometry.segments
+  numSegments = len(segments)
+  capacitance = numpy.zeros(numSegments)
+  leak = numpy.zeros(numSegments)
+  source = numpy.zeros(numSegments)
+  # axial resistance (MOhm) from the center of each segment to its ends
+  halfResistance = numpy.zeros((numSegments, 2))
+  # model['properties'] tags segments; NEURON does that in a separate
+  # process, so restore the tags afterwards to leave geometry unchanged
+  oldTags = [set(segment.tags) for segment in segments]
+  try:
+    for ind, segment in enumerate(segments):
+      values, channels = model['properties'](segment)
+      unknown = set(values).difference(('Ra', 'cm')).union(
+        set(channels).difference(('pas',)))
+      if unknown:
+        raise ValueError('Only passive models can be solved directly, but %s'
+                         ' has %s' % (segment.name, ', '.join(sorted(unknown))))
+      area = 1.0e6 * segment.surfaceArea  # mm^2 -> um^2
+      capacitance[ind] = 1.0e-5 * values['cm'] * area
+      if 'pas' in channels:
+        leak[ind] = 1.0e-2 * channels['pas']['g'] * area
+        source[ind] = leak[ind] * channels['pas']['e']
+      halfResistance[ind] = \
+        0.01 * values['Ra'] * _halfResistanceIntegrals(segment)
+  finally:
+    for segment, tags in zip(segments, oldTags):
+      segment.tags = tags
+  
+  # connect segments through zero-area nodes. A connection to the interior
+  # of a segment (NEURON's nseg = 1) is a connection to its center
+  nodeIndex = {}
+  junctions = []
+  edges = []
+  connected = set()
+  def _connect(segInd, location, node):
+    if 0.0 < location < 1.0:
+      nodeIndex.setdefault(node, segInd)
+    elif (segInd, location) not in connected:
+      connected.add((segInd, location))
+      if node not in nodeIndex:
+        nodeIndex[node] = numSegments + len(junctions)
+        junctions.append(node)
+      edges.append((segInd, nodeIndex[node],
+                    halfResistance[segInd, int(location)]))
+  
+  segIndex = {segment : ind for ind, segment in enumerate(segments)}
+  # make interior connections first, so that their nodes are segment centers
+  neighborLocations = [(ind, location, node)
+                       for ind, segment in enumerate(segments)
+                       for location, nLocation, node
+                       in segment.neighborLocations]
+  for ind, location, node in neighborLocations:
+    if 0.0 < location < 1.0:
+      _connect(ind, location, node)
+  for ind, location, node in neighborLocations:
+    if not 0.0 < location < 1.0:
+      _connect(ind, location, node)
+  
+  # inject the stimulus
+  stimInfo = model['stimulus']
+  stimLocation = stimInfo['location']
+  stimSegInd = segIndex[stimInfo['segment']]
+  if 0.0 < stimLocation < 1.0:
+    stimInd = stimSegInd
+  else:
+    stimNodes = stimInfo['segment'].nodes
+    stimNode = stimNodes[0] if stimLocation == 0.0 else stimNodes[-1]
+    _connect(stimSegInd, stimLocation, stimNode)
+    stimInd = nodeIndex[stimNode]
+  
+  numNodes = numSegments + len(junctions)
+  order = _hinesOrder(numNodes, edges, stimInd)
+  # position[n] is the new index of node n
+  position = numpy.empty(numNodes, dtype=int)
+  position[order] = numpy.arange(numNodes)
+  
+  # build the conductance matrix (uS)
+  rows, cols, vals = [], [], []
+  for n0, n1, resistance in edges:
+    if resistance > 0:
+      g = 1.0 / resistance
+    else:
+      # zero-length half segment; NEURON would use a tiny resistance
+      g = 1.0e9
+    rows.extend((n0, n1, n0, n1))
+    cols.extend((n0, n1, n1, n0))
+    vals.extend((g, g, -g, -g))
+  rows.extend(range(numSegments))
+  cols.extend(range(numSegments))
+  vals.extend(leak)
+  rows = position[numpy.array(rows, dtype=int)]
+  cols = position[numpy.array(cols, dtype=int)]
+  conductance = coo_matrix((vals, (rows, cols)),
+                           shape=(numNodes, numNodes)).tocsr()
+  
+  def _expand(segValues):
+    values = numpy.zeros(numNodes)
+    values[position[:numSegments]] = segValues
+    return values
+  stimulus = numpy.zeros(numNodes)
+  stimulus[position[stimInd]] = 1.0
+  return (_expand(capacitance), conductance, _expand(source), stimulus,
+          position[:numSegments])
+
+
+def modalResponse(geometry, model, numModes=10, minAmplitude=1.0e-3):
+  """
+  Compute the response of a passive model to its current step directly from
+  the eigen-decomposition of the compartmental system, instead of simulating
+  and fitting exponentials. The soma voltage is exactly
+    v(t) = sum_k dV_k * (1 - exp(-t / tau_k))
+  with tau_k = 1 / eigenvalue_k. Only the numModes slowest modes are found
+  (with a sparse, shift-inverted symmetric eigen-solve).
+  Modes with |dV| < minAmplitude * (steady-state dV) are not visible at the
+  soma, and are omitted.
+  Return (model, vErr, vResid) like peelLength.modelResponse: model is a list
+  of (tau, dV) from slowest to fastest, vErr is the part of the steady-state
+  dV not explained by the returned modes, and vResid is 0.
+  """
+  from scipy.sparse import diags
+  from scipy.sparse.linalg import eigsh, splu
+  
+  capacitance, conductance, source, stimulus, recordInds = \
+    _passiveCableSystem(geometry, model)
+  # step amplitude; like peeling, report dV for a positive step
+  amplitude = abs(model['stimulus']['amplitude'])
+  recordInd = recordInds[geometry.segments.index(geometry.soma)]
+  
+  # steady-state response
+  lu = splu(conductance.tocsc(), permc_spec='NATURAL', diag_pivot_thresh=0.0)
+  vSteady = amplitude * lu.solve(stimulus)[recordInd]
+  
+  # eliminate zero-area nodes (which only connect to segment centers, so
+  # their block of the conductance matrix is diagonal)
+  dynamic = numpy.flatnonzero(capacitance > 0)
+  static = numpy.flatnonzero(capacitance == 0)
+  gDD = conductance[dynamic, :][:, dynamic]
+  gDS = conductance[dynamic, :][:, static]
+  invGSS = diags(1.0 / conductance.diagonal()[static])
+  gEff = gDD - gDS.dot(invGSS).dot(gDS.T)
+  stimEff = stimulus[dynamic] - gDS.dot(invGSS.dot(stimulus[static]))
+  recordEff = numpy.searchsorted(dynamic, recordInd)
+  
+  # symmetrize: with w = sqrt(C) v, dw/dt = -S w + stim / sqrt(C)
+  invSqrtC = 1.0 / numpy.sqrt(capacitance[dynamic])
+  sMatrix = diags(invSqrtC).dot(gEff).dot(diags(invSqrtC))
+  numModes = min(numModes, len(dynamic))
+  if numModes < len(dynamic) - 1:
+    eigVals, eigVecs = eigsh(sMatrix.tocsc(), k=numModes, sigma=0.0,
+                             which='LM')
+  else:
+    eigVals, eigVecs = numpy.linalg.eigh(sMatrix.toarray())
+  
+  # amplitude of each mode at the recording site
+  dV = amplitude * invSqrtC[recordEff] * eigVecs[recordEff, :] * \
+       eigVecs.T.dot(invSqrtC * stimEff) / eigVals
+  modes = sorted(zip(1.0 / eigVals, dV), reverse=True)[:numModes]
+  expModel = [(float(tau), float(v)) for tau, v in modes
+              if abs(v) >= minAmplitude * abs(vSteady)]
+  vErr = float(vSteady - sum(v for tau, v in expModel))
+  return expModel, vErr, 0.0
+
+
+def steadyStateResponse(geometry, model):
+  """
+  Compute the steady-state response of a passive model to its stimulus with
+  one factorization and solve of the conductance matrix.
+  Return dict of steady-state voltage change (mV) at the center of each
+  segment, keyed by segment name (like vTraces from simulateModel)
+  """
+  from scipy.sparse.linalg import splu
+  
+  capacitance, conductance, source, stimulus, recordInds = \
+    _passiveCableSystem(geometry, model)
+  lu = splu(conductance.tocsc(), permc_spec='NATURAL', diag_pivot_thresh=0.0)
+  vSteady = model['stimulus']['amplitude'] * lu.solve(stimulus)[recordInds]
+  return {segment.name : float(v)
+          for segment, v in zip(geometry.segments, vSteady)}
+
+
+def impedanceResponse(geometry, model, frequencies):
+  """
+  Compute the frequency response of a passive model to sinusoidal current
+  injected at its stimulus location, by solving (G + i w C) v = i for each
+  frequency (in Hz). If the cell is a tree, the nodes are tree-ordered, so
+  elimination costs O(N) per frequency, and it is carried out for all
+  frequencies at once. A cell with loops (which are kept, see
+  _passiveCableSystem) is factored separately for each frequency.
+  Return (zIn, zTransfer):
+    zIn is an array of complex input impedance (MOhm) measured at the soma
+    zTransfer is a dict keyed by segment name, of arrays of complex transfer
+      impedance (MOhm) from the stimulus to the center of the segment
+  """
+  capacitance, conductance, source, stimulus, recordInds = \
+    _passiveCableSystem(geometry, model)
+  # angular frequency, in radians / ms
+  omega = 2.0e-3 * pi * numpy.asarray(frequencies, dtype=float)
+  
+  parents, offDiagonal = _treeParents(conductance)
+  if parents is not None:
+    v = _solveTreeFrequencies(conductance.diagonal(), offDiagonal, parents,
+                              capacitance, stimulus, omega)
+  else:
+    # the cell has loops, so factor each frequency separately
+    from scipy.sparse import diags
+    from scipy.sparse.linalg import splu
+    v = numpy.empty((len(capacitance), len(omega)), dtype=complex)
+    for ind, w in enumerate(omega):
+      lhs = (conductance + diags(1j * w * capacitance)).tocsc()
+      v[:, ind] = splu(lhs, permc_spec='NATURAL').solve(
+        stimulus.astype(complex))
+  
+  zTransfer = {segment.name : v[ind]
+               for segment, ind in zip(geometry.segments, recordInds)}
+  return zTransfer[geometry.soma.name], zTransfer
+
+
+def _treeParents(conductance):
+  """
+  Nodes are numbered children-first, so in a tree each node (except the
+  root, numbered last) has exactly one neighbor with a higher number: its
+  parent. Return (parents, offDiagonal), where offDiagonal[n] is the matrix
+  entry connecting node n to its parent, or (None, None) if not a tree.
+  """
+  from scipy.sparse import triu
+  upper = triu(conductance, k=1).tocsr()
+  counts = numpy.diff(upper.indptr)
+  if counts[-1] != 0 or (counts[:-1] != 1).any():
+    return None, None
+  return upper.indices, upper.data
+
+
+def _solveTreeFrequencies(diagonal, offDiagonal, parents, capacitance,
+                          stimulus, omega):
+  """
+  Solve (G + i w C) v = stimulus for every w in omega by Hines elimination
+  (children-first order), vectorized over frequencies.
+  Return complex v, with shape (number of nodes, number of frequencies)
+  """
+  d = diagonal[:, None] + 1j * capacitance[:, None] * omega[None, :]
+  rhs = numpy.zeros(d.shape, dtype=complex)
+  rhs[:] = stimulus[:, None]
+  # eliminate each node into its parent
+  for node, (parent, a) in enumerate(zip(parents, offDiagonal)):
+    factor = a / d[node]
+    d[parent] -= factor * a
+    rhs[parent] -= factor * rhs[node]
+  # back substitute from the root
+  v = rhs
+  v[-1] /= d[-1]
+  for node in range(len(parents) - 1, -1, -1):
+    v[node] = (rhs[node] - offDiagonal[node] * v[parents[node]]) / d[node]
+  return v
+
+
+def _halfResistanceIntegrals(segment):
+  """
+  Return integral of dx / (pi r^2) (um^-1) over the first and second halves
+  of segment, treating radius as linear between nodes (as NEURON does)
+  """
+  r = numpy.array([node.r1 for node in segment.nodes])
+  length = numpy.array([c.length for c in segment.compartments])
+  halfLength = 0.5 * length.sum()
+  cumLength = numpy.concatenate(([0.0], numpy.cumsum(length)))
+  # index of compartment containing the midpoint
+  midInd = min(numpy.searchsorted(cumLength, halfLength, side='right') - 1,
+               len(length) - 1)
+  frac = (halfLength - cumLength[midInd]) / length[midInd] \
+         if length[midInd] > 0 else 0.0
+  rMid = r[midInd] + frac * (r[midInd + 1] - r[midInd])
+  
+  # integral for a linearly tapered piece of length L is L / (pi r0 r1)
+  pieceR = length / (pi * r[:-1] * r[1:])
+  first = pieceR[:midInd].sum() + \
+          frac * length[midInd] / (pi * r[midInd] * rMid)
+  second = pieceR[midInd + 1:].sum() + \
+           (1.0 - frac) * length[midInd] / (pi * rMid * r[midInd + 1])
+  return numpy.array((first, second))
+
+
+def _hinesOrder(numNodes, edges, root):
+  """
+  Return the cable nodes ordered so that each node comes before its parent in
+  the tree rooted at root (reversed Hines order). Eliminating nodes in this
+  order produces no fill-in, so the matrix factors like a tridiagonal one.
+  """
+  neighbors = [[] for n in range(numNodes)]
+  for n0, n1, resistance in edges:
+    neighbors[n0].append(n1)
+    neighbors[n1].append(n0)
+  visited = [False] * numNodes
+  visited[root] = True
+  order = [root]
+  for node in order:
+    # order grows as nodes are discovered (breadth first)
+    for neighbor in neighbors[node]:
+      if not visited[neighbor]:
+        visited[neighbor] = True
+        order.append(neighbor)
+  # append any nodes not connected to root, so the matrix is still complete
+  order.extend(n for n in range(numNodes) if not visited[n])
+  return numpy.array(order[::-1], dtype=int)
+
+
 ###############################################################################
 def plotTraces(timeTrace, vTraces):
   pyplot.figure()
@@ -384,8 +1634,8 @@ def _parseArguments():
 if __name__ == "__main__":
   # get the geometry file
   options = _parseArguments()
-  # create geometry from the file
-  geometry = HocGeometry(options.geoFile)
+  # create geometry from the file, and prepare it for simulation
+  geometry = prepareGeometry(HocGeometry(options.geoFile))
   # get passive properties
   properties = getPassiveProperties(options.passiveFile)
   # make neuron model
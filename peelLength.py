@@ -4,39 +4,52 @@
 import sys
 write = sys.stdout.write
 import scipy
+import numpy
 from scipy import optimize, diff
-from math import exp, log, isinf, sqrt
+from math import exp, isinf, sqrt
 from matplotlib import pyplot
 
 
 ###############################################################################
 def expSum(t, model, vErr=0, t0=None):
+  # return vErr + sum_n dV_n * (1.0 - exp(-(t - t0)/tau_n)) (zero before t0)
+  t = numpy.asarray(t, dtype=float)
+  if not model:
+    return numpy.zeros(len(t)) + vErr
+  taus, dVs = (numpy.array(vals, dtype=float) for vals in zip(*model))
   if t0 is None:
-    v = [vErr + sum(dV * (1.0 - exp(-tn/tau)) for tau,dV in model) for tn in t]
+    expT = t
   else:
-    def _f(_dV, _tn, _t0, _tau):
-      if _tn <= _t0:
-        return 0.0
-      else:
-        return _dV * (1.0 - exp((_t0 - _tn)/_tau))
-    v = [vErr + sum(_f(dV, tn, t0, tau) for tau,dV in model) for tn in t]
-  
-  return v
+    expT = numpy.maximum(t - t0, 0.0)
+  return vErr + (1.0 - numpy.exp(-expT[:, None] / taus)).dot(dVs)
 
 
 ###############################################################################
 def expSumParams(t, *params):
-  offset = params[0]
-  if any(p <= 0 for p in params[1::2]):
-    return scipy.array([float('inf')] * len(t))
-  try:
-    v = scipy.array([offset + sum(dV * (1.0 - exp(-tn/tau)) for tau, dV in
-                                  zip(params[1::2], params[2::2]))
-                     for tn in t])
-  except OverflowError:
-    print(params)
-    raise
-  return v
+  # params = offset, tau_1, dV_1, tau_2, dV_2, ...
+  taus = numpy.array(params[1::2], dtype=float)
+  if (taus <= 0).any():
+    return numpy.full(len(t), float('inf'))
+  t = numpy.asarray(t, dtype=float)
+  dVs = numpy.array(params[2::2], dtype=float)
+  return params[0] + (1.0 - numpy.exp(-t[:, None] / taus)).dot(dVs)
+
+
+###############################################################################
+def _expSumJacobian(t, *params):
+  # derivatives of expSumParams with respect to each parameter
+  t = numpy.asarray(t, dtype=float)
+  taus = numpy.array(params[1::2], dtype=float)
+  dVs = numpy.array(params[2::2], dtype=float)
+  jacobian = numpy.empty((len(t), len(params)))
+  jacobian[:, 0] = 1.0
+  if (taus <= 0).any():
+    jacobian[:, 1:] = 0.0
+    return jacobian
+  decay = numpy.exp(-t[:, None] / taus)
+  jacobian[:, 1::2] = -dVs * decay * t[:, None] / (taus * taus)
+  jacobian[:, 2::2] = 1.0 - decay
+  return jacobian
 
 
 ###############################################################################
@@ -48,6 +61,104 @@ def _linearFit(x, y, startInd, stopInd):
   return p[0], p[1], linearErr, startInd, stopInd
 
 
+###############################################################################
+def _bestLinearFit(x, y, startInd, stopInd, dI):
+  """
+  Return the _linearFit() with the smallest error among the windows
+  [i1, i1 + dI) for startInd <= i1 < stopInd - dI. The error of every window
+  is computed at once from prefix sums of x, y, x^2, xy, y^2; only windows
+  whose error is within rounding error of the best are refit exactly, so the
+  chosen window is the same as fitting every window.
+  """
+  fits = _bestLinearFits(x, y[None, :], [startInd], [stopInd], [dI])
+  return tuple(fit[0] for fit in fits)
+
+
+###############################################################################
+def _bestLinearFits(x, y, startInds, stopInds, dIs, refit=True):
+  """
+  Batched _bestLinearFit(): y has one trace per row, x is shared by all rows
+  or has one row per trace, and startInds, stopInds, dIs hold one value per
+  row. If refit is False, the best window's fit is taken from the prefix sums
+  instead of refitting candidates (ties within rounding error may then pick a
+  different, equally good window). Return arrays (slope, offset, linearErr,
+  fitStartInd, fitStopInd); rows without a finite window error get nan slope,
+  offset and linearErr.
+  """
+  numRows, numT = y.shape
+  x = numpy.broadcast_to(x[..., :numT], y.shape)
+  rows = numpy.arange(numRows)
+  inds = numpy.arange(numT)
+  startInds, stopInds, dIs = (numpy.asarray(a, dtype=int)
+                              for a in (startInds, stopInds, dIs))
+  # center the data to limit rounding error in the prefix sums, zeroing
+  # everything outside of [startInd, stopInd - 1)
+  inRange = (inds >= startInds[:, None]) & (inds < stopInds[:, None] - 1)
+  numVals = (stopInds - 1 - startInds)[:, None]
+  xc = numpy.where(inRange, x - x[rows, startInds][:, None], 0.0)
+  with numpy.errstate(invalid='ignore'):
+    yc = numpy.where(inRange, y, 0.0)
+    yMean = yc.sum(axis=1) / numVals[:, 0]
+    yc = numpy.where(inRange, yc - yMean[:, None], 0.0)
+  windowEnds = numpy.minimum(inds + dIs[:, None], numT)
+  def _windowSums(values):
+    # return sums over each window, and a bound on their rounding error
+    cumSum = numpy.zeros((numRows, numT + 1))
+    numpy.cumsum(values, axis=1, out=cumSum[:, 1:])
+    absSum = numpy.zeros((numRows, numT + 1))
+    numpy.cumsum(abs(values), axis=1, out=absSum[:, 1:])
+    return (cumSum[rows[:, None], windowEnds] - cumSum[:, :-1],
+            numVals * eps * absSum[rows[:, None], windowEnds])
+  eps = numpy.finfo(float).eps
+  (sumX, errX), (sumY, errY) = _windowSums(xc), _windowSums(yc)
+  sumXX, errXX = _windowSums(xc * xc)
+  sumXY, errXY = _windowSums(xc * yc)
+  sumYY, errYY = _windowSums(yc * yc)
+  dI = dIs[:, None]
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    varX = sumXX - sumX * sumX / dI
+    coVar = sumXY - sumX * sumY / dI
+    varY = sumYY - sumY * sumY / dI
+    linearErr = varY - coVar * coVar / varX
+    # propagate bounds on rounding error to linearErr
+    errVarX = errXX + 2 * abs(sumX) * errX / dI
+    errCoVar = errXY + (abs(sumX) * errY + abs(sumY) * errX) / dI
+    errVarY = errYY + 2 * abs(sumY) * errY / dI
+    tol = 2 * (errVarY + 2 * abs(coVar) * errCoVar / varX
+               + coVar * coVar * errVarX / (varX * varX)) \
+          + 8 * eps * (abs(varY) + coVar * coVar / varX)
+  
+  valid = (inds >= startInds[:, None]) & (inds + dI <= stopInds[:, None] - 1) \
+    & numpy.isfinite(linearErr) & numpy.isfinite(tol)
+  linearErr = numpy.where(valid, linearErr, numpy.inf)
+  if not refit:
+    fitStartInds = linearErr.argmin(axis=1)
+    best = (rows, fitStartInds)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      slope = coVar[best] / varX[best]
+      offset = (sumY[best] - slope * sumX[best]) / dIs \
+        + yMean - slope * x[rows, startInds]
+    found = numpy.isfinite(linearErr[best])
+    nan = float('nan')
+    return (numpy.where(found, slope, nan), numpy.where(found, offset, nan),
+            numpy.where(found, linearErr[best], nan),
+            numpy.where(found, fitStartInds, startInds),
+            numpy.where(found, fitStartInds + dIs, stopInds))
+  tol = numpy.where(valid, tol, 0.0)
+  candidates = valid & \
+    (linearErr - tol <= (linearErr + tol).min(axis=1)[:, None])
+  fits = []
+  for row in rows:
+    fitStartInds = numpy.flatnonzero(candidates[row])
+    if len(fitStartInds) == 0:
+      nan = float('nan')
+      fits.append((nan, nan, nan, startInds[row], stopInds[row]))
+      continue
+    fits.append(min((_linearFit(x[row], y[row], i1, i1 + dIs[row])
+                     for i1 in fitStartInds), key=lambda fit: fit[2]))
+  return tuple(numpy.array(vals) for vals in zip(*fits))
+
+
 ###############################################################################
 def estimateVInf(v, vNoise=1e-10):
   stopInd, maxV = max(enumerate(v), key=lambda x: x[1])
@@ -74,12 +185,13 @@ def peelLength(t, v, startInd=0, debugPlots=False):
   #  exponential, then subtracting that exponential to find the next slowest,
   #  etc
   
-  # convert v to a scipy array
-  v = scipy.array(v)
+  # convert t and v to scipy arrays
+  t = scipy.array(t, dtype=float)
+  v = scipy.array(v, dtype=float)
   
   # get tStart, vStart
   tStart, vStart = t[startInd], v[startInd]
-  fitStartInd = startInd
+  fitStartInd = oldFitStartInd = startInd
   
   # estimate the final voltage after infinite time
   vInf, stopInd = estimateVInf(v)
@@ -98,7 +210,7 @@ def peelLength(t, v, startInd=0, debugPlots=False):
     # find the slowest remaining time constant, and it's associated dV
     
     # fix the duration of the search window
-    dI = max(10, (stopInd - startInd) / 10)
+    dI = max(10, (stopInd - startInd) // 10)
     if dI >= stopInd - startInd:
       # not enough room to search, so give up
       break
@@ -106,11 +218,9 @@ def peelLength(t, v, startInd=0, debugPlots=False):
     oldStopInd = stopInd
     oldFitStartInd = fitStartInd
     # find the best subregion/linear fit to log v in that subregion
-    logV = [log(vn) for vn in v[:stopInd]]
+    logV = numpy.log(v[:stopInd])
     slope, offset, linearErr, fitStartInd, stopInd = \
-      min((_linearFit(t, logV, i1, i1 + dI)
-           for i1 in range(startInd, stopInd - dI)),
-          key=lambda x: x[2])
+      _bestLinearFit(t, logV, startInd, stopInd, dI)
     
     tau = -1.0 / slope
     dV = exp(offset)
@@ -128,37 +238,31 @@ def peelLength(t, v, startInd=0, debugPlots=False):
       pyplot.ylim(min(min(linear[:oldStopInd]), min(logV[:oldStopInd])),
                   max(linear[0], logV[0]))
 
-    if tau < 0 or (len(model) > 0 and tau > model[-1][0]):
+    if not tau >= 0 or (len(model) > 0 and tau > model[-1][0]):
       # the exponential we've found is garbage
       break
     # the exponential is okay, add it to the model
     model.append((tau, dV))
     
-    # remove the newly modeled exponential from the voltage
-    def _expFun(_t, _dV, _slope):
-      if _t > 0.0:
-        return _dV * exp(_slope * _t)
-      else:
-        return _dV
-    v -= [_expFun(tn, dV, slope) for tn in t]
+    # remove the newly modeled exponential from the voltage (constant
+    # before t = 0)
+    v -= dV * numpy.exp(slope * numpy.maximum(t, 0.0))
 
     # refine the stopInd for next time
-    try:
-      stopInd = min(stopInd,
-                    next(vn for vn in enumerate(v) if vn[1] <= 0)[0] - 1)
-    except StopIteration:
-      pass
+    nonPositive = numpy.flatnonzero(v <= 0)
+    if len(nonPositive):
+      stopInd = min(stopInd, nonPositive[0] - 1)
   
   vErr = v[startInd]
   numV = len(v) - startInd
-  vResid = sqrt(sum(vn*vn for vn in v[startInd:]) / numV)
+  vResid = sqrt(numpy.dot(v[startInd:], v[startInd:]) / numV)
   return model, vErr, vResid, oldFitStartInd
 
 
 ###############################################################################
 def fitLength(t, v, startInd, startModel, vErr=0):
   
-  expInd = max(enumerate(diff(v)), key=lambda x:x[1])[0] + 1
+  expInd = numpy.argmax(diff(v)) + 1
   startInd = max(expInd, startInd)
   
   # only fit the exponential part of the traces
@@ -166,13 +270,17 @@ def fitLength(t, v, startInd, startModel, vErr=0):
   
   # start with initial guess and fit parameters of model
   startParams = [vErr] + [p for pair in startModel for p in pair]
+  # scale parameters by their starting magnitude: the default scaling comes
+  # from Jacobian column norms, which misbehaves for fully decayed exponentials
+  paramScale = 1.0 / numpy.maximum(numpy.abs(startParams), 1.0e-3)
   
   try:
     params, pCov = optimize.curve_fit(expSumParams, t, v, p0=startParams,
+                                      jac=_expSumJacobian, diag=paramScale,
                                       maxfev=500)
   except RuntimeError as err:
-    if 'Number of calls to function has reached maxfev' in err.message:
-      print(err.message)
+    if 'Number of calls to function has reached maxfev' in str(err):
+      print(str(err))
       return [], float('Inf'), float('inf')
     else:
       raise
@@ -180,7 +288,7 @@ def fitLength(t, v, startInd, startModel, vErr=0):
   fitModel = [(tau, dV) for tau, dV in zip(params[1::2], params[2::2])]
   vErr = params[0]
   fitV = expSum(t, fitModel, vErr=vErr)
-  vResid = sqrt(sum((vn - fitVn)**2 for vn, fitVn in zip(v, fitV)) / len(fitV))
+  vResid = sqrt(numpy.mean((v - fitV)**2))
   return fitModel, vErr, vResid
 
 
@@ -284,6 +392,302 @@ def modelResponse(t, v, verbose=False, plotFit=False, debugPlots=False,
   return fitModel, vErr, vResid
 
 
+###############################################################################
+def _getStepWindows(t, v):
+  # batched getStepWindow(): return per-trace time and voltage arrays, the
+  # index of the start of the step, and the number of samples in the window
+  numTraces, numT = v.shape
+  rows = numpy.arange(numTraces)
+  inds = numpy.arange(numT)
+  maxInds, minInds = v.argmax(axis=1), v.argmin(axis=1)
+  v0 = v[:, 0]
+  positive = v[rows, maxInds] - v0 > v0 - v[rows, minInds]
+  windowLens = numpy.where(positive, maxInds, minInds)
+  # flip negative steps for now
+  v = numpy.where(positive[:, None], v, v0[:, None] - v)
+  
+  # re-center time to start at the point of maximum voltage change
+  inWindow = inds[:-1] < windowLens[:, None] - 1
+  diffV = numpy.diff(v, axis=1)
+  maxDVInds = numpy.where(inWindow, diffV, -numpy.inf).argmax(axis=1)
+  # back up to just after the last non-increasing sample before the jump
+  nonIncreasing = (diffV <= 0) & (inds[:-1] < maxDVInds[:, None])
+  lastInds = numT - 2 - nonIncreasing[:, ::-1].argmax(axis=1)
+  dVInds = numpy.where(nonIncreasing.any(axis=1), lastInds + 1, 0)
+  
+  t = t[None, :] - t[dVInds][:, None]
+  v = v - v[rows, dVInds][:, None]
+  return t, v, dVInds, windowLens
+
+
+###############################################################################
+def _estimateVInfs(v, numT, vNoise=1e-10):
+  # batched estimateVInf(), with trace n valid for v[n, :numT[n]]
+  rows = numpy.arange(v.shape[0])
+  valid = numpy.arange(v.shape[1]) < numT[:, None]
+  stopInds = numpy.where(valid, v, -numpy.inf).argmax(axis=1)
+  
+  vm = v[rows, (stopInds * 0.9).astype(int)]
+  v1 = v[rows, (stopInds * 0.95).astype(int)]
+  vp = v[rows, stopInds]
+  
+  dVm = v1 - vm
+  dVp = vp - v1
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    vInf = numpy.where((dVp < vNoise) | (dVm < vNoise) | (dVm < dVp), vp,
+                       v1 + dVm * dVp / (dVm - dVp))
+  return vInf, stopInds
+
+
+###############################################################################
+def _peelLengths(t, v, startInds, numT):
+  # batched peelLength(): t and v have one trace per row, with trace n valid
+  # for v[n, :numT[n]]. Every trace still being peeled is advanced by one
+  # exponential per pass
+  numTraces = v.shape[0]
+  rows = numpy.arange(numTraces)
+  inds = numpy.arange(v.shape[1])
+  valid = inds < numT[:, None]
+  
+  # estimate the final voltage after infinite time, and convert v to
+  # exponential decay towards vInf
+  vInf, stopInds = _estimateVInfs(v, numT)
+  v = vInf[:, None] - v
+  vStart = v[rows, startInds]
+  
+  models = [[] for n in rows]
+  fitStartInds = startInds.copy()
+  oldFitStartInds = startInds.copy()
+  lastTau = numpy.full(numTraces, numpy.inf)
+  peeling = numpy.ones(numTraces, dtype=bool)
+  while True:
+    # stop when essentially no deltaV remains, or there is no room to search
+    dIs = numpy.maximum(10, (stopInds - startInds) // 10)
+    peeling &= (v[rows, startInds] > 0.01 * vStart) \
+      & (dIs < stopInds - startInds)
+    peel = numpy.flatnonzero(peeling)
+    if len(peel) == 0:
+      break
+    
+    oldFitStartInds[peel] = fitStartInds[peel]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      logV = numpy.log(v[peel])
+    slope, offset, linearErr, fitStartInds[peel], stopInds[peel] = \
+      _bestLinearFits(t[peel], logV, startInds[peel], stopInds[peel],
+                      dIs[peel], refit=False)
+    with numpy.errstate(divide='ignore', over='ignore'):
+      tau = -1.0 / slope
+      dV = numpy.exp(offset)
+    
+    # drop traces where the exponential we've found is garbage
+    good = (tau >= 0) & (tau <= lastTau[peel])
+    peeling[peel[~good]] = False
+    peel, slope, tau, dV = peel[good], slope[good], tau[good], dV[good]
+    if len(peel) == 0:
+      break
+    lastTau[peel] = tau
+    for n, tau_n, dV_n in zip(peel, tau, dV):
+      models[n].append((float(tau_n), float(dV_n)))
+    
+    # remove the newly modeled exponentials from the voltage (constant
+    # before t = 0)
+    v[peel] -= dV[:, None] * numpy.exp(slope[:, None]
+                                       * numpy.maximum(t[peel], 0.0))
+    
+    # refine the stopInds for next time
+    nonPositive = (v[peel] <= 0) & valid[peel]
+    stopInds[peel] = numpy.where(nonPositive.any(axis=1),
+                                 numpy.minimum(stopInds[peel],
+                                               nonPositive.argmax(axis=1) - 1),
+                                 stopInds[peel])
+  
+  vErr = v[rows, startInds]
+  resid = numpy.where(valid & (inds >= startInds[:, None]), v, 0.0)
+  vResid = numpy.sqrt((resid * resid).sum(axis=1) / (numT - startInds))
+  return models, vErr, vResid, oldFitStartInds
+
+
+###############################################################################
+def _expSumsParams(t, params):
+  # expSumParams() for each row of params, evaluated on the same row of t.
+  # Also return the decay factors exp(-t/tau), needed for the Jacobian
+  taus, dVs = params[:, 1::2], params[:, 2::2]
+  with numpy.errstate(divide='ignore', over='ignore', invalid='ignore'):
+    decay = numpy.exp(t[:, :, None] * (-1.0 / taus)[:, None, :])
+    f = (params[:, 0] + dVs.sum(axis=1))[:, None] \
+      - numpy.matmul(decay, dVs[:, :, None])[:, :, 0]
+  f[(taus <= 0).any(axis=1)] = numpy.inf
+  return f, decay
+
+
+###############################################################################
+def _levenbergMarquardt(t, v, weights, params, maxIter=200, tol=1.49012e-8):
+  """
+  Fit expSumParams() to every row of v at once by Levenberg-Marquardt, using
+  only samples where weights is True. Parameters are scaled by their starting
+  magnitude, as in fitLength(). Return the fit params and the sum of squared
+  residuals for each row (inf where no valid fit was found).
+  """
+  params = params.copy()
+  numTraces, numParams = params.shape
+  scale = 1.0 / numpy.maximum(abs(params), 1.0e-3)
+  
+  def _cost(_params, _rows):
+    _f, _decay = _expSumsParams(t[_rows], _params)
+    with numpy.errstate(invalid='ignore', over='ignore'):
+      _resid = numpy.where(weights[_rows], _f - v[_rows], 0.0)
+      _cost = (_resid * _resid).sum(axis=1)
+    _cost[~numpy.isfinite(_cost)] = numpy.inf
+    return _cost, _resid, _decay
+  
+  def _normalEquations(_params, _rows, _resid, _decay):
+    # return J^T J and J^T resid, with J the Jacobian with respect to the
+    # scaled parameters
+    _taus, _dVs = _params[:, 1::2], _params[:, 2::2]
+    _weights = weights[_rows]
+    _decay *= _weights[:, :, None]
+    _jacobian = numpy.empty(_decay.shape[:2] + (numParams,))
+    _jacobian[:, :, 0] = _weights
+    numpy.multiply(_decay, t[_rows][:, :, None], out=_jacobian[:, :, 1::2])
+    _jacobian[:, :, 1::2] *= (-_dVs / (_taus * _taus))[:, None, :]
+    numpy.subtract(_weights[:, :, None], _decay, out=_jacobian[:, :, 2::2])
+    _jacobianT = _jacobian.transpose(0, 2, 1)
+    _scale = scale[_rows]
+    return (numpy.matmul(_jacobianT, _jacobian)
+            / (_scale[:, :, None] * _scale[:, None, :]),
+            numpy.matmul(_jacobianT, _resid[:, :, None])[:, :, 0] / _scale)
+  
+  rows = numpy.arange(numTraces)
+  cost, resid, decay = _cost(params, rows)
+  fitting = numpy.isfinite(cost) & (weights.sum(axis=1) > numParams)
+  rows = numpy.flatnonzero(fitting)
+  jtj = numpy.zeros((numTraces, numParams, numParams))
+  grad = numpy.zeros((numTraces, numParams))
+  jtj[rows], grad[rows] = _normalEquations(params[rows], rows, resid[rows],
+                                           decay[rows])
+  del resid, decay
+  diagInds = numpy.arange(numParams)
+  damping = 1.0e-3 * jtj[:, diagInds, diagInds].max(axis=1)
+  for iteration in range(maxIter):
+    fit = numpy.flatnonzero(fitting)
+    if len(fit) == 0:
+      break
+    dampedJtJ = jtj[fit]
+    dampedJtJ[:, diagInds, diagInds] += damping[fit][:, None]
+    try:
+      scaledStep = \
+        -numpy.linalg.solve(dampedJtJ, grad[fit][:, :, None])[:, :, 0]
+    except numpy.linalg.LinAlgError:
+      scaledStep = -numpy.array([numpy.linalg.lstsq(a, g, rcond=None)[0]
+                                 for a, g in zip(dampedJtJ, grad[fit])])
+    newParams = params[fit] + scaledStep / scale[fit]
+    newCost, newResid, newDecay = _cost(newParams, fit)
+    
+    # accept steps that reduce the cost, and adjust damping
+    better = newCost < cost[fit]
+    accept = fit[better]
+    # converge when the cost changes negligibly, whether or not the step is
+    # accepted (steps are rejected at the rounding-error floor of a perfect fit)
+    with numpy.errstate(invalid='ignore'):
+      converged = abs(cost[fit] - newCost) <= tol * cost[fit]
+    params[accept] = newParams[better]
+    cost[accept] = newCost[better]
+    damping[fit] *= numpy.where(better, 0.3, 2.0)
+    
+    # also stop when steps no longer change the parameters
+    scaledParams = params[fit] * scale[fit]
+    stepNorm = numpy.sqrt((scaledStep * scaledStep).sum(axis=1))
+    converged |= stepNorm <= tol * (tol + numpy.sqrt(
+                   (scaledParams * scaledParams).sum(axis=1)))
+    fitting[fit[converged]] = False
+    
+    # update the normal equations of traces that will take another step
+    update = better & ~converged
+    if update.any():
+      jtj[fit[update]], grad[fit[update]] = \
+        _normalEquations(newParams[update], fit[update], newResid[update],
+                         newDecay[update])
+  
+  return params, cost
+
+
+###############################################################################
+def _fitLengths(t, v, numT, startInds, startModels, vErrs):
+  # batched fitLength(): refine each trace's startModel by nonlinear fit
+  numTraces, maxT = v.shape
+  inds = numpy.arange(maxT)
+  
+  # only fit the exponential part of the traces
+  diffV = numpy.where(inds[:-1] < numT[:, None] - 1, numpy.diff(v, axis=1),
+                      -numpy.inf)
+  startInds = numpy.maximum(diffV.argmax(axis=1) + 1, startInds)
+  weights = (inds >= startInds[:, None]) & (inds < numT[:, None])
+  
+  models = [[] for n in range(numTraces)]
+  vErr = numpy.full(numTraces, numpy.inf)
+  vResid = numpy.full(numTraces, numpy.inf)
+  # fit traces with the same number of exponentials together
+  for numExp in set(len(model) for model in startModels):
+    group = numpy.array([n for n, model in enumerate(startModels)
+                         if len(model) == numExp])
+    startParams = numpy.array([[vErrs[n]] + [p for pair in startModels[n]
+                                             for p in pair] for n in group])
+    params, cost = _levenbergMarquardt(t[group], v[group], weights[group],
+                                       startParams)
+    numFit = weights[group].sum(axis=1)
+    for n, p, c, k in zip(group, params, cost, numFit):
+      if numpy.isfinite(c):
+        models[n] = [(tau, dV) for tau, dV in zip(p[1::2], p[2::2])]
+        vErr[n] = p[0]
+        vResid[n] = sqrt(c / k)
+  return models, vErr, vResid
+
+
+###############################################################################
+def modelResponses(t, v, findStepWindow=False, maxBatchSize=None):
+  """
+  Model many voltage responses at once, as modelResponse() does for one
+  trace. t is the time base shared by all traces and v is a 2D array with
+  one trace per row. Step-window detection, peeling and the nonlinear
+  refinement are each done for a whole batch of traces with numpy; batches
+  hold maxBatchSize traces (by default, about 2^20 samples per batch).
+  Return (models, vErr, vResid): a list with the model of each trace, and
+  arrays with each trace's vErr and vResid.
+  """
+  t = numpy.asarray(t, dtype=float)
+  v = numpy.array(v, dtype=float, ndmin=2)
+  numTraces, numT = v.shape
+  if maxBatchSize is None:
+    maxBatchSize = max(1, 2**20 // numT)
+  
+  models = []
+  vErr = numpy.empty(numTraces)
+  vResid = numpy.empty(numTraces)
+  for batchStart in range(0, numTraces, maxBatchSize):
+    batch = slice(batchStart, batchStart + maxBatchSize)
+    vBatch = v[batch]
+    if findStepWindow:
+      tBatch, vBatch, startInds, numTBatch = _getStepWindows(t, vBatch)
+    else:
+      tBatch = numpy.broadcast_to(t, vBatch.shape)
+      startInds = numpy.zeros(len(vBatch), dtype=int)
+      numTBatch = numpy.full(len(vBatch), numT, dtype=int)
+    
+    peelModels, peelVErr, peelVResid, fitStartInds \
+      = _peelLengths(tBatch, vBatch, startInds, numTBatch)
+    fitModels, fitVErr, fitVResid \
+      = _fitLengths(tBatch, vBatch, numTBatch, fitStartInds, peelModels,
+                    peelVErr)
+    
+    # keep whichever model gives the best result
+    usePeel = peelVResid < fitVResid
+    models.extend(peelModel if p else fitModel for peelModel, fitModel, p
+                  in zip(peelModels, fitModels, usePeel))
+    vErr[batch] = numpy.where(usePeel, peelVErr, fitVErr)
+    vResid[batch] = numpy.where(usePeel, peelVResid, fitVResid)
+  return models, vErr, vResid
+
+
 ###############################################################################
 def evaluateFit(model, fitModel, vErr, vResid):
   def _percErr(modelExp, fitExp):
@@ -343,11 +747,10 @@ def makeSyntheticData(deltaVTotal=10.0, tFinal=2000, dT=0.25, numLengths=(2,5),
   
   if upSwing:
     tauUp = min(0.5 * min(tau), 10.0)  
-    for n, tn in enumerate(t):
-      v[n] *= (1.0 - exp(-tn / tauUp))
+    v *= (1.0 - numpy.exp(-t / tauUp))
     
   if noiseAmp > 0:
-    v = [vn + random.normalvariate(0, noiseAmp) for vn in v]
+    v += [random.normalvariate(0, noiseAmp) for vn in v]
   return t, v, model
 
 
@@ -365,6 +768,29 @@ def testPeelLength(plotFit=False, debugPlots=False, noiseAmp=0.0,
   evaluateFit(model, fitModel, vErr, vResid)
 
 
+###############################################################################
+def testModelResponses(numTraces=100, noiseAmp=0.0, verbose=True):
+  # model many synthetic traces at once, and compare with modelResponse()
+  import time
+  traces = [makeSyntheticData(noiseAmp=noiseAmp) for n in range(numTraces)]
+  t = traces[0][0]
+  v = numpy.array([trace[1] for trace in traces])
+  startTime = time.time()
+  models, vErr, vResid = modelResponses(t, v)
+  batchTime = time.time() - startTime
+  startTime = time.time()
+  singleResid = numpy.array([modelResponse(t, vn)[2] for vn in v])
+  singleTime = time.time() - startTime
+  if verbose:
+    print('Modeled %d traces in %.3g s (%.3g s one at a time)'
+          % (numTraces, batchTime, singleTime))
+    print('RMS voltage error: median %.2g mV, max %.2g mV '
+          % (numpy.median(vResid), vResid.max())
+          + '(one at a time: median %.2g mV, max %.2g mV)'
+          % (numpy.median(singleResid), singleResid.max()))
+  return models, vErr, vResid
+
+
 ###############################################################################
 def _parseArguments():
   import argparse
@@ -383,6 +809,9 @@ def _parseArguments():
                       help="suppress printing information")
   parser.add_argument("--noiseAmp", "-n", default=0.0, type=float,
                       help="specify noise level for synthetic data")
+  parser.add_argument("--numTraces", default=1, type=int,
+                      help="model this many synthetic traces at once with "
+                          +"modelResponses")
               
   return parser.parse_args()
 
@@ -393,6 +822,9 @@ if __name__ == "__main__":
   if options.demo:
     demo(plotFit=options.plotFit, debugPlots=options.debugPlots,
          verbose=options.verbose)
+  elif options.numTraces > 1:
+    testModelResponses(numTraces=options.numTraces, noiseAmp=options.noiseAmp,
+                       verbose=options.verbose)
   else:
     testPeelLength(plotFit=options.plotFit, debugPlots=options.debugPlots,
                    noiseAmp=options.noiseAmp, verbose=options.verbose)
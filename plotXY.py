@@ -1,6 +1,8 @@
 #!/usr/bin/python
 
 
+import weakref
+import numpy
 import matplotlib
 from matplotlib import pyplot
 import scipy
@@ -17,14 +19,22 @@ Not meant to be called from command line, but imported and used
 matplotlib.rcParams['pdf.fonttype'] = 42
 
 
+# lines drawn with decimate=True, mapped to the _DecimatedLine that holds
+# their full data
+_decimatedLines = weakref.WeakKeyDictionary()
+
+
 
 ###############################################################################
 def plotXY(x, y, markerStyle, color=None, xLabel='x', yLabel='y', title=None,
            labelSize=30, tickSize=24, titleSize=None, figure=None,
-           legendLabel=None, xScale=None, yScale=None, **kwargs):
+           legendLabel=None, xScale=None, yScale=None, decimate=False,
+           **kwargs):
            
   """
   Plot typical x vs y plot with requested options.
+  If decimate is True, x must be increasing; only the min and max points per
+    horizontal pixel are drawn, and the line is re-decimated when zoomed
   Return figure object
   """
   if figure is None:
@@ -43,10 +53,17 @@ def plotXY(x, y, markerStyle, color=None, xLabel='x', yLabel='y', title=None,
   if legendLabel is None:
     legendLabel = yLabel
   
-  if color is None:
-    axes.plot(x, y, markerStyle, label=legendLabel, **kwargs)
+  if decimate:
+    x = numpy.asarray(x)
+    y = numpy.asarray(y)
+    xPlot, yPlot = decimateXY(x, y, _numBuckets(axes))
   else:
-    axes.plot(x, y, markerStyle, color=color, label=legendLabel, **kwargs)
+    xPlot, yPlot = x, y
+  if color is not None:
+    kwargs['color'] = color
+  line, = axes.plot(xPlot, yPlot, markerStyle, label=legendLabel, **kwargs)
+  if decimate:
+    _decimatedLines[line] = _DecimatedLine(line, x, y)
 
   if xScale is not None:
     axes.set_xscale(xScale)
@@ -83,6 +100,98 @@ def plotXY(x, y, markerStyle, color=None, xLabel='x', yLabel='y', title=None,
 
 
 
+###############################################################################
+def decimateXY(x, y, numBuckets):
+  """
+  Reduce x, y data (with x increasing) to at most 2 * numBuckets + 2 points
+  that draw the same at a horizontal resolution of numBuckets: the first and
+  last points, and the min and max points of each bucket of consecutive points,
+  in their original order. Peaks are kept no matter how narrow.
+  Return xDecimated, yDecimated
+  """
+  numPoints = len(y)
+  if numPoints <= 2 * numBuckets + 2:
+    return x, y
+  bucketSize = -(-numPoints // numBuckets)
+  numFull = numPoints // bucketSize
+  buckets = numpy.asarray(y[:numFull * bucketSize]).reshape(numFull,
+                                                            bucketSize)
+  offsets = bucketSize * numpy.arange(numFull)
+  inds = [[0, numPoints - 1], offsets + buckets.argmin(axis=1),
+          offsets + buckets.argmax(axis=1)]
+  if numFull * bucketSize < numPoints:
+    tail = numpy.asarray(y[numFull * bucketSize:])
+    inds.append(numFull * bucketSize + numpy.array([tail.argmin(),
+                                                    tail.argmax()]))
+  # sort the indices so the line is drawn through the points in order
+  inds = numpy.unique(numpy.concatenate(inds))
+  return x[inds], y[inds]
+
+
+
+###############################################################################
+def setLineData(line, x, y):
+  """
+  Set the data of a line drawn by plotXY, re-decimating it if it was plotted
+  with decimate=True
+  """
+  decimatedLine = _decimatedLines.get(line)
+  if decimatedLine is None:
+    line.set_data(x, y)
+  else:
+    decimatedLine.setData(x, y)
+
+
+
+###############################################################################
+def _numBuckets(axes):
+  """
+  Return the number of decimation buckets for axes: one per pixel of width
+  """
+  return max(int(axes.get_window_extent().width), 1)
+
+
+
+###############################################################################
+class _DecimatedLine(object):
+  """
+  Hold the full data of a decimated line, and re-decimate it to the visible
+  x-range when the axes are zoomed or resized
+  """
+  def __init__(self, line, x, y):
+    # only a weak reference, so that _decimatedLines (whose values must not
+    # refer to their keys) releases this when line is discarded
+    self.line = weakref.ref(line)
+    self.x = x
+    self.y = y
+    # the callback registries only keep weak references to these methods;
+    # _decimatedLines keeps self alive as long as line is
+    line.axes.callbacks.connect('xlim_changed', self.redecimate)
+    line.figure.canvas.mpl_connect('resize_event', self.redecimate)
+  
+  def setData(self, x, y):
+    self.x = numpy.asarray(x)
+    self.y = numpy.asarray(y)
+    self.redecimate()
+  
+  def redecimate(self, event=None):
+    line = self.line()
+    if line is None or line.axes is None:
+      # line was discarded, or removed from its axes
+      return
+    axes = line.axes
+    start, stop = 0, len(self.y)
+    if not axes.get_autoscalex_on():
+      # zoomed: decimate only the visible points, plus one more on each
+      # side so the line runs to the edges of the axes
+      xMin, xMax = sorted(axes.get_xlim())
+      start = max(numpy.searchsorted(self.x, xMin, 'left') - 1, 0)
+      stop = min(numpy.searchsorted(self.x, xMax, 'right') + 1, stop)
+    line.set_data(*decimateXY(self.x[start:stop], self.y[start:stop],
+                              _numBuckets(axes)))
+
+
+
 if __name__ == "__main__":
   print(_usageStr)
   # maybe put in a demo?
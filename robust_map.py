@@ -1,162 +1,423 @@
 #!/usr/bin/python
 
 
-from multiprocessing import Process, Queue, cpu_count
+from multiprocessing import Process, Queue, Pipe, cpu_count
+from collections import deque
+import itertools
 import tempfile
 import os
-from operator import xor
 import cPickle
+import hashlib
+import struct
+import zlib
 import textProgress
 import sys
 if sys.version_info[0] == 3:
   from io import StringIO
 else:
   from cStringIO import StringIO
-from time import sleep
+from time import time
+try:
+  from multiprocessing.connection import wait as _waitConnections
+except ImportError:
+  # Python 2: connections are selectable file descriptors (on Unix)
+  import select
+  def _waitConnections(connections, timeout=None):
+    return select.select(connections, [], [], timeout)[0]
 
 
 ###############################################################################
 def robust_map(f, inputList, args=tuple(), kwargs=dict(), numProcesses=-1,
-               initFunc=None):
-  rHash = hash(f.__name__)
-  rHash ^= reduce(xor, map(hash, inputList))
-  resumeFile = os.path.join(tempfile.gettempdir(), 'resume_' + str(rHash))
-  logFile = 'map_' + str(rHash) + '.log'
-  logOut = None
-  inputQueue = Queue()
-  outputQueue = Queue()
+               initFunc=None, chunkSize=1, checkpointDir=None,
+               keepCheckpoint=False, maxTasksPerWorker=None,
+               taskTimeout=None, maxMemory=None, maxRetries=1):
+  """
+  Compute [f(x, *args, **kwargs) for x in inputList] in parallel processes.
+  Results are saved to a checkpoint file as they are computed, so an
+  interrupted map resumes where it left off. Tasks that time out, exceed the
+  memory limit, or crash their worker are returned as TaskFailure objects.
+  See robust_imap() for details.
+  """
+  outputList = [None] * len(inputList)
+  for ind, val in robust_imap(f, inputList, args=args, kwargs=kwargs,
+                              numProcesses=numProcesses, initFunc=initFunc,
+                              chunkSize=chunkSize,
+                              checkpointDir=checkpointDir,
+                              keepCheckpoint=keepCheckpoint,
+                              maxTasksPerWorker=maxTasksPerWorker,
+                              taskTimeout=taskTimeout, maxMemory=maxMemory,
+                              maxRetries=maxRetries):
+    outputList[ind] = val
+  return outputList
+
 
-  if os.access(resumeFile, os.R_OK):
-    print('Resuming previously interrupted map (%s)' % resumeFile)
+def robust_imap(f, inputList, args=tuple(), kwargs=dict(), numProcesses=-1,
+                initFunc=None, chunkSize=1, checkpointDir=None,
+                keepCheckpoint=False, maxTasksPerWorker=None,
+                taskTimeout=None, maxMemory=None, maxRetries=1):
+  """
+  Iterator version of robust_map(): yield (index, f(inputList[index], ...))
+  as results are completed (in no particular order).
+    numProcesses:   number of worker processes (<= 0: fewer than cpu_count())
+    initFunc:       function called by each worker before computing
+    chunkSize:      number of inputs sent to a worker at a time
+    checkpointDir:  directory for the checkpoint file (default: tempdir).
+                    Use a shared directory to resume on another node.
+    keepCheckpoint: if True, keep the (compacted) checkpoint file after the
+                    map succeeds, otherwise remove it
+    maxTasksPerWorker: replace each worker with a fresh process after it
+                    computes this many inputs (default: never)
+    taskTimeout:    kill a worker whose task takes longer than this many
+                    seconds (default: no limit)
+    maxMemory:      kill a worker whose resident memory exceeds this many MB
+                    (default: no limit; only enforced on Linux)
+    maxRetries:     number of times a killed task is retried before it fails
+  Each finished result is immediately appended to the checkpoint file and
+  synced to disk, so a job that is killed (even by power loss) loses at most
+  the chunks being computed. Previously computed results are yielded first.
+  An exception raised by f stops the map and is re-raised, but a task that
+  times out, exceeds maxMemory, or crashes its worker (after maxRetries
+  retries) is yielded as a TaskFailure, and is not checkpointed so that it
+  is retried if the map is resumed.
+  """
+  # name the checkpoint by a hash that is stable across processes
+  rHash = hashlib.sha1(f.__name__.encode('utf-8'))
+  rHash.update(cPickle.dumps(list(inputList), 2))
+  rHash = rHash.hexdigest()[:16]
+  if checkpointDir is None:
+    checkpointDir = tempfile.gettempdir()
+  checkpointFile = os.path.join(checkpointDir, 'checkpoint_' + rHash)
+  logFile = 'map_' + rHash + '.log'
+  logOut = None
+  numInput = len(inputList)
+  
+  computed = {}
+  if os.access(checkpointFile, os.R_OK):
+    print('Resuming previously interrupted map (%s)' % checkpointFile)
     # resume interrupted job
-    computedIndices = []
-    with open(resumeFile, 'rb') as fIn:
-      fIn.seek(0, 2)
-      endInd = fIn.tell()
-      fIn.seek(0)
-      while fIn.tell() < endInd:
-        # load pickled calculated obj (index, value, textOut) from resume file
-        computedVal = cPickle.load(fIn)
-        # add computed index to computed indices
-        computedIndices.append(computedVal[0])
-        # add computed obj to outputQueue
-        outputQueue.put(computedVal + (None,))
-        textOut = computedVal[-1]
-        if textOut:
-          if logOut is None:
-            print('Logging output to %s' % logFile)
-            logOut = open(logFile, 'w')
-          logOut.write(textOut)
-    for ind, inputVal in enumerate(inputList):
-      if ind not in computedIndices:
-        inputQueue.put((ind, inputVal))
+    records = _readCheckpoint(checkpointFile)
+    for ind, (val, textOut) in sorted(records.items()):
+      computed[ind] = val
+      if textOut:
+        if logOut is None:
+          print('Logging output to %s' % logFile)
+          logOut = open(logFile, 'w')
+        logOut.write(textOut)
     print('Computing new values')
-  else:
-    # start new job
-    for inputVal in enumerate(inputList):
-      inputQueue.put(inputVal)
-  for n in range(numProcesses):
-    inputQueue.put((None, None))
   
+  # split the inputs that still need computing into chunks
+  remaining = [ind for ind in range(numInput) if ind not in computed]
+  pendingChunks = deque(remaining[n:n + chunkSize]
+                        for n in range(0, len(remaining), chunkSize))
   if numProcesses <= 0:
     numProcesses += cpu_count()
+  numProcesses = max(1, min(numProcesses, len(pendingChunks)))
   
-  sendArgs = (f, inputQueue, outputQueue, initFunc) + args
-  procs = [Process(target=_mapFunc, args=sendArgs, kwargs=kwargs)
-           for n in range(numProcesses)]
-
-  numInput = len(inputList)  
-  outputList = [None] * numInput
-  textOutList = [''] * numInput
+  # workers: {workerId: _Worker}. Each worker sends results through its own
+  # pipe, so killing a worker (even while it is sending) can't corrupt or
+  # lock the channel that other workers use
+  workers = {}
+  workerIds = itertools.count()
+  def _startWorker():
+    workerId = next(workerIds)
+    taskQueue = Queue()
+    resultConn, childConn = Pipe(duplex=False)
+    process = Process(target=_mapFunc,
+                      args=(f, taskQueue, childConn, initFunc) + args,
+                      kwargs=kwargs)
+    process.start()
+    # only the worker writes results, so that the pipe reports its exit
+    childConn.close()
+    workers[workerId] = _Worker(process, taskQueue, resultConn)
   
-  # start the processes
-  for p in procs:
-    p.start()
-
-  numOutput = 0
-  numPreCalc = outputQueue.qsize()
-  textProgress.startProgress(numInput - numPreCalc)
-  while numOutput < numInput:
-    try:
-      ind, val, textOut, err = outputQueue.get()
-    except BaseException as err:
-      pass
+  def _stopWorker(workerId, kill=False):
+    worker = workers.pop(workerId)
+    if kill:
+      worker.process.terminate()
+    else:
+      worker.taskQueue.put(None)
+    if worker.resultConn is not None:
+      worker.resultConn.close()
+  
+  # poll for hung, bloated, or crashed workers this often
+  pollTime = 1.0 if taskTimeout is None else min(1.0, 0.1 * taskTimeout)
+  done = set(computed)
+  attempts = {}
+  checkpointOut = open(checkpointFile, 'ab')
+  finished = False
+  try:
+    for ind, val in computed.items():
+      yield ind, val
     
-    if textOut:
-      if logOut is None:
-        print('Logging output to %s' % logFile)
-        logOut = open(logFile, 'w')
-      logOut.write(textOut)
+    if pendingChunks:
+      for n in range(numProcesses):
+        _startWorker()
+    textProgress.startProgress(numInput - len(done))
+    while len(done) < numInput:
+      # give work to idle workers
+      for workerId, worker in list(workers.items()):
+        if worker.chunk is None and not worker.process.is_alive():
+          # replace idle worker that died
+          _stopWorker(workerId, kill=True)
+          _startWorker()
+      for workerId, worker in list(workers.items()):
+        if worker.chunk is None and pendingChunks:
+          worker.chunk = pendingChunks.popleft()
+          worker.startTime = time()
+          worker.taskQueue.put([(ind, inputList[ind])
+                                for ind in worker.chunk])
+      
+      # collect all available results
+      connWorkers = {worker.resultConn : workerId
+                     for workerId, worker in workers.items()
+                     if worker.resultConn is not None}
+      messages = []
+      for resultConn in _waitConnections(list(connWorkers), pollTime):
+        workerId = connWorkers[resultConn]
+        try:
+          while True:
+            messages.append((workerId,) + resultConn.recv())
+            if not resultConn.poll():
+              break
+        except (EOFError, IOError, OSError):
+          # worker exited (perhaps part way through sending); that is
+          # handled below, so stop listening to it
+          resultConn.close()
+          workers[workerId].resultConn = None
+      
+      results = []
+      for workerId, ind, val, textOut, err in messages:
+        if textOut:
+          if logOut is None:
+            print('Logging output to %s' % logFile)
+            logOut = open(logFile, 'w')
+          logOut.write(textOut)
+        if err is not None:
+          # there was a problem, re-raise the error
+          raise err
+        worker = workers.get(workerId)
+        if worker is not None and worker.chunk is not None \
+           and ind in worker.chunk:
+          worker.chunk.remove(ind)
+          worker.startTime = time()
+          worker.numTasks += 1
+          if not worker.chunk:
+            worker.chunk = None
+            if maxTasksPerWorker is not None and \
+               worker.numTasks >= maxTasksPerWorker:
+              # recycle worker
+              _stopWorker(workerId)
+              _startWorker()
+        if ind in done:
+          # already computed (e.g. by a killed worker before a retry)
+          continue
+        done.add(ind)
+        # save progress as soon as it's made
+        _appendRecord(checkpointOut, (ind, val, textOut))
+        results.append((ind, val))
+      if results:
+        checkpointOut.flush()
+        os.fsync(checkpointOut.fileno())
+        textProgress.updateProgress(len(results))
+      
+      # check for workers that must be killed
+      failures = []
+      for workerId, worker in list(workers.items()):
+        if worker.chunk is None:
+          continue
+        if not worker.process.is_alive():
+          reason = 'crashed'
+          message = 'worker exited with code %s' % worker.process.exitcode
+        elif taskTimeout is not None and \
+             time() - worker.startTime > taskTimeout:
+          reason = 'timeout'
+          message = 'task took longer than %g s' % taskTimeout
+        elif maxMemory is not None and \
+             _residentMemory(worker.process.pid) > maxMemory:
+          reason = 'memory'
+          message = 'worker used more than %g MB' % maxMemory
+        else:
+          continue
+        # kill the worker, and retry its current task (or give up on it)
+        _stopWorker(workerId, kill=True)
+        _startWorker()
+        ind = worker.chunk[0]
+        rest = [i for i in worker.chunk[1:] if i not in done]
+        if rest:
+          pendingChunks.appendleft(rest)
+        if ind in done:
+          continue
+        attempts[ind] = attempts.get(ind, 0) + 1
+        if attempts[ind] <= maxRetries:
+          pendingChunks.appendleft([ind])
+        else:
+          done.add(ind)
+          failures.append((ind, TaskFailure(ind, reason, message,
+                                            attempts[ind])))
+      if failures:
+        textProgress.updateProgress(len(failures))
+      
+      for ind, val in results + failures:
+        yield ind, val
     
-    if err is None:
-      numOutput += 1
-      if numOutput > numPreCalc:
-        textProgress.updateProgress()
-      outputList[ind] = val
-      textOutList[ind] = textOut
-    else:
-      # there was a problem, save current progress
-      with open(resumeFile, 'wb') as fOut:
-        for ind, (val, textOut) in enumerate(zip(outputList, textOutList)):
-          if val is not None:
-            cPickle.dump((ind, val, textOut), fOut)
-      # stop all the functioning Processes
-      for p in procs:
-        if p.is_alive():
-          p.terminate()
-      # clean up log
-      if logOut is not None:
-        logOut.close()
-      # re-raise the error
-      raise err
-
-  # wait until all procs finished
-  for p in procs:
-    p.join()
-
-  assert outputQueue.empty()
+    # wait until all procs finished
+    for workerId in list(workers):
+      process = workers[workerId].process
+      _stopWorker(workerId)
+      process.join()
+    finished = True
+  finally:
+    # stop any functioning Processes (e.g. after an error)
+    for worker in workers.values():
+      if worker.process.is_alive():
+        worker.process.terminate()
+      if worker.resultConn is not None:
+        worker.resultConn.close()
+    checkpointOut.close()
+    # clean up log
+    if logOut is not None:
+      logOut.close()
   
-  if logOut is not None:
-    logOut.close()
+  if finished:
+    # map concluded successfully
+    if keepCheckpoint:
+      # rewrite checkpoint with just one record per input
+      _compactCheckpoint(checkpointFile)
+    else:
+      os.remove(checkpointFile)
+
+
+###############################################################################
+# checkpoint file: a sequence of records, each a header (payload length and
+# CRC-32) followed by a pickled (index, value, textOut) payload
+_recordHeader = struct.Struct('<II')
+
+
+def _appendRecord(fOut, record):
+  payload = cPickle.dumps(record, 2)
+  fOut.write(_recordHeader.pack(len(payload),
+                                zlib.crc32(payload) & 0xffffffff))
+  fOut.write(payload)
+
+
+def _readCheckpoint(checkpointFile):
+  """
+  Return dict of records {index: (value, textOut)} from checkpointFile. A
+  truncated or corrupt final record (e.g. from a killed job) is discarded,
+  and removed from the file so that new records can be appended.
+  """
+  records = {}
+  with open(checkpointFile, 'rb') as fIn:
+    goodEnd = 0
+    while True:
+      header = fIn.read(_recordHeader.size)
+      if len(header) < _recordHeader.size:
+        break
+      size, crc = _recordHeader.unpack(header)
+      payload = fIn.read(size)
+      if len(payload) < size or zlib.crc32(payload) & 0xffffffff != crc:
+        break
+      ind, val, textOut = cPickle.loads(payload)
+      records[ind] = (val, textOut)
+      goodEnd = fIn.tell()
+    fIn.seek(0, 2)
+    fileEnd = fIn.tell()
+  if goodEnd < fileEnd:
+    print('Discarding truncated record at end of %s' % checkpointFile)
+    with open(checkpointFile, 'r+b') as fOut:
+      fOut.truncate(goodEnd)
+      os.fsync(fOut.fileno())
+  return records
+
+
+def _compactCheckpoint(checkpointFile):
+  """
+  Atomically rewrite checkpointFile with only the last record for each index
+  """
+  records = _readCheckpoint(checkpointFile)
+  tempFile = checkpointFile + '.tmp'
+  with open(tempFile, 'wb') as fOut:
+    for ind, (val, textOut) in sorted(records.items()):
+      _appendRecord(fOut, (ind, val, textOut))
+    fOut.flush()
+    os.fsync(fOut.fileno())
+  os.rename(tempFile, checkpointFile)
+
+
+class TaskFailure(object):
+  """
+  Result of a task that was killed by robust_map (reason is 'timeout',
+  'memory', or 'crashed') on every one of its attempts
+  """
+  def __init__(self, index, reason, message, attempts):
+    self.index = index
+    self.reason = reason
+    self.message = message
+    self.attempts = attempts
   
-  if os.access(resumeFile, os.F_OK):
-    # resume file exists, but map concluded successfully
-    os.remove(resumeFile)
   
-  return outputList
+  def __repr__(self):
+    return 'TaskFailure(%d, %r, %r, %d)' % (self.index, self.reason,
+                                            self.message, self.attempts)
+
+
+class _Worker(object):
+  # a worker process, its task queue and result pipe (None once closed), and
+  # the chunk it's computing
+  def __init__(self, process, taskQueue, resultConn):
+    self.process = process
+    self.taskQueue = taskQueue
+    self.resultConn = resultConn
+    self.chunk = None
+    self.startTime = None
+    self.numTasks = 0
+
+
+def _residentMemory(pid):
+  """
+  Return resident memory (in MB) of process pid, or 0 if unknown
+  """
+  try:
+    with open('/proc/%d/statm' % pid, 'r') as fIn:
+      numPages = int(fIn.read().split()[1])
+  except (IOError, OSError, ValueError, IndexError):
+    return 0
+  return numPages * os.sysconf('SC_PAGE_SIZE') / 1048576.0
 
 
-def _mapFunc(f, inputQueue, outputQueue, initFunc, *args, **kwargs):
+def _mapFunc(f, taskQueue, resultConn, initFunc, *args, **kwargs):
   import sys
   import traceback
   sys.stdout = textOutput = StringIO()
   
   if initFunc is not None:
     initFunc()
-  try:
-    while not inputQueue.empty():
-      ind, inputVal = inputQueue.get()
-      if inputVal is None:
-        break
+  while True:
+    chunk = taskQueue.get()
+    if chunk is None:
+      break
+    for ind, inputVal in chunk:
       textOutput.seek(0)
-      outputVal = f(inputVal, *args, **kwargs)
-      outputQueue.put((ind, outputVal, textOutput.getvalue(), None))
-  except BaseException as err:
-    if err.args and err.args[0]:
-      if not isinstance(err.args[0], str):
-        err.args = (str(err.args[0]) + '\nProcess traceback:\n' +
-                  traceback.format_exc(),) + err.args[1:]
-      else:
-        err.args = (err.args[0] + '\nProcess traceback:\n' +
-                  traceback.format_exc(),) + err.args[1:]
-    else:
-      err.args = ('\nProcess traceback:\n' + traceback.format_exc(),) + \
-                 err.args[1:]
-    try:
-      outputQueue.put((ind, None, textOutput.getvalue(), err))
-    except:
-      pass
-    raise err
+      textOutput.truncate()
+      try:
+        outputVal = f(inputVal, *args, **kwargs)
+      except BaseException as err:
+        if err.args and err.args[0]:
+          if not isinstance(err.args[0], str):
+            err.args = (str(err.args[0]) + '\nProcess traceback:\n' +
+                      traceback.format_exc(),) + err.args[1:]
+          else:
+            err.args = (err.args[0] + '\nProcess traceback:\n' +
+                      traceback.format_exc(),) + err.args[1:]
+        else:
+          err.args = ('\nProcess traceback:\n' + traceback.format_exc(),) \
+                     + err.args[1:]
+        try:
+          resultConn.send((ind, None, textOutput.getvalue(), err))
+        except:
+          pass
+        raise err
+      resultConn.send((ind, outputVal, textOutput.getvalue(), None))
 
 
 def test_robust_map():